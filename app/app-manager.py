@@ -4,15 +4,10 @@
 #
 # SPDX-License-Identifier: GPL-3.0-or-later
 
-import argparse
-import json
-import os
-import time
+# Only the modules needed by an action are imported, so frequent queries like get-implementation start quickly
 
-from lib.manage import (compose, convert_to_upper, createDataDir, deleteData,
-                        download, downloadAll, downloadNew, get_var_safe,
-                        getAvailableUpdates, getUserData, setInstalled,
-                        setRemoved, update, getAppRegistryEntry)
+import os
+import sys
 
 # Print an error if user is not root
 if os.getuid() != 0:
@@ -22,22 +17,75 @@ if os.getuid() != 0:
 # The directory with this script
 scriptDir = os.path.dirname(os.path.realpath(__file__))
 nodeRoot = os.path.join(scriptDir, "..")
+
+# Fast path for queries like "app-manager.py get-implementation lightning": ask the daemon before even parsing the arguments
+if len(sys.argv) in [2, 3] and not sys.argv[-1].startswith("-"):
+    from lib.daemon import queryActions, request, socketPath
+    if sys.argv[1] in queryActions:
+        result = request(socketPath(nodeRoot), sys.argv[1], sys.argv[2] if len(sys.argv) == 3 else None)
+        if result is not None:
+            sys.stdout.write(result[1])
+            exit(result[0])
+
+import argparse
 appsDir = os.path.join(nodeRoot, "apps")
 appDataDir = os.path.join(nodeRoot, "app-data")
 userFile = os.path.join(nodeRoot, "db", "user.json")
 legacyScript = os.path.join(nodeRoot, "scripts", "app")
-torDataDir = os.path.join(nodeRoot, "tor", "data")
 
 parser = argparse.ArgumentParser(description="Manage apps on your Citadel")
 parser.add_argument('action', help='What to do with the app database.', choices=[
-                    "download", "generate", "update", "list-updates", "ls-installed", "install", "uninstall", "stop", "start", "compose", "restart", "get-ip", "get-implementation"])
+                    "download", "generate", "update", "list-updates", "ls-installed", "install", "uninstall", "stop", "start", "compose", "restart", "get-ip", "get-implementation", "start-all", "stop-all", "restart-all", "prefetch", "serve", "reap", "tor-status", "tor-scale"])
 parser.add_argument('--verbose', '-v', action='store_true')
+parser.add_argument('--force', '-f', action='store_true',
+                    help='Regenerate the app configuration even if nothing changed (For generate and update)')
+parser.add_argument('--jobs', '-j', type=int, default=0,
+                    help='How many apps (or images for prefetch, or subtrees for reap) to handle at once (For start-all, stop-all, restart-all, prefetch and reap, and the apps recreated by update, install and uninstall)')
+parser.add_argument('--rebalance', action='store_true',
+                    help='Also move apps from the busiest Tor instances to the least busy ones (For tor-scale)')
+parser.add_argument('--no-daemon', action='store_true',
+                    help='Answer get-ip, get-implementation and ls-installed without asking the app-manager daemon')
 parser.add_argument(
-    'app', help='Optional, the app to perform an action on. (For install, uninstall, stop, start and compose)', nargs='?')
+    'app', help='Optional, the app to perform an action on. (For install, uninstall, stop, start and compose, or the number of instances for tor-scale)', nargs='?')
 parser.add_argument(
-    'other', help='Anything else (For compose)', nargs="*")
+    'other', help='Anything else (For compose, or more apps for start-all, stop-all, restart-all and prefetch)', nargs="*")
 args = parser.parse_args()
 
+if args.action in ["ls-installed", "get-ip", "get-implementation"]:
+    # The daemon isn't running (or --no-daemon was given), answer the query in this process
+    from lib.query import runQuery
+    exitCode, output = runQuery(nodeRoot, args.action, args.app)
+    sys.stdout.write(output)
+    exit(exitCode)
+elif args.action == "serve":
+    from lib.daemon import serve, socketPath
+    serve(nodeRoot, socketPath(nodeRoot))
+    exit(0)
+elif args.action == "reap":
+    # Delete the data of uninstalled apps that was moved into the trash
+    from lib.trash import defaultJobs, reap
+    reap(nodeRoot, args.jobs or defaultJobs)
+    exit(0)
+elif args.action == "tor-status":
+    # How many hidden services every app Tor instance hosts
+    import json
+    from lib.torplacement import TorPlacement
+    print(json.dumps(TorPlacement(nodeRoot).status(), indent=2))
+    exit(0)
+
+from lib.tracing import span, startTrace
+
+# Time this action, if tracing is enabled
+startTrace(nodeRoot, "app-manager", " ".join(["app-manager", args.action] + ([args.app] if args.app else [])))
+
+from lib.manage import (compose, createDataDir, deleteData, download,
+                        downloadAll, downloadNew, getAppRegistryEntry,
+                        getAvailableUpdates, getDependencies, getUserData,
+                        setInstalled, setRemoved, update)
+from lib.registry import getCatalog
+
+catalog = getCatalog(appsDir)
+
 # If no action is specified, the list action is used
 if args.action is None:
     args.action = 'list'
@@ -52,7 +100,7 @@ elif args.action == 'download-new':
     downloadNew()
     exit(0)
 elif args.action == 'generate':
-    update()
+    update(args.force)
     exit(0)
 elif args.action == 'update':
     if args.app is None:
@@ -61,72 +109,62 @@ elif args.action == 'update':
     else:
         download(args.app)
         print("Downloaded latest {} version".format(args.app))
-    update()
-    exit(0)
-elif args.action == 'ls-installed':
-    try:
-        # Load the userFile as JSON, check if installedApps is in it, and if so, print the apps
-        with open(userFile, "r") as f:
-            userData = json.load(f)
-        if "installedApps" in userData:
-            with open(os.path.join(appsDir, "virtual-apps.json"), "r") as f:
-                virtual_apps = json.load(f)
-            # Print the apps
-            # Filter out virtual apps (virtual_apps.keys())
-            for app in userData["installedApps"]:
-                if app not in virtual_apps.keys():
-                    print(app)
-        else:
-            # To match the behavior of the old script, print a newline if there are no apps installed
-            print("\n")
-    except:
-        pass
+    changed = update(args.force)
+    # Only the installed apps that got a new configuration have to be recreated
+    # Their images are pulled first, the background prefetch then only pulls the images of the other apps
+    from lib.lifecycle import changedInstalledApps, prefetchAppImages, recreateApps
+    from lib.prefetch import startBackgroundPrefetch
+    recreated = changedInstalledApps(changed)
+    prefetchAppImages(recreated)
+    startBackgroundPrefetch(nodeRoot)
+    exit(1 if recreateApps(recreated, args.jobs) else 0)
 elif args.action == 'install':
     if not args.app:
         print("No app provided")
         exit(1)
-    registryEntry = getAppRegistryEntry(args.app)
+    with span("registry lookup"):
+        registryEntry = getAppRegistryEntry(args.app)
     # If registryEntry is None, fail
     if registryEntry is None:
         print("App {} does not seem to exist".format(args.app))
         exit(1)
     if isinstance(registryEntry['hiddenServices'], list):
-        for entry in registryEntry['hiddenServices']:
-            if not os.path.exists(os.path.join(torDataDir, entry, "hostname")):
-                print("Restarting Tor containers...")
-                try:
-                    os.system("docker restart app-tor app-2-tor app-3-tor")
-                except:
-                    print("Failed to restart Tor containers")
-                    exit(1)
-                print("Waiting for Tor containers to restart...")
-                for i in range(60):
-                    if os.path.exists(os.path.join(torDataDir, entry, "hostname")):
-                        break
-                    time.sleep(1)
-                else:
-                    print("Tor containers did not restart in time")
-                    exit(1)
-    update()
-    with open(os.path.join(appsDir, "virtual-apps.json"), "r") as f:
-        virtual_apps = json.load(f)
+        from lib.envstore import get_env_store
+        from lib.hiddenservices import ensureHiddenServices
+        # Reload only the Tor instances hosting the missing hidden services, and wait for all of them at once
+        with span("tor wait", services=len(registryEntry['hiddenServices'])):
+            missing = ensureHiddenServices(os.path.join(nodeRoot, "tor"), registryEntry['hiddenServices'],
+                                           get_env_store(os.path.join(nodeRoot, ".env")).load(), timeout=60)
+        if missing:
+            print("Tor containers did not create {} in time".format(", ".join(missing)))
+            exit(1)
+    changed = update()
     userData = getUserData()
     implements_service = False
-    for virtual_app in virtual_apps.keys():
-        implementations = virtual_apps[virtual_app]
-        if args.app in implementations:
-            for implementation in implementations:
-                if "installedApps" in userData and implementation in userData["installedApps"]:
-                    print("Another implementation of {} is already installed: {}. Uninstall it first to install this app.".format(virtual_app, implementation))
-                    exit(1)
-            implements_service = virtual_app
+    for virtual_app in catalog.getImplementedVirtualApps(args.app):
+        implementation = catalog.getInstalledImplementation(virtual_app, userData.get("installedApps", []))
+        if implementation:
+            print("Another implementation of {} is already installed: {}. Uninstall it first to install this app.".format(virtual_app, implementation))
+            exit(1)
+        implements_service = virtual_app
     createDataDir(args.app)
-    compose(args.app, "pull")
+    # Usually the images were already pulled in the background after the app was downloaded
+    from lib.prefetch import collectImages, prefetchImages
+    failed = prefetchImages(collectImages(appsDir, [args.app], {}))
+    if failed:
+        # docker compose tries to pull them again when it starts the app
+        print("Failed to pull: {}".format(", ".join(failed)))
     compose(args.app, "up --detach")
-    setInstalled(args.app)
     if implements_service:
-        setInstalled(implements_service)
-    update()
+        setInstalled(args.app, implements_service)
+    else:
+        setInstalled(args.app)
+    # Installing an app can change the configuration of other installed apps, like the ones using its services
+    # The app itself was just started, so it is only recreated if its configuration changed after it was marked as installed
+    from lib.generate import changedApps
+    from lib.lifecycle import recreateChangedApps
+    changed = [file for file in changed if changedApps([file]) != [args.app]] + update()
+    recreateChangedApps(changed, args.jobs)
 
 elif args.action == 'uninstall':
     if not args.app:
@@ -139,20 +177,15 @@ elif args.action == 'uninstall':
     print("Stopping app {}...".format(args.app))
     try:
         compose(args.app, "rm --force --stop")
-        print("Deleting data...")
+        print("Deleting data in the background...")
         deleteData(args.app)
     except:
         pass
     print("Removing from the list of installed apps...")
-    setRemoved(args.app)
-    with open(os.path.join(appsDir, "virtual-apps.json"), "r") as f:
-        virtual_apps = json.load(f)
-    implements_service = False
-    for virtual_app in virtual_apps.keys():
-        implementations = virtual_apps[virtual_app]
-        if args.app in implementations:
-            setRemoved(virtual_app)
-    update()
+    setRemoved(args.app, *catalog.getImplementedVirtualApps(args.app))
+    # Recreate the installed apps that lost access to the uninstalled app
+    from lib.lifecycle import recreateChangedApps
+    recreateChangedApps(update(), args.jobs)
 
 elif args.action == 'stop':
     if not args.app:
@@ -184,44 +217,36 @@ elif args.action == 'restart':
     compose(args.app, "rm --force --stop")
     compose(args.app, "up --detach")
 
-elif args.action == 'compose':
-    if not args.app:
-        print("No app provided")
+elif args.action in ['start-all', 'stop-all', 'restart-all']:
+    # Without any apps given, this runs the action for all installed apps
+    from lib.lifecycle import runBatch
+    apps = [args.app] + args.other if args.app else []
+    failed = runBatch(args.action[:-len("-all")], apps, args.jobs)
+    exit(1 if failed else 0)
+
+elif args.action == 'prefetch':
+    # Without any apps given, the images of all installed apps are pulled
+    from lib.prefetch import collectImages, defaultJobs, lockPrefetch, prefetchImages
+    apps = [args.app] + args.other if args.app else [app for app in getUserData().get("installedApps", []) if not catalog.isVirtualApp(app)]
+    with lockPrefetch(nodeRoot):
+        failed = prefetchImages(collectImages(appsDir, apps, getDependencies()), args.jobs or defaultJobs)
+    if failed:
+        print("Failed to pull: {}".format(", ".join(failed)))
         exit(1)
-    compose(args.app, " ".join(args.other))
 
-elif args.action == "get-ip":
-    if args.app == "":
-        print("Missing app")
+elif args.action == 'tor-scale':
+    from lib.torplacement import maxInstanceCount, scaleInstances
+    if not args.app or not args.app.isdigit():
+        print("No number of app Tor instances provided (1 to {})".format(maxInstanceCount))
         exit(1)
-    with open(os.path.join(appsDir, "virtual-apps.json"), "r") as f:
-        virtual_apps = json.load(f)
-    userData = getUserData()
-    implements_service = False
-    if args.app in virtual_apps:
-        for implementation in virtual_apps[args.app]:
-            if "installedApps" in userData and implementation in userData["installedApps"]:
-                print(get_var_safe("APP_{}_SERVICE_IP".format(convert_to_upper(implementation))))
-                exit(0)
-    else:
-        print("Not an virtual app")
+    try:
+        scaleInstances(nodeRoot, int(args.app), args.rebalance)
+    except ValueError as e:
+        print(e)
         exit(1)
 
-elif args.action == "get-implementation":
-    if args.app == "":
-        print("Missing app")
-        exit(1)
-    with open(os.path.join(appsDir, "virtual-apps.json"), "r") as f:
-        virtual_apps = json.load(f)
-    userData = getUserData()
-    implements_service = False
-    if args.app in virtual_apps:
-        for implementation in virtual_apps[args.app]:
-            if "installedApps" in userData and implementation in userData["installedApps"]:
-                print(implementation)
-                exit(0)
-    else:
-        print("Not an virtual app")
+elif args.action == 'compose':
+    if not args.app:
+        print("No app provided")
         exit(1)
-    print("Virtual app not found")
-    exit(1)
+    compose(args.app, " ".join(args.other))
@@ -0,0 +1,70 @@
+# SPDX-FileCopyrightText: 2023 Citadel and contributors
+#
+# SPDX-License-Identifier: GPL-3.0-or-later
+
+# The resident app-manager: a long-running process that answers query actions over a unix socket
+#
+# It keeps the app catalog, the user state and .env in memory, so asking it is much cheaper than
+# loading everything in a new process. Running it is optional, app-manager.py answers queries itself if it isn't running.
+#
+# Requests and replies are single lines of JSON:
+#   {"action": "get-implementation", "app": "lightning"}
+#   {"exitCode": 0, "output": "lnd\n"}
+
+import json
+import os
+import socket
+from typing import Optional, Tuple
+
+# The actions the daemon answers
+# The client side of this module only imports what's needed to talk to the daemon, so asking it is as cheap as possible
+queryActions = ["ls-installed", "get-ip", "get-implementation"]
+
+def socketPath(node_root: str) -> str:
+    return os.path.join(node_root, "events", "app-manager.socket")
+
+# Ask the daemon, returns None if it isn't running or didn't answer
+def request(path: str, action: str, app: Optional[str], timeout: float = 5) -> Optional[Tuple[int, str]]:
+    try:
+        with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as connection:
+            connection.settimeout(timeout)
+            connection.connect(path)
+            connection.sendall(json.dumps({"action": action, "app": app}).encode("utf-8") + b"\n")
+            reply = connection.makefile("rb").readline()
+        result = json.loads(reply)
+        return result["exitCode"], result["output"]
+    except (OSError, ValueError, KeyError, TypeError):
+        return None
+
+def serve(node_root: str, path: str):
+    import socketserver
+
+    from lib.query import runQuery
+
+    class Handler(socketserver.StreamRequestHandler):
+        def handle(self):
+            try:
+                message = json.loads(self.rfile.readline())
+                if message.get("action") not in queryActions:
+                    raise ValueError("Unsupported action")
+                exitCode, output = runQuery(node_root, message["action"], message.get("app"))
+            except Exception as e:
+                exitCode, output = 1, "{}\n".format(e)
+            try:
+                self.wfile.write(json.dumps({"exitCode": exitCode, "output": output}).encode("utf-8") + b"\n")
+            except OSError:
+                pass
+
+    class Server(socketserver.ThreadingUnixStreamServer):
+        daemon_threads = True
+
+    if os.path.exists(path):
+        os.remove(path)
+    # Only root can talk to the daemon, like only root can run app-manager.py
+    oldUmask = os.umask(0o077)
+    try:
+        server = Server(path, Handler)
+    finally:
+        os.umask(oldUmask)
+    with server:
+        server.serve_forever()
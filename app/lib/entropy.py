@@ -1,14 +1,21 @@
-# SPDX-FileCopyrightText: 2021-2022 Citadel and contributors
+# SPDX-FileCopyrightText: 2021-2023 Citadel and contributors
 #
 # SPDX-License-Identifier: GPL-3.0-or-later
 
+import hmac
 import os
-import subprocess
+from functools import lru_cache
+from typing import Dict
 
 scriptDir = os.path.dirname(os.path.realpath(__file__))
 nodeRoot = os.path.join(scriptDir, "..", "..")
 
-def deriveEntropy(identifier: str):
+# The number of additional seeds (APP_SEED_1 to APP_SEED_5) every app gets
+extraAppSeeds = 5
+
+# Read the node seed, this is only done once per process
+@lru_cache(maxsize=None)
+def getNodeSeed() -> str:
     seedFile = os.path.join(nodeRoot, "db", "citadel-seed", "seed")
     alternativeSeedFile = os.path.join(nodeRoot, "..", "db", "citadel-seed", "seed")
     if not os.path.isfile(seedFile):
@@ -17,7 +24,21 @@ def deriveEntropy(identifier: str):
         else:
             raise Exception("No seed file found")
     with open(seedFile, "r") as f:
-        node_seed = f.read().strip()
-    entropy = subprocess.check_output(
-        'printf "%s" "{}" | openssl dgst -sha256 -binary -hmac "{}" | xxd -p | tr --delete "\n"'.format(identifier, node_seed), shell=True)
-    return entropy.decode("utf-8")
+        return f.read().strip()
+
+# Hex-encoded HMAC-SHA256 of identifier, keyed with seed
+# This matches the output of: printf "%s" "<identifier>" | openssl dgst -sha256 -binary -hmac "<seed>" | xxd -p | tr --delete "\n"
+def hmacEntropy(seed: str, identifier: str) -> str:
+    return hmac.new(seed.encode("utf-8"), identifier.encode("utf-8"), "sha256").hexdigest()
+
+@lru_cache(maxsize=None)
+def deriveEntropy(identifier: str) -> str:
+    return hmacEntropy(getNodeSeed(), identifier)
+
+# Get all seeds for an app as a dict of env var name -> seed
+def deriveAppSeeds(app: str) -> Dict[str, str]:
+    seeds = {"APP_SEED": deriveEntropy("app-{}-seed".format(app))}
+    # Allow more app seeds, with random numbers from 1-5 assigned in a loop
+    for i in range(1, extraAppSeeds + 1):
+        seeds["APP_SEED_{}".format(i)] = deriveEntropy("app-{}-seed{}".format(app, i))
+    return seeds
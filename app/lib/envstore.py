@@ -0,0 +1,66 @@
+# SPDX-FileCopyrightText: 2023 Citadel and contributors
+#
+# SPDX-License-Identifier: GPL-3.0-or-later
+
+import os
+from typing import Dict, Iterable, Optional
+
+from lib.citadelutils import parse_dotenv
+
+# A process-wide view of a dotenv file
+# The file is only parsed again if its inode, size or mtime changed since the last read,
+# so looking up many variables (e.g. replacing every <placeholder> in a file) only reads .env once
+class EnvStore:
+    def __init__(self, file_path: str):
+        self.file_path = file_path
+        self._key = None
+        self._vars: Dict[str, str] = {}
+
+    # Returns the identity of the file on disk, or None if it doesn't exist
+    def _stat_key(self):
+        try:
+            st = os.stat(self.file_path)
+        except FileNotFoundError:
+            return None
+        return (st.st_ino, st.st_size, st.st_mtime_ns)
+
+    # Re-parse the file if it changed on disk and return all variables
+    def load(self) -> Dict[str, str]:
+        key = self._stat_key()
+        if key != self._key:
+            self._vars = parse_dotenv(self.file_path) if key is not None else {}
+            self._key = key
+        return self._vars
+
+    # Forget the parsed state, the next lookup will read the file again
+    def invalidate(self):
+        self._key = None
+        self._vars = {}
+
+    def get(self, var_name: str, default: Optional[str] = None) -> Optional[str]:
+        value = self.load().get(var_name)
+        return str(value) if value is not None else default
+
+    # Look up multiple variables at once, missing ones are left out of the result
+    def get_many(self, var_names: Iterable[str]) -> Dict[str, str]:
+        env = self.load()
+        return {name: str(env[name]) for name in var_names if name in env}
+
+    # Get all variables starting with prefix and ending with suffix
+    # For example, scan("APP_", "_SERVICE_IP") returns the service IPs of all apps
+    def scan(self, prefix: str = "", suffix: str = "") -> Dict[str, str]:
+        return {name: str(value) for name, value in self.load().items()
+                if name.startswith(prefix) and name.endswith(suffix)}
+
+    def __contains__(self, var_name: str) -> bool:
+        return var_name in self.load()
+
+
+_stores: Dict[str, EnvStore] = {}
+
+# Get the shared store for a dotenv file
+def get_env_store(file_path: str) -> EnvStore:
+    file_path = os.path.realpath(file_path)
+    if file_path not in _stores:
+        _stores[file_path] = EnvStore(file_path)
+    return _stores[file_path]
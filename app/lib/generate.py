@@ -0,0 +1,103 @@
+# SPDX-FileCopyrightText: 2023 Citadel and contributors
+#
+# SPDX-License-Identifier: GPL-3.0-or-later
+
+# Change detection for generating the app configuration with the app-cli
+#
+# Running the app-cli means starting a container that regenerates the configuration of every app.
+# The result only depends on a few inputs, so a fingerprint of them is stored in db/generate-state after every successful run,
+# together with a hash of every generated file. If neither the inputs nor the generated files changed since then,
+# running the app-cli again would not change anything, so it is skipped.
+
+import glob
+import hashlib
+import json
+import marshal
+import os
+from typing import Dict, List, Optional
+
+# Bump this if the layout of the state file changes
+stateVersion = 1
+
+def _hashFile(file_path: str) -> Optional[str]:
+    try:
+        with open(file_path, "rb") as f:
+            return hashlib.sha256(f.read()).hexdigest()
+    except (FileNotFoundError, IsADirectoryError):
+        return None
+
+class GenerateState:
+    def __init__(self, node_root: str):
+        self.nodeRoot = node_root
+        self.appsDir = os.path.join(node_root, "apps")
+        self.stateFile = os.path.join(node_root, "db", "generate-state")
+
+    # The files the app-cli generates, relative to the node root
+    def outputFiles(self) -> List[str]:
+        files = glob.glob(os.path.join(self.appsDir, "*", "docker-compose.yml"))
+        files += glob.glob(os.path.join(self.appsDir, "*.json"))
+        files += glob.glob(os.path.join(self.nodeRoot, "tor", "torrc-apps*"))
+        return sorted(os.path.relpath(file, self.nodeRoot) for file in files)
+
+    # Hashes of all generated files, by path relative to the node root
+    def outputs(self) -> Dict[str, Optional[str]]:
+        return {file: _hashFile(os.path.join(self.nodeRoot, file)) for file in self.outputFiles()}
+
+    # A fingerprint of everything the generated files depend on:
+    # every app's app.yml, the installed apps, .env and dependencies.yml (which includes the app-cli version)
+    def inputFingerprint(self) -> str:
+        fingerprint = hashlib.sha256()
+        for appYml in sorted(glob.glob(os.path.join(self.appsDir, "*", "app.yml"))):
+            fingerprint.update(os.path.relpath(appYml, self.appsDir).encode("utf-8") + b"\0")
+            fingerprint.update((_hashFile(appYml) or "").encode("utf-8") + b"\0")
+        installedApps = []
+        try:
+            with open(os.path.join(self.nodeRoot, "db", "user.json"), "r") as f:
+                installedApps = json.load(f).get("installedApps", [])
+        except (FileNotFoundError, ValueError):
+            pass
+        fingerprint.update(json.dumps(sorted(set(installedApps))).encode("utf-8") + b"\0")
+        for file in [".env", os.path.join("db", "dependencies.yml")]:
+            fingerprint.update((_hashFile(os.path.join(self.nodeRoot, file)) or "").encode("utf-8") + b"\0")
+        return fingerprint.hexdigest()
+
+    def load(self) -> Optional[dict]:
+        try:
+            with open(self.stateFile, "rb") as f:
+                state = marshal.load(f)
+        except (OSError, EOFError, ValueError, TypeError):
+            return None
+        if not isinstance(state, dict) or state.get("version") != stateVersion:
+            return None
+        return state
+
+    # True if the last successful run had the same inputs, and the generated files weren't changed since
+    def isCurrent(self, fingerprint: str, outputs: Dict[str, Optional[str]]) -> bool:
+        state = self.load()
+        return state is not None and state["inputs"] == fingerprint and state["outputs"] == outputs
+
+    # Write the state atomically, failing to do so only means the next run can't be skipped
+    def save(self, fingerprint: str, outputs: Dict[str, Optional[str]], changed: List[str]):
+        tmpFile = "{}.{}.tmp".format(self.stateFile, os.getpid())
+        try:
+            with open(tmpFile, "wb") as f:
+                marshal.dump({"version": stateVersion, "inputs": fingerprint, "outputs": outputs, "changed": changed}, f)
+            os.replace(tmpFile, self.stateFile)
+        except OSError:
+            try:
+                os.remove(tmpFile)
+            except OSError:
+                pass
+
+# The files that differ between two sets of output hashes
+def changedFiles(before: Dict[str, Optional[str]], after: Dict[str, Optional[str]]) -> List[str]:
+    return sorted(file for file in set(before) | set(after) if before.get(file) != after.get(file))
+
+# The apps whose docker-compose.yml is in a list of changed files
+def changedApps(changed: List[str]) -> List[str]:
+    apps = []
+    for file in changed:
+        parts = file.split(os.sep)
+        if len(parts) == 3 and parts[0] == "apps" and parts[2] == "docker-compose.yml":
+            apps.append(parts[1])
+    return apps
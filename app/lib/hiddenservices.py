@@ -0,0 +1,197 @@
+# SPDX-FileCopyrightText: 2023 Citadel and contributors
+#
+# SPDX-License-Identifier: GPL-3.0-or-later
+
+# Making sure an app's hidden services exist before it is installed
+#
+# The hidden services of apps are spread over the app Tor instances (app-tor, app-2-tor, ...) by lib/torplacement.py,
+# each with its own torrc. Only the instances that host a missing hidden service are reloaded,
+# through their control port if it is enabled, otherwise by sending them SIGHUP.
+# Both make Tor re-read its torrc and create new hidden services without dropping the existing ones.
+# Then all hostname files are waited for at once with inotify, with a single timeout.
+
+import ctypes
+import ctypes.util
+import os
+import select
+import socket
+import subprocess
+import time
+from typing import Dict, List, Optional
+
+from lib.torplacement import TorInstance, TorPlacement
+
+# Where the data dir of the Tor containers is mounted inside them
+containerDataDir = "/var/lib/tor"
+
+def appTorInstances(tor_dir: str) -> List[TorInstance]:
+    return TorPlacement(os.path.dirname(os.path.abspath(tor_dir))).instances()
+
+# Parse a torrc into a list of (option, value) pairs
+def _parseTorrc(torrc: str) -> List[tuple]:
+    options = []
+    try:
+        with open(torrc, "r") as f:
+            for line in f:
+                line = line.strip()
+                if not line or line.startswith("#"):
+                    continue
+                parts = line.split(None, 1)
+                options.append((parts[0].lower(), parts[1] if len(parts) > 1 else ""))
+    except FileNotFoundError:
+        pass
+    return options
+
+# Find the instances that host the given hidden services (names of directories in the Tor data dir)
+# If a hidden service isn't in any torrc, all instances are returned, because it's unknown which one will host it
+def findHostingInstances(instances: List[TorInstance], services: List[str]) -> List[TorInstance]:
+    hosting = []
+    found = set()
+    for instance in instances:
+        dirs = set(os.path.basename(value.rstrip("/")) for option, value in _parseTorrc(instance.torrc) if option == "hiddenservicedir")
+        if dirs.intersection(services):
+            hosting.append(instance)
+            found.update(dirs.intersection(services))
+    if found != set(services):
+        return list(instances)
+    return hosting
+
+# The address of an instance's control port, or None if it has none
+def controlAddress(instance: TorInstance, env: Dict[str, str]) -> Optional[tuple]:
+    for option, value in _parseTorrc(instance.torrc):
+        if option != "controlport":
+            continue
+        address = value.split()[0]
+        if address in ["0", "auto"] or address.startswith("unix:"):
+            continue
+        host, _, port = address.rpartition(":")
+        host = host or instance.ip or env.get(instance.ipVar, "")
+        if host and port.isdigit():
+            return host, int(port)
+    return None
+
+# The cookie to authenticate with, if the instance uses cookie authentication
+def _controlCookie(instance: TorInstance, tor_data_dir: str) -> Optional[bytes]:
+    options = dict(_parseTorrc(instance.torrc))
+    if options.get("cookieauthentication") != "1":
+        return None
+    cookieFile = options.get("cookieauthfile", os.path.join(options.get("datadirectory", containerDataDir), "control_auth_cookie"))
+    if cookieFile.startswith(containerDataDir + "/"):
+        cookieFile = os.path.join(tor_data_dir, cookieFile[len(containerDataDir) + 1:])
+    try:
+        with open(cookieFile, "rb") as f:
+            return f.read()
+    except OSError:
+        return None
+
+# Send SIGNAL RELOAD over a Tor control port, raises an OSError if that fails
+def reloadViaControlPort(address: tuple, cookie: Optional[bytes] = None, timeout: float = 5):
+    with socket.create_connection(address, timeout=timeout) as connection:
+        reader = connection.makefile("rb")
+        authenticate = "AUTHENTICATE {}".format(cookie.hex()) if cookie is not None else "AUTHENTICATE"
+        for name, command in [("AUTHENTICATE", authenticate), ("SIGNAL RELOAD", "SIGNAL RELOAD")]:
+            connection.sendall(command.encode("utf-8") + b"\r\n")
+            reply = reader.readline().decode("utf-8", "replace").strip()
+            if not reply.startswith("250"):
+                raise OSError("Tor refused {}: {}".format(name, reply))
+        connection.sendall(b"QUIT\r\n")
+
+# Make an instance re-read its torrc, through its control port if possible, otherwise with SIGHUP
+def reloadInstance(instance: TorInstance, env: Dict[str, str], tor_data_dir: str) -> bool:
+    address = controlAddress(instance, env)
+    if address is not None:
+        try:
+            reloadViaControlPort(address, _controlCookie(instance, tor_data_dir))
+            return True
+        except OSError as e:
+            print("Failed to reload {} through its control port: {}".format(instance.container, e))
+    return subprocess.call(["docker", "kill", "--signal", "HUP", instance.container], stdout=subprocess.DEVNULL) == 0
+
+
+# Minimal inotify bindings, only what's needed to wait for files to be created
+IN_MODIFY = 0x00000002
+IN_CLOSE_WRITE = 0x00000008
+IN_MOVED_TO = 0x00000080
+IN_CREATE = 0x00000100
+
+class _Inotify:
+    def __init__(self):
+        libc = ctypes.CDLL(ctypes.util.find_library("c") or "libc.so.6", use_errno=True)
+        self._addWatch = libc.inotify_add_watch
+        self._addWatch.argtypes = [ctypes.c_int, ctypes.c_char_p, ctypes.c_uint32]
+        self.fd = libc.inotify_init1(os.O_NONBLOCK | os.O_CLOEXEC)
+        if self.fd < 0:
+            raise OSError(ctypes.get_errno(), "inotify_init1 failed")
+        self.watched = set()
+
+    def watch(self, path: str) -> bool:
+        if path in self.watched:
+            return True
+        if self._addWatch(self.fd, os.fsencode(path), IN_CREATE | IN_MOVED_TO | IN_CLOSE_WRITE | IN_MODIFY) < 0:
+            return False
+        self.watched.add(path)
+        return True
+
+    # Wait until there are events or the timeout expires, the events themselves don't matter
+    def wait(self, timeout: float):
+        readable, _, _ = select.select([self.fd], [], [], max(0, timeout))
+        if readable:
+            try:
+                while os.read(self.fd, 65536):
+                    pass
+            except BlockingIOError:
+                pass
+
+    def close(self):
+        os.close(self.fd)
+
+def _hasHostname(directory: str) -> bool:
+    try:
+        return os.path.getsize(os.path.join(directory, "hostname")) > 0
+    except OSError:
+        return False
+
+# Wait until all hidden services have a (non-empty) hostname file, returns the ones that are still missing after the timeout
+def waitForHostnames(tor_data_dir: str, services: List[str], timeout: float = 60) -> List[str]:
+    deadline = time.monotonic() + timeout
+    missing = [service for service in services if not _hasHostname(os.path.join(tor_data_dir, service))]
+    if not missing:
+        return []
+    try:
+        inotify: Optional[_Inotify] = _Inotify()
+    except (OSError, AttributeError):
+        inotify = None
+    try:
+        while True:
+            if inotify is not None:
+                # Watch the data dir for the hidden service dirs to be created, and every existing dir for its hostname file
+                inotify.watch(tor_data_dir)
+                for service in missing:
+                    directory = os.path.join(tor_data_dir, service)
+                    if os.path.isdir(directory):
+                        inotify.watch(directory)
+            # Check after adding the watches, so files created in between aren't missed
+            missing = [service for service in missing if not _hasHostname(os.path.join(tor_data_dir, service))]
+            remaining = deadline - time.monotonic()
+            if not missing or remaining <= 0:
+                return missing
+            if inotify is not None:
+                inotify.wait(remaining)
+            else:
+                time.sleep(min(0.2, remaining))
+    finally:
+        if inotify is not None:
+            inotify.close()
+
+# Make sure all hidden services exist, reloading only the Tor instances that host them
+# Returns the ones that are still missing after the timeout
+def ensureHiddenServices(tor_dir: str, services: List[str], env: Dict[str, str], timeout: float = 60) -> List[str]:
+    torDataDir = os.path.join(tor_dir, "data")
+    missing = [service for service in services if not _hasHostname(os.path.join(torDataDir, service))]
+    if not missing:
+        return []
+    for instance in findHostingInstances(appTorInstances(tor_dir), missing):
+        print("Reloading {}...".format(instance.container))
+        if not reloadInstance(instance, env, torDataDir):
+            print("Failed to reload {}".format(instance.container))
+    return waitForHostnames(torDataDir, missing, timeout)
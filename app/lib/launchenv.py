@@ -0,0 +1,150 @@
+# SPDX-FileCopyrightText: 2023 Citadel and contributors
+#
+# SPDX-License-Identifier: GPL-3.0-or-later
+
+# The environment apps are launched with by compose()
+#
+# Building it means reading the hostname, the app's onion hostnames, deriving the app's seeds
+# and looking up the IPs of the virtual apps it may depend on. None of these change between two generate runs,
+# so the environment of every app is cached in db/launch-env/<app>, together with the identity of all files it was built from.
+# It is only rebuilt if one of these files changed.
+
+import json
+import marshal
+import os
+import socket
+from typing import Dict, List, Optional, Tuple
+
+from lib.entropy import deriveAppSeeds
+from lib.envstore import get_env_store
+from lib.registry import getCatalog, statKey
+
+# Bump this if the layout of the cache changes
+cacheVersion = 1
+
+def _upper(string: str) -> str:
+    return string.upper().replace('-', '_')
+
+class LaunchEnvCache:
+    def __init__(self, node_root: str):
+        self.nodeRoot = node_root
+        self.appsDir = os.path.join(node_root, "apps")
+        self.appDataDir = os.path.join(node_root, "app-data")
+        self.envFile = os.path.join(node_root, ".env")
+        self.userFile = os.path.join(node_root, "db", "user.json")
+        self.cacheDir = os.path.join(node_root, "db", "launch-env")
+        # Both locations entropy.getNodeSeed() looks at
+        self.seedFiles = [os.path.join(node_root, "db", "citadel-seed", "seed"),
+                          os.path.join(node_root, "..", "db", "citadel-seed", "seed")]
+        # App -> (inputs, env) of cache entries loaded by this process
+        self._entries: Dict[str, Tuple[list, Dict[str, str]]] = {}
+
+    def _hiddenServiceFile(self, app: str, service: Optional[str] = None) -> str:
+        name = "app-{}".format(app) if service is None else "app-{}-{}".format(app, service)
+        return os.path.join(self.nodeRoot, "tor", "data", name, "hostname")
+
+    # The files the environment of an app is built from
+    # The hidden services of an app come from the registry, which is one of these files,
+    # so if they change, the inputs change anyway
+    def _inputFiles(self, app: str, hiddenServices: List[str]) -> List[str]:
+        return [
+            self.envFile,
+            self.userFile,
+            os.path.join(self.appsDir, "registry.json"),
+            os.path.join(self.appsDir, "virtual-apps.json"),
+            *self.seedFiles,
+            self._hiddenServiceFile(app),
+            *[self._hiddenServiceFile(app, service) for service in hiddenServices],
+        ]
+
+    def _inputs(self, files: List[str]) -> list:
+        return [socket.gethostname(), files, [statKey(file) for file in files]]
+
+    def _readHostname(self, file: str) -> str:
+        try:
+            with open(file, "r") as f:
+                return f.read().strip()
+        except OSError:
+            return "notyetset.onion"
+
+    def _build(self, app: str, hiddenServices: List[str]) -> Dict[str, str]:
+        env: Dict[str, str] = {}
+        catalog = getCatalog(self.appsDir)
+        installedApps = []
+        if os.path.isfile(self.userFile):
+            with open(self.userFile, "r") as f:
+                installedApps = json.load(f).get("installedApps", [])
+        envStore = get_env_store(self.envFile)
+        for virtualApp in catalog.getVirtualApps().keys():
+            implementation = catalog.getInstalledImplementation(virtualApp, installedApps)
+            if implementation:
+                serviceIp = envStore.get("APP_{}_SERVICE_IP".format(_upper(implementation)))
+                if serviceIp:
+                    env["APP_{}_IP".format(_upper(virtualApp))] = serviceIp
+        env["APP_DOMAIN"] = (socket.gethostname().split(".")[0] or "citadel") + ".local"
+        env["APP_HIDDEN_SERVICE"] = self._readHostname(self._hiddenServiceFile(app))
+        try:
+            env.update(deriveAppSeeds(app))
+        except Exception:
+            pass
+        env["APP_DATA_DIR"] = os.path.join(self.appDataDir, app)
+        env["CITADEL_APP_DATA"] = self.appDataDir
+        env["BITCOIN_DATA_DIR"] = os.path.join(self.nodeRoot, "bitcoin")
+        env["CITADEL_ROOT"] = self.nodeRoot
+        # List all hidden services for an app and put their hostname in the environment
+        for service in hiddenServices:
+            env["APP_HIDDEN_SERVICE_{}".format(_upper(service))] = self._readHostname(self._hiddenServiceFile(app, service))
+        return env
+
+    def _load(self, app: str):
+        try:
+            with open(os.path.join(self.cacheDir, app), "rb") as f:
+                entry = marshal.load(f)
+        except (OSError, EOFError, ValueError, TypeError):
+            return None
+        if not isinstance(entry, dict) or entry.get("version") != cacheVersion:
+            return None
+        return entry["inputs"], entry["env"]
+
+    # Write the cache entry atomically, it contains the app's seeds, so only root can read it
+    # (scripts/configure leaves db/launch-env out when it changes the owner of the node's files)
+    def _save(self, app: str, inputs: list, env: Dict[str, str]):
+        cacheFile = os.path.join(self.cacheDir, app)
+        tmpFile = "{}.{}.tmp".format(cacheFile, os.getpid())
+        try:
+            os.makedirs(self.cacheDir, mode=0o700, exist_ok=True)
+            fd = os.open(tmpFile, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600)
+            with os.fdopen(fd, "wb") as f:
+                marshal.dump({"version": cacheVersion, "inputs": inputs, "env": env}, f)
+            os.replace(tmpFile, cacheFile)
+        except OSError:
+            try:
+                os.remove(tmpFile)
+            except OSError:
+                pass
+
+    # Get the launch environment of an app, without the variables of the process itself
+    def get(self, app: str) -> Dict[str, str]:
+        entry = self._entries.get(app) or self._load(app)
+        if entry is not None:
+            inputs, env = entry
+            # The cached inputs contain the list of files, so they can be checked without looking at the registry
+            if self._inputs(inputs[1]) == inputs:
+                self._entries[app] = entry
+                return env
+        # Every input has to be stat()ed before the environment is built, so changes while building cause a rebuild next time
+        hiddenServices: List[str] = (getCatalog(self.appsDir).getEntry(app) or {}).get("hiddenServices", [])
+        inputs = self._inputs(self._inputFiles(app, hiddenServices))
+        env = self._build(app, hiddenServices)
+        self._entries[app] = (inputs, env)
+        self._save(app, inputs, env)
+        return env
+
+_caches: Dict[str, LaunchEnvCache] = {}
+
+# Get the launch environment cache for a node, there's one per node root and process
+def getLaunchEnvCache(node_root: str) -> LaunchEnvCache:
+    key = os.path.realpath(node_root)
+    if key not in _caches:
+        _caches[key] = LaunchEnvCache(node_root)
+    return _caches[key]
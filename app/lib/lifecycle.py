@@ -0,0 +1,135 @@
+# SPDX-FileCopyrightText: 2023 Citadel and contributors
+#
+# SPDX-License-Identifier: GPL-3.0-or-later
+
+import os
+import time
+from concurrent.futures import ThreadPoolExecutor
+from typing import Dict, List
+
+from lib.generate import changedApps
+from lib.manage import appsDir, compose, getUserData, nodeRoot
+from lib.prefetch import collectImages, lockPrefetch, prefetchImages
+from lib.registry import getCatalog
+
+# How many apps are started or stopped at the same time, unless --jobs is passed
+# This can be overridden with the CITADEL_APP_JOBS environment variable
+def defaultJobs() -> int:
+    try:
+        return max(1, int(os.environ["CITADEL_APP_JOBS"]))
+    except (KeyError, ValueError):
+        return max(2, min(4, os.cpu_count() or 1))
+
+# Split apps into groups that can run at the same time
+# Implementations of virtual apps (like lnd for lightning) come first, so they are up before the apps consuming them
+def orderApps(apps: List[str]) -> List[List[str]]:
+    catalog = getCatalog(appsDir)
+    implementations = [app for app in apps if catalog.getImplementedVirtualApps(app)]
+    consumers = [app for app in apps if app not in implementations]
+    return [group for group in [implementations, consumers] if group]
+
+def _startApp(app: str, installedApps: List[str]) -> int:
+    if app not in installedApps:
+        print("App {} is not yet installed".format(app))
+        return 1
+    return compose(app, "up --detach")
+
+def _stopApp(app: str, installedApps: List[str]) -> int:
+    print("Stopping app {}...".format(app))
+    return compose(app, "rm --force --stop")
+
+def _restartApp(app: str, installedApps: List[str]) -> int:
+    if app not in installedApps:
+        print("App {} is not yet installed".format(app))
+        return 1
+    _stopApp(app, installedApps)
+    return compose(app, "up --detach")
+
+actions = {
+    "start": _startApp,
+    "stop": _stopApp,
+    "restart": _restartApp,
+}
+
+pastTense = {
+    "start": "Started",
+    "stop": "Stopped",
+    "restart": "Restarted",
+}
+
+# Runs an action for a single app, returning the exit code and how long it took
+def _runTimed(action: str, app: str, installedApps: List[str]):
+    startTime = time.monotonic()
+    try:
+        status = actions[action](app, installedApps)
+    except SystemExit as e:
+        status = e.code if isinstance(e.code, int) else 1
+    except Exception as e:
+        print("Failed to {} {}: {}".format(action, app, e))
+        status = 1
+    return status or 0, time.monotonic() - startTime
+
+# Start, stop or restart multiple apps in this process, with at most jobs apps at the same time
+# If apps is empty, all installed apps are used
+# Returns the number of apps that failed
+def runBatch(action: str, apps: List[str], jobs: int = 0) -> int:
+    userData = getUserData()
+    installedApps = userData.get("installedApps", [])
+    catalog = getCatalog(appsDir)
+    if not apps:
+        apps = [app for app in installedApps if not catalog.isVirtualApp(app)]
+    # Remove duplicates, but keep the order
+    apps = list(dict.fromkeys(apps))
+    groups = orderApps(apps)
+    # Stop consumers before the apps they depend on
+    if action == "stop":
+        groups.reverse()
+    jobs = jobs or defaultJobs()
+
+    results: Dict[str, tuple] = {}
+    batchStart = time.monotonic()
+    with ThreadPoolExecutor(max_workers=jobs) as pool:
+        for group in groups:
+            futures = {app: pool.submit(_runTimed, action, app, installedApps) for app in group}
+            for app, future in futures.items():
+                results[app] = future.result()
+    batchDuration = time.monotonic() - batchStart
+
+    print()
+    print("{:<24} {:>8} {:>10}".format("App", "Status", "Time"))
+    for app in apps:
+        status, duration = results[app]
+        print("{:<24} {:>8} {:>9.1f}s".format(app, "ok" if status == 0 else "failed", duration))
+    print("{} {} app(s) in {:.1f}s with up to {} at once".format(
+        pastTense[action], len(apps), batchDuration, jobs))
+    return len([app for app in apps if results[app][0] != 0])
+
+# Start the installed apps whose docker-compose.yml is in a list of changed files (from update()),
+# "docker compose up" recreates their containers that have a changed configuration, all other apps are left alone
+# Returns the number of apps that failed
+def recreateChangedApps(changed: List[str], jobs: int = 0) -> int:
+    apps = changedInstalledApps(changed)
+    prefetchAppImages(apps)
+    return recreateApps(apps, jobs)
+
+# The installed apps whose compose file is in the changed files
+def changedInstalledApps(changed: List[str]) -> List[str]:
+    installedApps = getUserData().get("installedApps", [])
+    return [app for app in changedApps(changed) if app in installedApps]
+
+# Pull the images of apps before they are recreated, so they are down for as short as possible
+# This holds the prefetch lock, so a background prefetch started later doesn't pull the same images at the same time
+def prefetchAppImages(apps: List[str]):
+    if not apps:
+        return
+    with lockPrefetch(nodeRoot):
+        failed = prefetchImages(collectImages(appsDir, apps, {}))
+    if failed:
+        # docker compose tries to pull them again when it recreates the apps
+        print("Failed to pull: {}".format(", ".join(failed)))
+
+def recreateApps(apps: List[str], jobs: int = 0) -> int:
+    if not apps:
+        return 0
+    print("Recreating apps with a changed configuration: {}".format(", ".join(apps)))
+    return runBatch("start", apps, jobs)
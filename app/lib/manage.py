@@ -2,18 +2,23 @@
 #
 # SPDX-License-Identifier: GPL-3.0-or-later
 
-import json
 import os
 import re
-import shutil
-import stat
 import subprocess
+from functools import lru_cache
 from sys import argv
 from typing import List
 
-import yaml
-from lib.citadelutils import parse_dotenv
-from lib.entropy import deriveEntropy
+from lib.envstore import get_env_store
+from lib.generate import GenerateState, changedFiles
+from lib.launchenv import getLaunchEnvCache
+from lib.permissions import Reconciler, reconcileOwner
+from lib.provision import provisionDir
+from lib.registry import getCatalog
+from lib.torplacement import TorPlacement
+from lib.tracing import span
+from lib.trash import moveToTrash, startReaper
+from lib.userstate import getUserState
 
 # The directory with this script
 scriptDir = os.path.dirname(os.path.realpath(__file__))
@@ -22,15 +27,22 @@ appsDir = os.path.join(nodeRoot, "apps")
 appSystemDir = os.path.join(nodeRoot, "app")
 appDataDir = os.path.join(nodeRoot, "app-data")
 userFile = os.path.join(nodeRoot, "db", "user.json")
-with open(os.path.join(nodeRoot, "db", "dependencies.yml"), "r") as file: 
-  dependencies = yaml.safe_load(file)
+# Compose commands that (re)create or start containers, only these need the permissions of the app's data dir to be fixed
+startingComposeCommands = ["up", "start", "restart", "run", "create"]
 
-dotenv = {}
+# db/dependencies.yml, only loaded when it's needed, because importing PyYAML takes a while
+@lru_cache(maxsize=None)
+def getDependencies() -> dict:
+    import yaml
+    with open(os.path.join(nodeRoot, "db", "dependencies.yml"), "r") as file:
+        return yaml.safe_load(file)
+
+envFile = os.path.join(nodeRoot, ".env")
 
 def get_var_safe(var_name):
-    dotenv = parse_dotenv(os.path.join(nodeRoot, ".env"))
-    if var_name in dotenv:
-        return str(dotenv[var_name])
+    var_value = get_env_store(envFile).get(var_name)
+    if var_value is not None:
+        return var_value
     else:
         print("Error: {} is not defined!".format(var_name))
         return False
@@ -50,145 +62,132 @@ def convert_to_upper(string):
 # Put variables in the config file. A config file accesses an env var $EXAMPLE_VARIABLE by containing <example-variable>
 # in the config file. Check for such occurences and replace them with the actual variable
 def replace_vars(file_content: str):
-  return re.sub(r'<(.*?)>', lambda m: get_var(convert_to_upper(m.group(1))), file_content)
-
-def update():
-    os.system("docker run --rm -v {}:/citadel -u 1000:1000 {} /app-cli convert /citadel".format(nodeRoot, dependencies['app-cli']))
+  env = get_env_store(envFile).get_many(
+      {convert_to_upper(name) for name in re.findall(r'<(.*?)>', file_content)})
+  return re.sub(r'<(.*?)>', lambda m: env.get(convert_to_upper(m.group(1))) or get_var(convert_to_upper(m.group(1))), file_content)
+
+# Generate the configuration of all apps, unless nothing it depends on changed since the last run
+# Returns the generated files (relative to the node root) that changed
+def update(force: bool = False) -> List[str]:
+    with span("generate") as generateSpan:
+        return _update(force, generateSpan)
+
+def _update(force: bool, generateSpan) -> List[str]:
+    state = GenerateState(nodeRoot)
+    fingerprint = state.inputFingerprint()
+    before = state.outputs()
+    if not force and state.isCurrent(fingerprint, before):
+        print("Configuration is already up to date")
+        generateSpan.set(upToDate=True)
+        return []
+    exitCode = os.system("docker run --rm -v {}:/citadel -u 1000:1000 {} /app-cli convert /citadel".format(nodeRoot, getDependencies()['app-cli']))
+    if exitCode == 0:
+        # Move the hidden services the app-cli wrote back to the Tor instances they were on, and place new ones
+        with span("tor placement"):
+            TorPlacement(nodeRoot).apply(generated=True)
+    after = state.outputs()
+    changed = changedFiles(before, after)
+    if exitCode != 0:
+        print("Failed to generate configuration")
+        return changed
+    # The app-cli may update some of its inputs itself, so the fingerprint is taken again after it ran
+    state.save(state.inputFingerprint(), after, changed)
+    generateSpan.set(changedFiles=len(changed))
     print("Generated configuration successfully")
+    if changed:
+        print("Changed files: {}".format(", ".join(changed)))
+    return changed
 
 def downloadNew():
-    os.system("docker run --rm -v {}:/citadel -u 1000:1000 {} /app-cli download-new /citadel".format(nodeRoot, dependencies['app-cli']))
+    os.system("docker run --rm -v {}:/citadel -u 1000:1000 {} /app-cli download-new /citadel".format(nodeRoot, getDependencies()['app-cli']))
     print("Generated configuration successfully")
 
 def downloadAll():
-    os.system("docker run --rm -v {}:/citadel -u 1000:1000 {} /app-cli download-apps /citadel".format(nodeRoot, dependencies['app-cli']))
+    os.system("docker run --rm -v {}:/citadel -u 1000:1000 {} /app-cli download-apps /citadel".format(nodeRoot, getDependencies()['app-cli']))
     print("Generated configuration successfully")
 
 def download(app_id):
-    os.system("docker run --rm -v {}:/citadel -u 1000:1000 {} /app-cli download {} --citadel-root /citadel".format(nodeRoot, dependencies['app-cli'], app_id))
+    os.system("docker run --rm -v {}:/citadel -u 1000:1000 {} /app-cli download {} --citadel-root /citadel".format(nodeRoot, getDependencies()['app-cli'], app_id))
     print("Generated configuration successfully")
 
 def getAvailableUpdates():
-    os.system("docker run --rm -v {}:/citadel -u 1000:1000 {} /app-cli check-updates /citadel".format(nodeRoot, dependencies['app-cli']))
+    os.system("docker run --rm -v {}:/citadel -u 1000:1000 {} /app-cli check-updates /citadel".format(nodeRoot, getDependencies()['app-cli']))
     print("Generated configuration successfully")
 
 def getUserData():
-    userData = {}
-    if os.path.isfile(userFile):
-        with open(userFile, "r") as f:
-            userData = json.load(f)
-    return userData
+    return getUserState(userFile).read()
 
 def compose(app, arguments):
     if not os.path.isdir(os.path.join(appsDir, app)):
         print("Warning: App {} doesn't exist on this node!".format(app))
-        return
-    virtual_apps = {}
-    with open(os.path.join(appsDir, "virtual-apps.json"), "r") as f:
-        virtual_apps = json.load(f)
-    userData = getUserData()
-    for virtual_app in virtual_apps.keys():
-        implementations = virtual_apps[virtual_app]
-        for implementation in implementations:
-            if "installedApps" in userData and implementation in userData["installedApps"]:
-                if get_var_safe("APP_{}_SERVICE_IP".format(convert_to_upper(implementation))):
-                    os.environ["APP_{}_IP".format(convert_to_upper(virtual_app))] = get_var_safe("APP_{}_SERVICE_IP".format(convert_to_upper(implementation)))  # type: ignore
-                #if get_var_safe("APP_{}_SERVICE_PORT".format(convert_to_upper(implementation))):
-                    #os.environ["APP_{}_PORT".format(virtual_app)] = get_var_safe("APP_{}_SERVICE_PORT".format(convert_to_upper(implementation)))  # type: ignore
-                break
+        return 1
+    # Build the environment for this call only, so compose() can run for multiple apps at once
+    env = os.environ.copy()
+    env.update(getLaunchEnvCache(nodeRoot).get(app))
     # Runs a compose command in the app dir
     # Before that, check if a docker-compose.yml exists in the app dir
     composeFile = os.path.join(appsDir, app, "docker-compose.yml")
     commonComposeFile = os.path.join(appSystemDir, "docker-compose.common.yml")
-    os.environ["APP_DOMAIN"] = subprocess.check_output(
-        "hostname -s 2>/dev/null || echo 'citadel'", shell=True).decode("utf-8").strip() + ".local"
-    os.environ["APP_HIDDEN_SERVICE"] = subprocess.check_output("cat {} 2>/dev/null || echo 'notyetset.onion'".format(
-        os.path.join(nodeRoot, "tor", "data", "app-{}/hostname".format(app))), shell=True).decode("utf-8").strip()
-    try:
-        os.environ["APP_SEED"] = deriveEntropy("app-{}-seed".format(app))
-        # Allow more app seeds, with random numbers from 1-5 assigned in a loop
-        for i in range(1, 6):
-            os.environ["APP_SEED_{}".format(i)] = deriveEntropy("app-{}-seed{}".format(app, i))
-    except: pass
-    os.environ["APP_DATA_DIR"] = os.path.join(appDataDir, app)
-    os.environ["CITADEL_APP_DATA"] = appDataDir
-    # Chown and chmod dataDir to have the owner 1000:1000 and the same permissions as appDir
-    subprocess.call("chown -R 1000:1000 {}".format(os.path.join(appDataDir, app)), shell=True)
-    try:
-        os.chmod(os.path.join(appDataDir, app), os.stat(os.path.join(appsDir, app)).st_mode)
-    except Exception:
-        pass
-    if app == "nextcloud":
-        subprocess.call("chown -R 33:33 {}".format(os.path.join(appDataDir, app, "data", "nextcloud")), shell=True)
-        subprocess.call("chmod -R 770 {}".format(os.path.join(appDataDir, app, "data", "nextcloud")), shell=True)
-    os.environ["BITCOIN_DATA_DIR"] = os.path.join(nodeRoot, "bitcoin")
-    os.environ["CITADEL_ROOT"] = nodeRoot
-    # List all hidden services for an app and put their hostname in the environment
-    hiddenServices: List[str] = getAppRegistryEntry(app).get("hiddenServices", [])
-    for service in hiddenServices:
-        appHiddenServiceFile = os.path.join(
-            nodeRoot, "tor", "data", "app-{}-{}/hostname".format(app, service))
-        os.environ["APP_HIDDEN_SERVICE_{}".format(service.upper().replace("-", "_"))] = subprocess.check_output("cat {} 2>/dev/null || echo 'notyetset.onion'".format(
-            appHiddenServiceFile), shell=True).decode("utf-8").strip()
+    if any(word in startingComposeCommands for word in arguments.split()):
+        fixDataDirPermissions(app)
 
     if not os.path.isfile(composeFile):
         print("Error: Could not find docker-compose.yml in " + app)
         exit(1)
-    os.system(
-        "docker compose --env-file '{}' --project-name '{}' --file '{}' --file '{}' {}".format(
-            os.path.join(nodeRoot, ".env"), app, commonComposeFile, composeFile, arguments))
+    with span(" ".join(["compose"] + arguments.split()[:1]), app=app, arguments=arguments):
+        return subprocess.call(
+            "docker compose --env-file '{}' --project-name '{}' --file '{}' --file '{}' {}".format(
+                os.path.join(nodeRoot, ".env"), app, commonComposeFile, composeFile, arguments), shell=True, env=env)
 
 
-def remove_readonly(func, path, _):
-    os.chmod(path, stat.S_IWRITE)
-    func(path)
-
-def deleteData(app: str):
+# Chown and chmod dataDir to have the owner 1000:1000 and the same permissions as appDir
+# Only entries that have the wrong owner or permissions are changed
+def fixDataDirPermissions(app: str):
     dataDir = os.path.join(appDataDir, app)
-    try:
-        shutil.rmtree(dataDir, onerror=remove_readonly)
-    except FileNotFoundError:
-        pass
+    prune = []
+    with span("chown", app=app):
+        if app == "nextcloud":
+            nextcloudDataDir = os.path.join(dataDir, "data", "nextcloud")
+            prune.append(nextcloudDataDir)
+            Reconciler(33, 33, 0o770).reconcile(nextcloudDataDir)
+        reconcileOwner(dataDir, 1000, 1000, prune)
+        try:
+            os.chmod(dataDir, os.stat(os.path.join(appsDir, app)).st_mode)
+        except Exception:
+            pass
+
+# Move the app's data dir into the trash, it is deleted in the background
+def deleteData(app: str):
+    with span("delete data", app=app):
+        if moveToTrash(nodeRoot, os.path.join(appDataDir, app)):
+            startReaper(nodeRoot)
 
 def createDataDir(app: str):
     dataDir = os.path.join(appDataDir, app)
     appDir = os.path.join(appsDir, app)
-    if os.path.isdir(dataDir):
-        deleteData(app)
     # Recursively copy everything from appDir to dataDir while excluding .gitkeep files
-    shutil.copytree(appDir, dataDir, symlinks=False,
-                    ignore=shutil.ignore_patterns(".gitkeep"))
-    # Chown and chmod dataDir to have the owner 1000:1000 and the same permissions as appDir
-    subprocess.call("chown -R 1000:1000 {}".format(os.path.join(appDataDir, app)), shell=True)
-    os.chmod(dataDir, os.stat(appDir).st_mode)
-
-
-def setInstalled(app: str):
-    userData = getUserData()
-    if not "installedApps" in userData:
-        userData["installedApps"] = []
-    userData["installedApps"].append(app)
-    userData["installedApps"] = list(set(userData["installedApps"]))
-    with open(userFile, "w") as f:
-        json.dump(userData, f)
-
-
-def setRemoved(app: str):
-    userData = getUserData()
-    if not "installedApps" in userData:
-        return
-    userData["installedApps"] = list(set(userData["installedApps"]))
-    userData["installedApps"].remove(app)
-    with open(userFile, "w") as f:
-        json.dump(userData, f)
+    # The copy is owned by 1000:1000 and only replaces an existing dataDir once it is complete
+    # An existing dataDir is moved into the trash and deleted in the background
+    trashed = []
+    with span("create data dir", app=app):
+        provisionDir(appDir, dataDir, 1000, 1000, discard=lambda old: trashed.append(moveToTrash(nodeRoot, old)))
+        os.chmod(dataDir, os.stat(appDir).st_mode)
+    if any(trashed):
+        startReaper(nodeRoot)
+
+
+# Mark one or more apps as installed, in a single change of the user file
+def setInstalled(*apps: str):
+    with span("set installed"):
+        getUserState(userFile).install(*apps)
+
+# Mark one or more apps as not installed, in a single change of the user file
+def setRemoved(*apps: str):
+    with span("set removed"):
+        getUserState(userFile).remove(*apps)
 
 # Gets the app's registry entry from the registry.json file
 # The file is an array of objects, each object is an app's registry entry
-# We can filter by the "id" property to get the app's registry entry
+# Lookups go through the app catalog, which indexes the registry by the "id" property
 def getAppRegistryEntry(app: str):
-    with open(os.path.join(appsDir, "registry.json")) as f:
-        registry = json.load(f)
-    for appRegistryEntry in registry:
-        if appRegistryEntry["id"] == app:
-            return appRegistryEntry
-    return None
+    return getCatalog(appsDir).getEntry(app)
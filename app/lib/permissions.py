@@ -0,0 +1,164 @@
+#!/usr/bin/env python3
+
+# SPDX-FileCopyrightText: 2023 Citadel and contributors
+#
+# SPDX-License-Identifier: GPL-3.0-or-later
+
+# Ownership and permission reconciler, a replacement for "chown -R" and "chmod -R"
+# It only calls lchown()/chmod() on entries that actually have the wrong owner or mode,
+# so running it over a tree that is already correct only reads metadata.
+# Like chown -R, an entry that can't be changed or listed is reported, and the rest of the tree is still fixed.
+#
+# This file doesn't import anything from lib, so it can also be run as a script from scripts/configure:
+#   permissions.py [--owner UID:GID] [--mode MODE] [--prune PATH]... [--jobs N] DIR...
+
+import argparse
+import os
+import stat
+import sys
+from concurrent.futures import ThreadPoolExecutor
+from typing import Iterable, List, NamedTuple, Optional
+
+class ReconcileStats(NamedTuple):
+    scanned: int = 0
+    chowned: int = 0
+    chmodded: int = 0
+    # Entries that couldn't be changed, and directories that couldn't be listed
+    failed: int = 0
+
+    def __add__(self, other):
+        return ReconcileStats(self.scanned + other.scanned, self.chowned + other.chowned, self.chmodded + other.chmodded,
+                              self.failed + other.failed)
+
+class Reconciler:
+    # uid and gid are the wanted owner, mode (like 0o770) the wanted permissions, None leaves them untouched
+    # Paths in prune (and everything below them) are skipped
+    def __init__(self, uid: Optional[int] = None, gid: Optional[int] = None, mode: Optional[int] = None,
+                 prune: Iterable[str] = (), jobs: int = 1):
+        self.uid = uid
+        self.gid = gid
+        self.mode = mode
+        self.prune = set(os.path.realpath(path) for path in prune)
+        self.jobs = max(1, jobs)
+
+    # Raises FileNotFoundError if the entry is gone, other errors are reported and counted
+    def _fix(self, path: str, st: os.stat_result) -> ReconcileStats:
+        chowned = 0
+        chmodded = 0
+        failed = 0
+        if (self.uid is not None and st.st_uid != self.uid) or (self.gid is not None and st.st_gid != self.gid):
+            try:
+                os.lchown(path, -1 if self.uid is None else self.uid, -1 if self.gid is None else self.gid)
+                chowned = 1
+            except FileNotFoundError:
+                raise
+            except OSError as e:
+                _report("changing ownership of", path, e)
+                failed = 1
+        # Like chmod -R, don't change the mode of symlinks
+        if self.mode is not None and not stat.S_ISLNK(st.st_mode) and stat.S_IMODE(st.st_mode) != self.mode:
+            try:
+                os.chmod(path, self.mode)
+                chmodded = 1
+            except FileNotFoundError:
+                raise
+            except OSError as e:
+                _report("changing permissions of", path, e)
+                failed = 1
+        return ReconcileStats(1, chowned, chmodded, failed)
+
+    # Reconcile a directory tree, without the root directory itself
+    def _walk(self, root: str) -> ReconcileStats:
+        stats = ReconcileStats()
+        stack = [root]
+        while stack:
+            directory = stack.pop()
+            try:
+                with os.scandir(directory) as entries:
+                    for entry in entries:
+                        if entry.path in self.prune:
+                            continue
+                        try:
+                            st = entry.stat(follow_symlinks=False)
+                            stats += self._fix(entry.path, st)
+                        except FileNotFoundError:
+                            continue
+                        except OSError as e:
+                            _report("reading", entry.path, e)
+                            stats += ReconcileStats(failed=1)
+                            continue
+                        if stat.S_ISDIR(st.st_mode):
+                            stack.append(entry.path)
+            except (FileNotFoundError, NotADirectoryError):
+                continue
+            except OSError as e:
+                _report("reading directory", directory, e)
+                stats += ReconcileStats(failed=1)
+        return stats
+
+    def reconcile(self, root: str) -> ReconcileStats:
+        root = os.path.realpath(root)
+        if root in self.prune:
+            return ReconcileStats()
+        try:
+            st = os.lstat(root)
+        except FileNotFoundError:
+            return ReconcileStats()
+        stats = self._fix(root, st)
+        if not stat.S_ISDIR(st.st_mode):
+            return stats
+        if self.jobs == 1:
+            return stats + self._walk(root)
+        # Fix the top level entries here, and walk every top level directory as its own shard
+        shards: List[str] = []
+        try:
+            with os.scandir(root) as entries:
+                for entry in entries:
+                    if entry.path in self.prune:
+                        continue
+                    try:
+                        entry_stat = entry.stat(follow_symlinks=False)
+                        stats += self._fix(entry.path, entry_stat)
+                    except FileNotFoundError:
+                        continue
+                    except OSError as e:
+                        _report("reading", entry.path, e)
+                        stats += ReconcileStats(failed=1)
+                        continue
+                    if stat.S_ISDIR(entry_stat.st_mode):
+                        shards.append(entry.path)
+        except OSError as e:
+            _report("reading directory", root, e)
+            return stats + ReconcileStats(failed=1)
+        with ThreadPoolExecutor(max_workers=self.jobs) as pool:
+            for shard_stats in pool.map(self._walk, shards):
+                stats += shard_stats
+        return stats
+
+def _report(action: str, path: str, error: OSError):
+    print("Error {} {}: {}".format(action, path, error.strerror or error), file=sys.stderr)
+
+# Like "chown -R uid:gid root", but only touching entries that need it
+def reconcileOwner(root: str, uid: int, gid: int, prune: Iterable[str] = (), jobs: int = 1) -> ReconcileStats:
+    return Reconciler(uid, gid, prune=prune, jobs=jobs).reconcile(root)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Recursively set owner and permissions, only where they are wrong")
+    parser.add_argument('--owner', help='The owner to set, as UID:GID')
+    parser.add_argument('--mode', help='The permissions to set, in octal (e.g. 770)')
+    parser.add_argument('--prune', action='append', default=[], help='Skip this path and everything below it')
+    parser.add_argument('--jobs', '-j', type=int, default=os.cpu_count() or 1)
+    parser.add_argument('directories', nargs='+')
+    args = parser.parse_args()
+    uid, gid = None, None
+    if args.owner:
+        uid, gid = [int(part) for part in args.owner.split(":")]
+    reconciler = Reconciler(uid, gid, int(args.mode, 8) if args.mode else None, args.prune, args.jobs)
+    total = ReconcileStats()
+    for directory in args.directories:
+        total += reconciler.reconcile(directory)
+    print("Checked {} entries, changed the owner of {} and the mode of {}".format(total.scanned, total.chowned, total.chmodded))
+    if total.failed:
+        print("Failed to change or read {} entries".format(total.failed))
+        exit(1)
@@ -0,0 +1,127 @@
+# SPDX-FileCopyrightText: 2023 Citadel and contributors
+#
+# SPDX-License-Identifier: GPL-3.0-or-later
+
+# Pulling the images of apps ahead of time
+#
+# The images of the apps' generated compose files and the images pinned in db/dependencies.yml are collected
+# into one deduplicated set. Images that are already present are skipped, the others are pulled by a few workers at once,
+# with retries. After apps were downloaded, this runs in the background,
+# so starting or installing apps later only has to create the containers.
+
+import fcntl
+import os
+import subprocess
+import sys
+import time
+from concurrent.futures import ThreadPoolExecutor
+from typing import Iterable, List, Set
+
+import yaml
+
+from lib.tracing import span
+
+try:
+    from yaml import CSafeLoader as SafeLoader
+except ImportError:
+    from yaml import SafeLoader  # type: ignore
+
+# How many images to pull at once
+defaultJobs = 4
+# How often to try pulling an image
+defaultAttempts = 3
+
+# Entries of dependencies.yml that aren't images
+nonImageDependencies = ["compose"]
+
+# Get the images used by the compose files of apps, and the ones pinned in dependencies.yml
+# Images that depend on variables can't be resolved here, so they are left to docker compose
+def collectImages(apps_dir: str, apps: Iterable[str], dependencies: dict) -> List[str]:
+    images: Set[str] = set()
+    for app in apps:
+        try:
+            with open(os.path.join(apps_dir, app, "docker-compose.yml"), "r") as f:
+                compose = yaml.load(f, Loader=SafeLoader) or {}
+        except FileNotFoundError:
+            continue
+        for service in (compose.get("services") or {}).values():
+            image = (service or {}).get("image")
+            if isinstance(image, str) and "$" not in image:
+                images.add(image)
+    for name, image in dependencies.items():
+        if name not in nonImageDependencies and isinstance(image, str):
+            images.add(image)
+    return sorted(images)
+
+# Split an image reference into repository, tag and digest
+# Images from Docker Hub are listed by docker without the docker.io/library/ prefix, so it is removed here too
+def _parseReference(image: str):
+    repository, _, digest = image.partition("@")
+    tag = "latest" if not digest else ""
+    name = repository.rsplit("/", 1)[-1]
+    if ":" in name:
+        repository, tag = repository.rsplit(":", 1)
+    for prefix in ["docker.io/library/", "docker.io/", "index.docker.io/library/", "index.docker.io/"]:
+        if repository.startswith(prefix):
+            repository = repository[len(prefix):]
+            break
+    return repository, tag, digest
+
+# Get the images that are already present locally
+def presentImages(images: List[str]) -> Set[str]:
+    try:
+        output = subprocess.check_output(
+            ["docker", "images", "--digests", "--format", "{{.Repository}} {{.Tag}} {{.Digest}}"], stderr=subprocess.DEVNULL).decode("utf-8")
+    except (OSError, subprocess.CalledProcessError):
+        return set()
+    tags = set()
+    digests = set()
+    for line in output.splitlines():
+        parts = line.split()
+        if len(parts) != 3:
+            continue
+        repository, tag, digest = parts
+        tags.add((repository, tag))
+        digests.add((repository, digest))
+    present = set()
+    for image in images:
+        repository, tag, digest = _parseReference(image)
+        # An image pinned by digest is only present if that digest is
+        if (digest and (repository, digest) in digests) or (not digest and (repository, tag) in tags):
+            present.add(image)
+    return present
+
+def pullImage(image: str, attempts: int = defaultAttempts) -> bool:
+    for attempt in range(attempts):
+        if attempt:
+            time.sleep(2 ** attempt)
+        if subprocess.call(["docker", "pull", "--quiet", image], stdout=subprocess.DEVNULL) == 0:
+            return True
+        print("Failed to pull {} (attempt {} of {})".format(image, attempt + 1, attempts), flush=True)
+    return False
+
+# Pull all images that aren't present yet, returns the ones that couldn't be pulled
+def prefetchImages(images: List[str], jobs: int = defaultJobs, attempts: int = defaultAttempts) -> List[str]:
+    with span("pull images", images=len(images)) as pullSpan:
+        present = presentImages(images)
+        missing = [image for image in images if image not in present]
+        pullSpan.set(missing=len(missing))
+        if not missing:
+            return []
+        print("Pulling {} of {} images...".format(len(missing), len(images)), flush=True)
+        with ThreadPoolExecutor(max_workers=max(1, jobs)) as pool:
+            results = list(pool.map(lambda image: pullImage(image, attempts), missing))
+        return [image for image, pulled in zip(missing, results) if not pulled]
+
+# Run a prefetch of all installed apps in a background process, logging to logs/prefetch.log
+# Only one prefetch runs at a time, a new one waits for the previous one, so it sees all images downloaded since
+def startBackgroundPrefetch(node_root: str):
+    with open(os.path.join(node_root, "logs", "prefetch.log"), "a") as log:
+        subprocess.Popen([sys.executable, os.path.join(node_root, "app", "app-manager.py"), "prefetch"],
+                         stdin=subprocess.DEVNULL, stdout=log, stderr=log, start_new_session=True)
+
+# Hold the prefetch lock while the returned file is open
+def lockPrefetch(node_root: str):
+    lock = open(os.path.join(node_root, "db", ".prefetch.lock"), "a")
+    fcntl.flock(lock.fileno(), fcntl.LOCK_EX)
+    return lock
@@ -0,0 +1,120 @@
+# SPDX-FileCopyrightText: 2023 Citadel and contributors
+#
+# SPDX-License-Identifier: GPL-3.0-or-later
+
+# Copies an app's template directory into its data dir
+#
+# Files are copied by a pool of workers, using a reflink or copy_file_range() where the filesystem supports it,
+# and get their owner set while they are copied.
+# Everything is written into a staging directory next to the target, which is renamed into place once the copy is complete,
+# so a failed copy never leaves a half-populated data dir behind.
+
+import errno
+import fcntl
+import os
+import shutil
+import stat
+from concurrent.futures import ThreadPoolExecutor
+from typing import Callable, List, Optional, Tuple
+
+# ioctl to clone a file (reflink) on filesystems like btrfs and xfs
+FICLONE = 0x40049409
+
+# Files with these names are not copied
+ignoredFiles = [".gitkeep"]
+
+def _copyData(src: int, dst: int, size: int):
+    try:
+        fcntl.ioctl(dst, FICLONE, src)
+        return
+    except OSError:
+        pass
+    offset = 0
+    if hasattr(os, "copy_file_range"):
+        try:
+            while offset < size:
+                copied = os.copy_file_range(src, dst, size - offset)
+                if copied == 0:
+                    break
+                offset += copied
+            return
+        except OSError as e:
+            # Not supported for these files (e.g. across filesystems on older kernels), fall back to a plain copy
+            if e.errno not in [errno.EXDEV, errno.ENOSYS, errno.EINVAL, errno.EOPNOTSUPP]:
+                raise
+    os.lseek(src, offset, os.SEEK_SET)
+    os.lseek(dst, offset, os.SEEK_SET)
+    while True:
+        chunk = os.read(src, 1024 * 1024)
+        if not chunk:
+            break
+        os.write(dst, chunk)
+
+# Copy a single file, including its permissions and timestamps, owned by uid:gid
+def copyFile(srcPath: str, dstPath: str, uid: int = -1, gid: int = -1):
+    src = os.open(srcPath, os.O_RDONLY)
+    try:
+        st = os.fstat(src)
+        dst = os.open(dstPath, os.O_WRONLY | os.O_CREAT | os.O_EXCL, 0o600)
+        try:
+            if uid != -1 or gid != -1:
+                os.fchown(dst, uid, gid)
+            _copyData(src, dst, st.st_size)
+            os.fchmod(dst, stat.S_IMODE(st.st_mode))
+        finally:
+            os.close(dst)
+        os.utime(dstPath, ns=(st.st_atime_ns, st.st_mtime_ns))
+    finally:
+        os.close(src)
+
+# Create the directory structure of src in dst, and return the directories and files in it
+# Like shutil.copytree(symlinks=False), symlinks are followed
+def _copyDirs(src: str, dst: str, uid: int, gid: int, ignore: Callable[[str], bool]):
+    dirs: List[Tuple[str, str]] = []
+    files: List[Tuple[str, str]] = []
+    stack = [(src, dst)]
+    while stack:
+        srcDir, dstDir = stack.pop()
+        os.mkdir(dstDir)
+        if uid != -1 or gid != -1:
+            os.lchown(dstDir, uid, gid)
+        dirs.append((srcDir, dstDir))
+        with os.scandir(srcDir) as entries:
+            for entry in entries:
+                if ignore(entry.name):
+                    continue
+                if entry.is_dir():
+                    stack.append((entry.path, os.path.join(dstDir, entry.name)))
+                else:
+                    files.append((entry.path, os.path.join(dstDir, entry.name)))
+    return dirs, files
+
+# Copy src to dst with the owner uid:gid, replacing dst if it exists
+# The replaced dst is passed to discard, which deletes it by default
+def provisionDir(src: str, dst: str, uid: int = -1, gid: int = -1, jobs: Optional[int] = None,
+                 ignore: Callable[[str], bool] = lambda name: name in ignoredFiles,
+                 discard: Callable[[str], object] = lambda path: shutil.rmtree(path, ignore_errors=True)):
+    dst = dst.rstrip("/")
+    parent, name = os.path.split(dst)
+    staging = os.path.join(parent, ".{}.staging-{}".format(name, os.getpid()))
+    if os.path.lexists(staging):
+        shutil.rmtree(staging)
+    try:
+        dirs, files = _copyDirs(src, staging, uid, gid, ignore)
+        with ThreadPoolExecutor(max_workers=jobs or min(8, (os.cpu_count() or 1) * 2)) as pool:
+            # list() so errors from the workers are raised here
+            list(pool.map(lambda paths: copyFile(paths[0], paths[1], uid, gid), files))
+        # Copy permissions and timestamps of directories last, adding files changed their mtime
+        for srcDir, dstDir in reversed(dirs):
+            shutil.copystat(srcDir, dstDir)
+    except BaseException:
+        shutil.rmtree(staging, ignore_errors=True)
+        raise
+    if os.path.lexists(dst):
+        # Move the old dir out of the way first, so dst is never missing for longer than between two renames
+        old = os.path.join(parent, ".{}.old-{}".format(name, os.getpid()))
+        os.rename(dst, old)
+        os.rename(staging, dst)
+        discard(old)
+    else:
+        os.rename(staging, dst)
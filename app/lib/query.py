@@ -0,0 +1,50 @@
+# SPDX-FileCopyrightText: 2023 Citadel and contributors
+#
+# SPDX-License-Identifier: GPL-3.0-or-later
+
+# Read-only app-manager actions that are called very often (by scripts/start, scripts/configure and the status scripts)
+#
+# These only need the app catalog, the user state and .env, which are all cached and revalidated by their file's stat,
+# so they can be answered by a long-running app-manager daemon too.
+# Every action returns its exit code and the text it prints.
+
+import os
+from typing import Optional, Tuple
+
+from lib.envstore import get_env_store
+from lib.registry import getCatalog
+from lib.userstate import getUserState
+
+def _upper(string: str) -> str:
+    return string.upper().replace('-', '_')
+
+def runQuery(node_root: str, action: str, app: Optional[str]) -> Tuple[int, str]:
+    catalog = getCatalog(os.path.join(node_root, "apps"))
+    try:
+        userData = getUserState(os.path.join(node_root, "db", "user.json")).read()
+    except ValueError:
+        userData = None
+    if action == "ls-installed":
+        # Nothing is printed without installed apps, scripts/app checks for an empty list
+        if userData is None or "installedApps" not in userData:
+            return 0, ""
+        # Filter out virtual apps
+        return 0, "".join("{}\n".format(installed) for installed in userData["installedApps"] if not catalog.isVirtualApp(installed))
+    if not app:
+        return 1, "Missing app\n"
+    if not catalog.isVirtualApp(app):
+        return 1, "Not an virtual app\n"
+    implementation = catalog.getInstalledImplementation(app, (userData or {}).get("installedApps", []))
+    if action == "get-ip":
+        if not implementation:
+            return 0, ""
+        varName = "APP_{}_SERVICE_IP".format(_upper(implementation))
+        serviceIp = get_env_store(os.path.join(node_root, ".env")).get(varName)
+        if serviceIp is None:
+            return 0, "Error: {} is not defined!\nFalse\n".format(varName)
+        return 0, "{}\n".format(serviceIp)
+    if action == "get-implementation":
+        if not implementation:
+            return 1, "Virtual app not found\n"
+        return 0, "{}\n".format(implementation)
+    raise ValueError("{} is not a query action".format(action))
@@ -0,0 +1,156 @@
+# SPDX-FileCopyrightText: 2023 Citadel and contributors
+#
+# SPDX-License-Identifier: GPL-3.0-or-later
+
+import json
+import marshal
+import os
+import threading
+from typing import Dict, List, Optional
+
+# Bump this if the layout of the index changes
+indexVersion = 1
+
+# Returns the identity of a file on disk, or None if it doesn't exist
+def statKey(file_path: str):
+    try:
+        st = os.stat(file_path)
+    except FileNotFoundError:
+        return None
+    return (st.st_ino, st.st_size, st.st_mtime_ns)
+
+# The app catalog: registry.json and virtual-apps.json from the apps dir
+#
+# Both files are loaded once per process and indexed by app id and by implementation.
+# The indexes are also stored in a compact marshal file next to the JSON files,
+# so later processes only decode the registry entries they actually look up.
+# Everything is invalidated when the inode, size or mtime of one of the JSON files changes.
+# The catalog is shared by the threads of a process, lookups and refreshes hold a lock.
+class AppCatalog:
+    def __init__(self, apps_dir: str):
+        self.registryFile = os.path.join(apps_dir, "registry.json")
+        self.virtualAppsFile = os.path.join(apps_dir, "virtual-apps.json")
+        self.indexFile = os.path.join(apps_dir, ".catalog-index")
+        self._sources = None
+        # App id -> JSON encoded registry entry, decoded on first access
+        self._rawEntries: Dict[str, str] = {}
+        self._entries: Dict[str, dict] = {}
+        self._virtualApps: Dict[str, List[str]] = {}
+        # Implementation -> virtual apps it implements
+        self._implements: Dict[str, List[str]] = {}
+        self._lock = threading.Lock()
+
+    def _sourceKeys(self):
+        return (statKey(self.registryFile), statKey(self.virtualAppsFile))
+
+    def _loadIndex(self, sources) -> bool:
+        try:
+            with open(self.indexFile, "rb") as f:
+                index = marshal.load(f)
+        except (OSError, EOFError, ValueError, TypeError):
+            return False
+        if not isinstance(index, dict) or index.get("version") != indexVersion or index.get("sources") != sources:
+            return False
+        self._rawEntries = index["entries"]
+        self._virtualApps = index["virtualApps"]
+        return True
+
+    def _buildIndex(self, sources):
+        registry = []
+        if sources[0] is not None:
+            with open(self.registryFile, "r") as f:
+                registry = json.load(f)
+        self._virtualApps = {}
+        if sources[1] is not None:
+            with open(self.virtualAppsFile, "r") as f:
+                self._virtualApps = json.load(f)
+        self._rawEntries = {}
+        for appRegistryEntry in registry:
+            # Keep the first entry if an id is listed twice, like the old linear search did
+            if appRegistryEntry["id"] not in self._rawEntries:
+                self._rawEntries[appRegistryEntry["id"]] = json.dumps(appRegistryEntry, separators=(",", ":"))
+        # Write the index atomically, failing to do so is not an error, it only makes the next run slower
+        tmpFile = "{}.{}.tmp".format(self.indexFile, os.getpid())
+        try:
+            with open(tmpFile, "wb") as f:
+                marshal.dump({
+                    "version": indexVersion,
+                    "sources": sources,
+                    "entries": self._rawEntries,
+                    "virtualApps": self._virtualApps,
+                }, f)
+            os.replace(tmpFile, self.indexFile)
+        except OSError:
+            try:
+                os.remove(tmpFile)
+            except OSError:
+                pass
+
+    # Make sure the in-memory state matches the files on disk, only call this while holding the lock
+    def _refresh(self):
+        sources = self._sourceKeys()
+        if sources == self._sources:
+            return
+        if not self._loadIndex(sources):
+            self._buildIndex(sources)
+        self._entries = {}
+        self._implements = {}
+        for virtualApp, implementations in self._virtualApps.items():
+            for implementation in implementations:
+                self._implements.setdefault(implementation, []).append(virtualApp)
+        self._sources = sources
+
+    # Gets the app's registry entry, or None if the app isn't in the registry
+    def getEntry(self, app: str) -> Optional[dict]:
+        with self._lock:
+            self._refresh()
+            entry = self._entries.get(app)
+            if entry is None:
+                rawEntry = self._rawEntries.get(app)
+                if rawEntry is None:
+                    return None
+                entry = json.loads(rawEntry)
+                self._entries[app] = entry
+            return entry
+
+    def getAppIds(self) -> List[str]:
+        with self._lock:
+            self._refresh()
+            return list(self._rawEntries.keys())
+
+    # Virtual app name -> list of apps implementing it
+    def getVirtualApps(self) -> Dict[str, List[str]]:
+        with self._lock:
+            self._refresh()
+            return self._virtualApps
+
+    def isVirtualApp(self, app: str) -> bool:
+        return app in self.getVirtualApps()
+
+    def getImplementations(self, virtualApp: str) -> List[str]:
+        return self.getVirtualApps().get(virtualApp, [])
+
+    # Get the virtual apps an app implements
+    def getImplementedVirtualApps(self, app: str) -> List[str]:
+        with self._lock:
+            self._refresh()
+            return self._implements.get(app, [])
+
+    # Get the installed implementation of a virtual app, or None if there is none
+    def getInstalledImplementation(self, virtualApp: str, installedApps: List[str]) -> Optional[str]:
+        for implementation in self.getImplementations(virtualApp):
+            if implementation in installedApps:
+                return implementation
+        return None
+
+
+_catalogs: Dict[str, AppCatalog] = {}
+_catalogsLock = threading.Lock()
+
+# Get the shared catalog for an apps dir
+def getCatalog(apps_dir: str) -> AppCatalog:
+    apps_dir = os.path.realpath(apps_dir)
+    with _catalogsLock:
+        if apps_dir not in _catalogs:
+            _catalogs[apps_dir] = AppCatalog(apps_dir)
+        return _catalogs[apps_dir]
@@ -0,0 +1,483 @@
+# SPDX-FileCopyrightText: 2023 Citadel and contributors
+#
+# SPDX-License-Identifier: GPL-3.0-or-later
+
+# Placement of the apps' hidden services on the app Tor instances (app-tor, app-2-tor, ...)
+#
+# The app-cli writes the hidden services of all apps into torrc-apps, torrc-apps-2 and torrc-apps-3.
+# After every run, the hidden services are taken from these files and spread over the configured number of instances:
+# every service keeps the instance it was assigned to before, so existing services never move and only the instance
+# that gets a new service has to be reloaded.
+# All hidden services of an app are placed on the same instance. New apps go to the instance with the lowest score,
+# which is the sum of the instance's share of the services (services of apps that aren't installed count less,
+# because they don't get any traffic) and its share of the CPU time the app Tor instances used since the last placement.
+#
+# The assignments, the number of instances and the addresses of the added instances are stored in db/tor-placement.json.
+# Changing the number of instances adds or removes the instances' services in docker-compose.yml, and only moves
+# the services of removed instances. The per-instance counts are written to statuses/tor-status.json.
+#
+# The compose services are also set by configure, with its own copy of composeInstances() in scripts/lib/services.py,
+# so an update that replaces docker-compose.yml doesn't remove added instances.
+# test_same_instances_as_the_app_manager in tests/test_services.py checks that both add the same services.
+#
+# Every torrc is bind-mounted into its container as a single file, so they are written in place:
+# a running Tor keeps the inode it was started with and wouldn't see a file that replaced it when it is reloaded.
+
+import copy
+import json
+import os
+import re
+import subprocess
+import time
+from typing import Dict, List, NamedTuple, Optional, Tuple
+
+defaultInstanceCount = 3
+maxInstanceCount = 16
+# Instances up to this one are defined in the default docker-compose.yml, with their addresses in .env
+builtinInstanceCount = 3
+# Services of apps that aren't installed get (almost) no traffic, they only publish their descriptors
+idleServiceWeight = 0.2
+# Bump this if the layout of the state file changes
+stateVersion = 1
+# Torrc options of instances that were added, their data dir has to be separate from the other instances'
+addedInstancePreamble = "SocksPort 0\nDataDirectory /var/lib/tor/{}\n"
+
+class TorInstance(NamedTuple):
+    container: str
+    torrc: str
+    # The variable in .env with the IP of the container
+    ipVar: str
+    # The IP of instances that aren't in .env
+    ip: Optional[str] = None
+
+def instanceName(index: int) -> str:
+    return "app-tor" if index == 0 else "app-{}-tor".format(index + 1)
+
+def torrcName(index: int) -> str:
+    return "torrc-apps" if index == 0 else "torrc-apps-{}".format(index + 1)
+
+def ipVar(index: int) -> str:
+    return "APPS_TOR_IP" if index == 0 else "APPS_{}_TOR_IP".format(index + 1)
+
+def isInstanceService(name: str) -> bool:
+    return re.match(r"^app(-[0-9]+)?-tor$", name) is not None
+
+# A hidden service from a torrc: its HiddenServiceDir and HiddenService* lines, and the comments right before them
+class HiddenService(NamedTuple):
+    name: str
+    lines: List[str]
+
+# Split a torrc into the options that aren't part of a hidden service, and the hidden services
+def parseTorrc(content: str) -> Tuple[List[str], List[HiddenService]]:
+    preamble: List[str] = []
+    services: List[HiddenService] = []
+    comments: List[str] = []
+    current: Optional[HiddenService] = None
+    for line in content.splitlines():
+        stripped = line.strip()
+        if not stripped:
+            preamble += comments
+            comments = []
+            current = None
+            continue
+        if stripped.startswith("#"):
+            comments.append(line)
+            continue
+        option = stripped.split(None, 1)[0].lower()
+        if option == "hiddenservicedir":
+            value = stripped.split(None, 1)[1] if " " in stripped else ""
+            current = HiddenService(os.path.basename(value.rstrip("/")), comments + [line])
+            services.append(current)
+        elif option.startswith("hiddenservice") and current is not None:
+            current.lines.extend(comments + [line])
+        else:
+            preamble.extend(comments + [line])
+            current = None
+        comments = []
+    preamble += comments
+    return preamble, services
+
+def formatTorrc(preamble: List[str], services: List[HiddenService]) -> str:
+    blocks = ["\n".join(preamble)] if preamble else []
+    blocks += ["\n".join(service.lines) for service in services]
+    return "\n\n".join(blocks) + "\n"
+
+def _readFile(filePath: str) -> Optional[str]:
+    try:
+        with open(filePath, "r") as f:
+            return f.read()
+    except FileNotFoundError:
+        return None
+
+# Write a file atomically, unless it already has this content, returns True if it was written
+def _writeIfChanged(filePath: str, content: str) -> bool:
+    if _readFile(filePath) == content:
+        return False
+    tmpFile = "{}.{}.tmp".format(filePath, os.getpid())
+    try:
+        with open(tmpFile, "w") as f:
+            f.write(content)
+        if os.path.exists(filePath):
+            st = os.stat(filePath)
+            os.chown(tmpFile, st.st_uid, st.st_gid)
+            os.chmod(tmpFile, st.st_mode & 0o7777)
+        os.replace(tmpFile, filePath)
+    except BaseException:
+        try:
+            os.remove(tmpFile)
+        except OSError:
+            pass
+        raise
+    return True
+
+# Write a file in place, keeping its inode, unless it already has this content, returns True if it was written
+def _writeInPlace(filePath: str, content: str) -> bool:
+    if _readFile(filePath) == content:
+        return False
+    with open(filePath, "w") as f:
+        f.write(content)
+    return True
+
+# CPU time (in seconds) containers used, from cgroup v2 or v1, by container name
+def _cpuUsage(containers: List[str], cgroupRoot: str = "/sys/fs/cgroup") -> Dict[str, float]:
+    # Containers that don't exist are skipped, docker inspect still prints the others
+    try:
+        output = subprocess.run(["docker", "inspect", "--format", "{{.Name}} {{.Id}}"] + containers,
+                                stdout=subprocess.PIPE, stderr=subprocess.DEVNULL).stdout.decode("utf-8")
+    except OSError:
+        return {}
+    usage = {}
+    for line in output.splitlines():
+        name, _, containerId = line.strip().lstrip("/").partition(" ")
+        candidates = [
+            (os.path.join(cgroupRoot, "system.slice", "docker-{}.scope".format(containerId), "cpu.stat"), "usage_usec", 1e-6),
+            (os.path.join(cgroupRoot, "docker", containerId, "cpu.stat"), "usage_usec", 1e-6),
+            (os.path.join(cgroupRoot, "cpuacct", "docker", containerId, "cpuacct.usage"), None, 1e-9),
+        ]
+        for filePath, key, scale in candidates:
+            try:
+                with open(filePath, "r") as f:
+                    content = f.read()
+            except OSError:
+                continue
+            if key is None:
+                usage[name] = int(content.strip()) * scale
+            else:
+                stats = dict(line.split(" ", 1) for line in content.splitlines() if " " in line)
+                usage[name] = int(stats.get(key, 0)) * scale
+            break
+    return usage
+
+def loadState(stateFile: str) -> dict:
+    try:
+        with open(stateFile, "r") as f:
+            state = json.load(f)
+        if state.get("version") == stateVersion:
+            return state
+    except (OSError, ValueError):
+        pass
+    # Without a state, every service stays on the instance the app-cli put it on
+    return {"version": stateVersion, "instances": defaultInstanceCount, "assignments": {}, "addresses": {}, "load": {}, "new": True}
+
+# The services of a compose file with the given number of app Tor instances, added instances are copies of app-tor
+# Instances that are in the file already are kept as they are, all of them are where app-tor is in the file
+def composeInstances(services: dict, count: int, addresses: Dict[str, List[str]]) -> dict:
+    wanted = {}
+    for index in range(count):
+        name = instanceName(index)
+        if name in services:
+            wanted[name] = services[name]
+            continue
+        definition = copy.deepcopy(services[instanceName(0)])
+        definition["container_name"] = name
+        definition["volumes"] = ["${{PWD}}/tor/{}:/etc/tor/torrc".format(torrcName(index)) if volume.endswith(":/etc/tor/torrc") else volume
+                                 for volume in definition["volumes"]]
+        if index < builtinInstanceCount:
+            address = ["$" + ipVar(index), "$" + ipVar(index) + "6"]
+        else:
+            address = addresses[name]
+        definition["networks"] = {"default": {"ipv4_address": address[0], "ipv6_address": address[1]}}
+        wanted[name] = definition
+    result = {}
+    for name, definition in services.items():
+        if name == instanceName(0):
+            result.update(wanted)
+        elif not isInstanceService(name):
+            result[name] = definition
+    return result
+
+class TorPlacement:
+    def __init__(self, nodeRoot: str):
+        self.nodeRoot = nodeRoot
+        self.torDir = os.path.join(nodeRoot, "tor")
+        self.appsDir = os.path.join(nodeRoot, "apps")
+        self.stateFile = os.path.join(nodeRoot, "db", "tor-placement.json")
+        self.statusFile = os.path.join(nodeRoot, "statuses", "tor-status.json")
+        self.composeFile = os.path.join(nodeRoot, "docker-compose.yml")
+        self.state = loadState(self.stateFile)
+
+    def _saveState(self):
+        self.state.pop("new", None)
+        _writeIfChanged(self.stateFile, json.dumps(self.state, indent=2, sort_keys=True) + "\n")
+
+    def instanceCount(self) -> int:
+        return self.state["instances"]
+
+    def instances(self) -> List[TorInstance]:
+        result = []
+        for index in range(self.instanceCount()):
+            name = instanceName(index)
+            address = self.state["addresses"].get(name)
+            result.append(TorInstance(name, os.path.join(self.torDir, torrcName(index)), ipVar(index), address[0] if address else None))
+        return result
+
+    # The torrc files there are on disk, by instance index, including those of instances that were removed
+    def _torrcFiles(self) -> Dict[int, str]:
+        files = {}
+        for index in range(max(maxInstanceCount, self.instanceCount())):
+            filePath = os.path.join(self.torDir, torrcName(index))
+            if os.path.isfile(filePath):
+                files[index] = filePath
+        return files
+
+    # The app every hidden service belongs to, services that aren't in the registry are their own group
+    def _appsOfServices(self) -> Dict[str, str]:
+        from lib.registry import getCatalog
+        catalog = getCatalog(self.appsDir)
+        apps = {}
+        for app in catalog.getAppIds():
+            services = (catalog.getEntry(app) or {}).get("hiddenServices")
+            if isinstance(services, list):
+                for service in services:
+                    apps.setdefault(service, app)
+        return apps
+
+    def _installedApps(self) -> List[str]:
+        from lib.userstate import getUserState
+        return getUserState(os.path.join(self.nodeRoot, "db", "user.json")).read().get("installedApps", [])
+
+    # Measure how much CPU time every instance used since the last placement, in cores
+    def observeLoad(self):
+        now = time.time()
+        usage = _cpuUsage([instance.container for instance in self.instances()])
+        load = {}
+        for name, seconds in usage.items():
+            previous = self.state["load"].get(name)
+            entry = {"cpuSeconds": seconds, "time": now, "cores": previous.get("cores", 0.0) if previous else 0.0}
+            # After a restart, the counter starts at zero again, then only the new value is recorded
+            if previous and seconds >= previous["cpuSeconds"] and now - previous["time"] >= 60:
+                entry["cores"] = (seconds - previous["cpuSeconds"]) / (now - previous["time"])
+            load[name] = entry
+        self.state["load"] = load
+
+    def _scores(self, weights: Dict[int, float], count: int) -> List[float]:
+        cores = [self.state["load"].get(instanceName(index), {}).get("cores", 0.0) for index in range(count)]
+        meanWeight = max(sum(weights.values()) / count, 1e-9)
+        meanCores = sum(cores) / count
+        return [weights.get(index, 0.0) / meanWeight + (cores[index] / meanCores if meanCores > 0 else 0.0) for index in range(count)]
+
+    # Assign every hidden service to an instance, keeping existing assignments
+    # Returns the services by instance index
+    def place(self, services: Dict[str, Tuple[HiddenService, int]], rebalance: bool = False) -> Dict[int, List[HiddenService]]:
+        count = self.instanceCount()
+        assignments: Dict[str, int] = self.state["assignments"]
+        apps = self._appsOfServices()
+        installed = set(self._installedApps())
+        groups: Dict[str, List[str]] = {}
+        for name in sorted(services):
+            groups.setdefault(apps.get(name, name), []).append(name)
+        groupWeight = lambda group: len(groups[group]) * (1.0 if group in installed else idleServiceWeight)
+
+        placed: Dict[str, int] = {}
+        unplaced = []
+        for group, names in groups.items():
+            for name in names:
+                index = assignments.get(name)
+                if index is None and self.state.get("new"):
+                    # Adopt the placement of the app-cli the first time
+                    index = services[name][1]
+                if index is not None and index < count:
+                    placed[name] = index
+            if any(name not in placed for name in names):
+                unplaced.append(group)
+
+        weights: Dict[int, float] = {}
+        for group, names in groups.items():
+            for name in names:
+                if name in placed:
+                    weights[placed[name]] = weights.get(placed[name], 0.0) + groupWeight(group) / len(names)
+
+        # Place new apps and the apps of removed instances, biggest first, on the instance with the lowest score
+        for group in sorted(unplaced, key=lambda group: (-groupWeight(group), group)):
+            names = groups[group]
+            existing = [placed[name] for name in names if name in placed]
+            if existing:
+                # Keep new services of an app with the ones it already has
+                index = existing[0]
+            else:
+                scores = self._scores(weights, count)
+                index = min(range(count), key=lambda i: (scores[i], i))
+            for name in names:
+                if name not in placed:
+                    placed[name] = index
+                    weights[index] = weights.get(index, 0.0) + groupWeight(group) / len(names)
+
+        if rebalance:
+            self._rebalance(groups, placed, weights, groupWeight, count)
+
+        self.state["assignments"] = {name: placed[name] for name in sorted(placed)}
+        result: Dict[int, List[HiddenService]] = {index: [] for index in range(count)}
+        for name in sorted(placed):
+            result[placed[name]].append(services[name][0])
+        return result
+
+    # Move whole apps from the instance with the highest score to the one with the lowest, while that lowers the highest score
+    def _rebalance(self, groups, placed, weights, groupWeight, count: int, maxMoves: int = 64):
+        for _ in range(maxMoves):
+            scores = self._scores(weights, count)
+            high = max(range(count), key=lambda i: scores[i])
+            low = min(range(count), key=lambda i: scores[i])
+            candidates = [group for group, names in groups.items() if all(placed[name] == high for name in names)]
+            best = None
+            for group in sorted(candidates, key=lambda group: (groupWeight(group), group)):
+                moved = dict(weights)
+                moved[high] = moved.get(high, 0.0) - groupWeight(group)
+                moved[low] = moved.get(low, 0.0) + groupWeight(group)
+                newScores = self._scores(moved, count)
+                if max(newScores[high], newScores[low]) < scores[high] - 1e-9:
+                    best = group
+                    break
+            if best is None:
+                return
+            for name in groups[best]:
+                placed[name] = low
+            weights[high] = weights.get(high, 0.0) - groupWeight(best)
+            weights[low] = weights.get(low, 0.0) + groupWeight(best)
+
+    # Read the hidden services from the torrc files and write the torrc files of the placement
+    # If the app-cli just generated them, only its files have all hidden services, the others are from the last placement
+    # Returns the indexes of the instances whose torrc changed
+    def apply(self, generated: bool = False, rebalance: bool = False) -> List[int]:
+        files = self._torrcFiles()
+        if not files:
+            # Nothing was generated yet
+            return []
+        self.observeLoad()
+        preambles: Dict[int, List[str]] = {}
+        services: Dict[str, Tuple[HiddenService, int]] = {}
+        for index, filePath in sorted(files.items()):
+            preamble, fileServices = parseTorrc(_readFile(filePath) or "")
+            preambles[index] = preamble
+            if generated and index >= builtinInstanceCount:
+                continue
+            for service in fileServices:
+                services.setdefault(service.name, (service, index))
+        placement = self.place(services, rebalance)
+        changed = []
+        for index in range(self.instanceCount()):
+            preamble = preambles.get(index) or addedInstancePreamble.format(instanceName(index)).splitlines()
+            if _writeInPlace(os.path.join(self.torDir, torrcName(index)), formatTorrc(preamble, placement[index])):
+                changed.append(index)
+        # The app-cli always writes three files, remove those of instances that don't exist
+        for index, filePath in files.items():
+            if index >= self.instanceCount():
+                os.remove(filePath)
+        self._saveState()
+        self.writeStatus(placement)
+        return changed
+
+    def status(self, placement: Optional[Dict[int, List[HiddenService]]] = None) -> dict:
+        if placement is None:
+            placement = {index: parseTorrc(_readFile(instance.torrc) or "")[1] for index, instance in enumerate(self.instances())}
+        apps = self._appsOfServices()
+        installed = set(self._installedApps())
+        instances = []
+        for index, instance in enumerate(self.instances()):
+            names = [service.name for service in placement.get(index, [])]
+            instances.append({
+                "name": instance.container,
+                "services": len(names),
+                "activeServices": len([name for name in names if apps.get(name) in installed]),
+                "apps": len(set(apps.get(name, name) for name in names)),
+                "cpuCores": round(self.state["load"].get(instance.container, {}).get("cores", 0.0), 4),
+            })
+        return {"instances": instances, "updated": int(time.time())}
+
+    def writeStatus(self, placement: Optional[Dict[int, List[HiddenService]]] = None):
+        if os.path.isdir(os.path.dirname(self.statusFile)):
+            _writeIfChanged(self.statusFile, json.dumps(self.status(placement), indent=2) + "\n")
+
+    # A free address for an added instance, counting down from the end of the network so it doesn't clash with apps
+    def _allocateAddress(self, env: Dict[str, str]) -> Tuple[str, str]:
+        used = set(env.values())
+        for address in self.state["addresses"].values():
+            used.update(address)
+        prefix = env.get("NETWORK_IP", "10.21.21.0").rsplit(".", 1)[0]
+        prefix6 = env.get("NETWORK_IP6", "fd00::21:0:0:0").rsplit(":", 1)[0]
+        for octet in range(254, 13, -1):
+            address = ("{}.{}".format(prefix, octet), "{}:{}".format(prefix6, octet))
+            if address[0] not in used and address[1] not in used:
+                return address
+        raise ValueError("No free address for another Tor instance")
+
+    # Add or remove the services of the instances in docker-compose.yml, returns True if it changed
+    def _updateCompose(self, count: int) -> bool:
+        import yaml
+        try:
+            from yaml import CDumper as Dumper
+            from yaml import CSafeLoader as SafeLoader
+        except ImportError:
+            from yaml import Dumper, SafeLoader  # type: ignore
+        from lib.envstore import get_env_store
+        with open(self.composeFile, "r") as f:
+            compose = yaml.load(f, Loader=SafeLoader)
+        env = get_env_store(os.path.join(self.nodeRoot, ".env")).load()
+        addresses = self.state["addresses"]
+        for name in list(addresses):
+            if name not in [instanceName(index) for index in range(builtinInstanceCount, count)]:
+                del addresses[name]
+        for index in range(builtinInstanceCount, count):
+            if instanceName(index) not in addresses:
+                addresses[instanceName(index)] = list(self._allocateAddress(env))
+        compose["services"] = composeInstances(compose["services"], count, addresses)
+        return _writeIfChanged(self.composeFile, yaml.dump(compose, Dumper=Dumper, sort_keys=False))
+
+    # Change the number of instances, only the services of removed instances (and with rebalance, of overloaded ones) move
+    # Returns the names of the instances that were added and removed, the ones that lost services and the other changed ones
+    def scale(self, count: int, rebalance: bool = False) -> Tuple[List[str], List[str], List[str], List[str]]:
+        if count < 1 or count > maxInstanceCount:
+            raise ValueError("The number of app Tor instances must be between 1 and {}".format(maxInstanceCount))
+        before = self.instanceCount()
+        assignments = dict(self.state["assignments"])
+        self.state["instances"] = count
+        self._updateCompose(count)
+        changed = [instanceName(index) for index in self.apply(rebalance=rebalance)]
+        added = [instanceName(index) for index in range(before, count)]
+        removed = [instanceName(index) for index in range(count, before)]
+        lost = sorted(set(instanceName(index) for name, index in assignments.items()
+                          if index < count and self.state["assignments"].get(name, index) != index))
+        others = [name for name in changed if name not in added and name not in lost]
+        return added, removed, lost, others
+
+# Change the number of app Tor instances and bring the running instances in line
+# Removed instances are stopped and the ones that lost services reloaded before any other instance takes their services over,
+# so no hidden service is hosted twice
+def scaleInstances(nodeRoot: str, count: int, rebalance: bool = False):
+    from lib.envstore import get_env_store
+    from lib.hiddenservices import reloadInstance
+    nodeRoot = os.path.abspath(nodeRoot)
+    placement = TorPlacement(nodeRoot)
+    added, removed, lost, others = placement.scale(count, rebalance)
+    compose = ["docker", "compose", "--file", placement.composeFile, "--env-file", os.path.join(nodeRoot, ".env")]
+    if removed:
+        print("Removing {}...".format(", ".join(removed)))
+        subprocess.call(compose + ["rm", "--force", "--stop"] + removed, cwd=nodeRoot)
+    env = get_env_store(os.path.join(nodeRoot, ".env")).load()
+    instances = {instance.container: instance for instance in placement.instances()}
+    for name in lost + others:
+        print("Reloading {}...".format(name))
+        if not reloadInstance(instances[name], env, os.path.join(placement.torDir, "data")):
+            print("Failed to reload {}".format(name))
+    if added:
+        print("Starting {}...".format(", ".join(added)))
+        subprocess.call(compose + ["up", "--detach"] + added, cwd=nodeRoot)
@@ -0,0 +1,259 @@
+# SPDX-FileCopyrightText: 2023 Citadel and contributors
+#
+# SPDX-License-Identifier: GPL-3.0-or-later
+
+# Structured timing of app-manager actions, configure runs and karen's triggers
+#
+# Every operation is a trace made of spans: timed phases like the registry lookup, generating the configuration
+# or starting an app's containers, and every subprocess that was run.
+# Spans are appended as lines of JSON to logs/trace.ndjson, which is rotated when it gets too big,
+# and summarized by "citadel trace".
+#
+# Tracing is off unless db/tracing exists or CITADEL_TRACE=1 is set, then span() only returns a shared no-op.
+# The trace is passed to subprocesses in the environment, so an app-manager call made by karen or configure
+# becomes part of the trace of the trigger or the configure run.
+#
+# scripts/lib/tracing.py writes the same spans for configure and karen, tests/test_tracing.py checks that both match.
+# startTrace() replaces subprocess.call, subprocess.run, subprocess.check_call, subprocess.check_output and os.system
+# for the whole process.
+
+import atexit
+import fcntl
+import json
+import os
+import subprocess
+import sys
+import threading
+import time
+from typing import Any, Dict, List, Optional
+
+# Spans are written to this file in logs/
+traceFileName = "trace.ndjson"
+# Rotate the trace file once it is this big, and keep this many rotated files
+maxTraceFileSize = 4 * 1024 * 1024
+keptTraceFiles = 2
+# Spans are written in batches of this size, and when the process exits
+flushThreshold = 64
+# Longer subprocess commands are shortened in spans
+maxCommandLength = 160
+
+class _NoopSpan:
+    def __enter__(self):
+        return self
+
+    def __exit__(self, excType, exc, traceback):
+        return False
+
+    def set(self, **attributes):
+        pass
+
+    def end(self, **attributes):
+        pass
+
+_noopSpan = _NoopSpan()
+
+class Span:
+    def __init__(self, tracer: "Tracer", name: str, parent: Optional[str], attributes: Dict[str, Any]):
+        self.tracer = tracer
+        self.name = name
+        self.id = tracer.newId()
+        self.parent = parent
+        self.attributes = attributes
+        self.start = time.time()
+        self._startCounter = time.perf_counter()
+        self._ended = False
+
+    def set(self, **attributes):
+        self.attributes.update(attributes)
+
+    def end(self, **attributes):
+        if self._ended:
+            return
+        self._ended = True
+        self.attributes.update(attributes)
+        self.tracer.record(self, (time.perf_counter() - self._startCounter) * 1000)
+
+    def __enter__(self):
+        self.tracer.push(self)
+        return self
+
+    def __exit__(self, excType, exc, traceback):
+        self.tracer.pop(self)
+        if excType is not None and not (excType is SystemExit and exc.code in [None, 0]):
+            self.attributes["error"] = "{}: {}".format(excType.__name__, exc)
+        self.end()
+        return False
+
+class Tracer:
+    def __init__(self, nodeRoot: str, component: str, traceId: Optional[str], parent: Optional[str]):
+        self.path = os.path.join(nodeRoot, "logs", traceFileName)
+        self.component = component
+        self.traceId = traceId or os.urandom(8).hex()
+        # The span of the parent process this process was started in
+        self.parent = parent
+        self.root: Optional[Span] = None
+        self.subprocesses = 0
+        self._buffer: List[str] = []
+        self._lock = threading.Lock()
+        self._local = threading.local()
+
+    def newId(self) -> str:
+        return os.urandom(4).hex()
+
+    # The innermost span that is open in this thread, spans opened in other threads are children of the root span
+    def current(self) -> Optional[str]:
+        stack = getattr(self._local, "stack", None)
+        if stack:
+            return stack[-1].id
+        return self.root.id if self.root else self.parent
+
+    def push(self, span: Span):
+        if not hasattr(self._local, "stack"):
+            self._local.stack = []
+        self._local.stack.append(span)
+
+    def pop(self, span: Span):
+        stack = getattr(self._local, "stack", [])
+        if stack and stack[-1] is span:
+            stack.pop()
+
+    def span(self, name: str, attributes: Dict[str, Any]) -> Span:
+        return Span(self, name, self.current(), attributes)
+
+    def record(self, span: Span, durationMs: float):
+        entry = {"trace": self.traceId, "span": span.id, "parent": span.parent, "component": self.component,
+                 "name": span.name, "start": round(span.start, 3), "durationMs": round(durationMs, 2), "pid": os.getpid()}
+        if span.attributes:
+            entry["attributes"] = span.attributes
+        line = json.dumps(entry, default=str)
+        with self._lock:
+            self._buffer.append(line)
+            full = len(self._buffer) >= flushThreshold
+        if full or span is self.root:
+            self.flush()
+
+    def flush(self):
+        with self._lock:
+            lines, self._buffer = self._buffer, []
+        if lines:
+            try:
+                appendRotated(self.path, ("\n".join(lines) + "\n").encode("utf-8"))
+            except OSError:
+                pass
+
+# Append data to a file, rotating it first if it would get bigger than maxTraceFileSize
+# The file is locked while it is written, so concurrent processes neither interleave lines nor rotate it twice
+def appendRotated(path: str, data: bytes, maxSize: int = maxTraceFileSize, kept: int = keptTraceFiles):
+    fd = os.open(path, os.O_WRONLY | os.O_APPEND | os.O_CREAT, 0o600)
+    try:
+        fcntl.flock(fd, fcntl.LOCK_EX)
+        st = os.fstat(fd)
+        if st.st_size and st.st_size + len(data) > maxSize:
+            try:
+                rotated = os.stat(path).st_ino != st.st_ino
+            except FileNotFoundError:
+                rotated = True
+            # Only rotate if another process didn't already do that while this one waited for the lock
+            if not rotated:
+                for i in range(kept - 1, 0, -1):
+                    if os.path.exists("{}.{}".format(path, i)):
+                        os.replace("{}.{}".format(path, i), "{}.{}".format(path, i + 1))
+                os.replace(path, "{}.1".format(path))
+            os.close(fd)
+            fd = os.open(path, os.O_WRONLY | os.O_APPEND | os.O_CREAT, 0o600)
+            fcntl.flock(fd, fcntl.LOCK_EX)
+        os.write(fd, data)
+    finally:
+        os.close(fd)
+
+_tracer: Optional[Tracer] = None
+
+def isEnabled(nodeRoot: str) -> bool:
+    setting = os.environ.get("CITADEL_TRACE")
+    if setting is not None:
+        return setting == "1"
+    return os.path.exists(os.path.join(nodeRoot, "db", "tracing"))
+
+# Start tracing this process, the returned root span ends when the process exits
+# If tracing is disabled, this returns a no-op and span() stays a no-op
+def startTrace(nodeRoot: str, component: str, name: str, **attributes):
+    global _tracer
+    if _tracer is not None:
+        return _tracer.root
+    if not isEnabled(nodeRoot):
+        return _noopSpan
+    _tracer = Tracer(nodeRoot, component, os.environ.get("CITADEL_TRACE_ID"), os.environ.get("CITADEL_TRACE_PARENT"))
+    _tracer.root = _tracer.span(name, attributes)
+    # Subprocesses (like app-manager called by configure) add their spans to this trace
+    os.environ["CITADEL_TRACE"] = "1"
+    os.environ["CITADEL_TRACE_ID"] = _tracer.traceId
+    os.environ["CITADEL_TRACE_PARENT"] = _tracer.root.id
+    _instrumentSubprocesses()
+    atexit.register(_finish)
+    return _tracer.root
+
+# Start a separate trace for one operation of a long-running process, like a job of karen
+# Returns the operation's span, which has to be ended, and the environment to pass to the operation's subprocesses
+def startOperation(nodeRoot: str, component: str, name: str, **attributes):
+    if not isEnabled(nodeRoot):
+        return _noopSpan, {}
+    tracer = Tracer(nodeRoot, component, None, None)
+    tracer.root = tracer.span(name, attributes)
+    return tracer.root, {"CITADEL_TRACE": "1", "CITADEL_TRACE_ID": tracer.traceId, "CITADEL_TRACE_PARENT": tracer.root.id}
+
+def _finish():
+    if _tracer is None or _tracer.root is None:
+        return
+    _tracer.root.end(subprocesses=_tracer.subprocesses)
+    _tracer.flush()
+
+# Time a phase of the current operation
+def span(name: str, **attributes):
+    if _tracer is None:
+        return _noopSpan
+    return _tracer.span(name, attributes)
+
+def _describe(command) -> str:
+    if isinstance(command, (list, tuple)):
+        command = " ".join(str(part) for part in command)
+    command = str(command)
+    return command if len(command) <= maxCommandLength else command[:maxCommandLength - 3] + "..."
+
+# Count all subprocesses, and time the ones run by os.system() and the subprocess helpers that wait for them
+def _instrumentSubprocesses():
+    local = threading.local()
+
+    def countSpawns(event, args):
+        if event in ["subprocess.Popen", "os.system"] and _tracer is not None:
+            _tracer.subprocesses += 1
+
+    def timed(function, exitCode):
+        def wrapper(command, *args, **kwargs):
+            # subprocess.check_output() calls subprocess.run(), only time the outer call
+            if getattr(local, "active", False):
+                return function(command, *args, **kwargs)
+            local.active = True
+            mainThread = threading.current_thread() is threading.main_thread()
+            parent = os.environ.get("CITADEL_TRACE_PARENT")
+            try:
+                with span("subprocess", command=_describe(command)) as subprocessSpan:
+                    # Spans of the subprocess become children of this span, other threads' subprocesses are children of the root span
+                    if mainThread:
+                        os.environ["CITADEL_TRACE_PARENT"] = subprocessSpan.id
+                    result = function(command, *args, **kwargs)
+                    code = exitCode(result)
+                    if code is not None:
+                        subprocessSpan.set(exitCode=code)
+                    return result
+            finally:
+                local.active = False
+                if mainThread and parent is not None:
+                    os.environ["CITADEL_TRACE_PARENT"] = parent
+        return wrapper
+
+    sys.addaudithook(countSpawns)
+    os.system = timed(os.system, lambda status: os.waitstatus_to_exitcode(status) if status >= 0 else status)
+    subprocess.call = timed(subprocess.call, lambda code: code)
+    subprocess.run = timed(subprocess.run, lambda process: process.returncode)
+    subprocess.check_call = timed(subprocess.check_call, lambda code: code)
+    subprocess.check_output = timed(subprocess.check_output, lambda output: 0)
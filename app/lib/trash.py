@@ -0,0 +1,128 @@
+# SPDX-FileCopyrightText: 2023 Citadel and contributors
+#
+# SPDX-License-Identifier: GPL-3.0-or-later
+
+# Deferred deletion of app data
+#
+# Deleting a large data dir can take many minutes, so uninstalling (or reinstalling) an app only renames it
+# into app-data/.trash, which is on the same filesystem, so that's atomic and instant.
+# A background reaper then deletes everything in there with a few workers at idle CPU and I/O priority,
+# so it doesn't compete with bitcoind. scripts/start runs the reaper too, so deletions interrupted by a reboot are finished.
+
+import errno
+import fcntl
+import os
+import shutil
+import stat
+import subprocess
+import sys
+import time
+from concurrent.futures import ThreadPoolExecutor
+from typing import List, Optional, Tuple
+
+# How many subtrees are deleted at once
+defaultJobs = 4
+
+def trashDir(node_root: str) -> str:
+    return os.path.join(node_root, "app-data", ".trash")
+
+def _removeReadonly(func, path, _):
+    os.chmod(path, stat.S_IWRITE)
+    func(path)
+
+def _remove(path: str):
+    try:
+        if os.path.isdir(path) and not os.path.islink(path):
+            shutil.rmtree(path, onerror=_removeReadonly)
+        else:
+            os.remove(path)
+    except FileNotFoundError:
+        pass
+
+# Move a file or directory into the trash, returns the new path, or None if it didn't exist
+# If it can't be renamed into the trash (e.g. because it is a mount point), it is deleted right away
+def moveToTrash(node_root: str, path: str) -> Optional[str]:
+    trash = trashDir(node_root)
+    os.makedirs(trash, mode=0o700, exist_ok=True)
+    target = os.path.join(trash, "{}.{}-{}".format(os.path.basename(path.rstrip("/")), time.time_ns(), os.getpid()))
+    try:
+        os.rename(path, target)
+    except FileNotFoundError:
+        return None
+    except OSError as e:
+        if e.errno not in [errno.EXDEV, errno.EBUSY]:
+            raise
+        _remove(path)
+        return None
+    return target
+
+# Split the trees in the trash into subtrees that can be deleted independently
+# Directories are expanded breadth first until there are enough subtrees to keep all workers busy,
+# the expanded directories are returned deepest first, so they are empty by the time they are removed
+def _splitTrees(roots: List[str], want: int) -> Tuple[List[str], List[str]]:
+    subtrees = list(roots)
+    expanded: List[str] = []
+    for _ in range(3):
+        if len(subtrees) >= want:
+            break
+        nextSubtrees = []
+        for path in subtrees:
+            if os.path.islink(path) or not os.path.isdir(path):
+                nextSubtrees.append(path)
+                continue
+            try:
+                with os.scandir(path) as entries:
+                    nextSubtrees.extend(entry.path for entry in entries)
+            except OSError:
+                nextSubtrees.append(path)
+                continue
+            expanded.append(path)
+        subtrees = nextSubtrees
+    return subtrees, list(reversed(expanded))
+
+# Delete everything in the trash, returns the number of entries that were deleted
+def emptyTrash(node_root: str, jobs: int = defaultJobs) -> int:
+    trash = trashDir(node_root)
+    deleted = 0
+    # Entries may be added while this runs, so list the trash again until it is empty
+    while True:
+        try:
+            roots = [entry.path for entry in os.scandir(trash)]
+        except FileNotFoundError:
+            return deleted
+        if not roots:
+            return deleted
+        subtrees, expanded = _splitTrees(roots, jobs * 4)
+        with ThreadPoolExecutor(max_workers=max(1, jobs)) as pool:
+            list(pool.map(_remove, subtrees))
+        for path in expanded:
+            try:
+                os.rmdir(path)
+            except FileNotFoundError:
+                pass
+        deleted += len(roots)
+
+# Lower the CPU and I/O priority of this process, threads started afterwards inherit them
+def lowerPriority():
+    try:
+        os.nice(19)
+    except OSError:
+        pass
+    # Idle I/O class, only gets disk time when nothing else needs it
+    try:
+        subprocess.call(["ionice", "-c", "3", "-p", str(os.getpid())], stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    except OSError:
+        pass
+
+# Empty the trash, waiting for a running reaper to finish first so entries it already listed aren't deleted twice
+def reap(node_root: str, jobs: int = defaultJobs) -> int:
+    lowerPriority()
+    with open(os.path.join(node_root, "db", ".reaper.lock"), "a") as lock:
+        fcntl.flock(lock.fileno(), fcntl.LOCK_EX)
+        return emptyTrash(node_root, jobs)
+
+# Run the reaper in a background process, logging to logs/reaper.log
+def startReaper(node_root: str):
+    with open(os.path.join(node_root, "logs", "reaper.log"), "a") as log:
+        subprocess.Popen([sys.executable, os.path.join(node_root, "app", "app-manager.py"), "reap"],
+                         stdin=subprocess.DEVNULL, stdout=log, stderr=log, start_new_session=True)
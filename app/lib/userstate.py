@@ -0,0 +1,116 @@
+# SPDX-FileCopyrightText: 2023 Citadel and contributors
+#
+# SPDX-License-Identifier: GPL-3.0-or-later
+
+# Access to db/user.json
+#
+# Reads are served from an in-memory copy, which is only read again if the file's inode, size or mtime changed.
+# Changes are made in a transaction: while holding an exclusive fcntl lock, the file is read,
+# all changes are applied, and the result is written to a temporary file that is fsync()ed and renamed over user.json.
+# This way, concurrent app-manager processes don't lose each other's changes, and a crash never leaves a half-written file.
+# The lock is taken on a separate file, because user.json itself is replaced on every write.
+
+import copy
+import fcntl
+import json
+import os
+import threading
+from contextlib import contextmanager
+from typing import Dict, Iterator
+
+from lib.registry import statKey
+
+class UserState:
+    def __init__(self, user_file: str):
+        self.userFile = user_file
+        self.lockFile = os.path.join(os.path.dirname(user_file), ".{}.flock".format(os.path.basename(user_file)))
+        self._key = None
+        self._data: dict = {}
+        # The app-manager changes the state from multiple threads when it handles multiple apps at once
+        self._threadLock = threading.Lock()
+
+    def _read(self) -> dict:
+        key = statKey(self.userFile)
+        if key is None:
+            self._key, self._data = None, {}
+        elif key != self._key:
+            with open(self.userFile, "r") as f:
+                self._data = json.load(f)
+            self._key = key
+        return self._data
+
+    # Get the current user data
+    # The result is a copy, changing it has no effect, use transaction() for that
+    def read(self) -> dict:
+        with self._threadLock:
+            return copy.deepcopy(self._read())
+
+    def _write(self, data: dict):
+        tmpFile = "{}.{}.tmp".format(self.userFile, os.getpid())
+        try:
+            with open(tmpFile, "w") as f:
+                # Keep the owner and permissions of the existing file, the API container reads and writes it too
+                try:
+                    st = os.stat(self.userFile)
+                    os.fchown(f.fileno(), st.st_uid, st.st_gid)
+                    os.fchmod(f.fileno(), st.st_mode & 0o7777)
+                except FileNotFoundError:
+                    pass
+                json.dump(data, f)
+                f.flush()
+                os.fsync(f.fileno())
+            os.replace(tmpFile, self.userFile)
+        except BaseException:
+            try:
+                os.remove(tmpFile)
+            except OSError:
+                pass
+            raise
+        # Make the rename itself durable
+        dirFd = os.open(os.path.dirname(self.userFile) or ".", os.O_RDONLY)
+        try:
+            os.fsync(dirFd)
+        finally:
+            os.close(dirFd)
+
+    # Change the user data, all changes made to the yielded dict are written at once when the block ends
+    # If the block raises an exception, nothing is written
+    @contextmanager
+    def transaction(self) -> Iterator[dict]:
+        with open(self.lockFile, "a") as lock:
+            fcntl.flock(lock.fileno(), fcntl.LOCK_EX)
+            try:
+                # Another process may have changed the file in the same mtime tick, so always read it again under the lock
+                with self._threadLock:
+                    self._key = None
+                data = self.read()
+                original = copy.deepcopy(data)
+                yield data
+                if data != original:
+                    self._write(data)
+            finally:
+                fcntl.flock(lock.fileno(), fcntl.LOCK_UN)
+
+    # Mark apps as installed
+    def install(self, *apps: str):
+        with self.transaction() as data:
+            installedApps = data.setdefault("installedApps", [])
+            for app in apps:
+                if app not in installedApps:
+                    installedApps.append(app)
+
+    # Mark apps as not installed anymore
+    def remove(self, *apps: str):
+        with self.transaction() as data:
+            if "installedApps" not in data:
+                return
+            data["installedApps"] = [app for app in data["installedApps"] if app not in apps]
+
+_states: Dict[str, UserState] = {}
+
+# Get the user state of a user.json file, there's one per file and process
+def getUserState(user_file: str) -> UserState:
+    key = os.path.realpath(user_file)
+    if key not in _states:
+        _states[key] = UserState(user_file)
+    return _states[key]
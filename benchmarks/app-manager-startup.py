@@ -0,0 +1,83 @@
+#!/usr/bin/env python3
+
+# SPDX-FileCopyrightText: 2023 Citadel and contributors
+#
+# SPDX-License-Identifier: GPL-3.0-or-later
+
+# Measures how long app-manager.py takes to answer the query actions (ls-installed, get-ip, get-implementation)
+# on a synthetic node, answering them itself and through the app-manager daemon.
+# For reference, it also measures loading lib.manage, which every action used to do.
+# app-manager.py has to run as root, so this has to as well.
+
+import argparse
+import json
+import os
+import shutil
+import socket
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+
+repoRoot = os.path.join(os.path.dirname(os.path.realpath(__file__)), "..")
+
+parser = argparse.ArgumentParser(description="Benchmark the startup time of app-manager.py queries")
+parser.add_argument('--runs', type=int, default=20)
+parser.add_argument('--apps', type=int, default=200, help='Number of apps in the synthetic registry')
+args = parser.parse_args()
+
+def buildNode(root: str):
+    shutil.copytree(os.path.join(repoRoot, "app"), os.path.join(root, "app"), ignore=shutil.ignore_patterns("__pycache__"))
+    for directory in ["apps", "db", "events"]:
+        os.makedirs(os.path.join(root, directory))
+    shutil.copy(os.path.join(repoRoot, "db", "dependencies.yml"), os.path.join(root, "db", "dependencies.yml"))
+    registry = [{"id": "app-{}".format(i), "hiddenServices": [], "description": "x" * 500} for i in range(args.apps)]
+    registry.append({"id": "lnd", "hiddenServices": []})
+    with open(os.path.join(root, "apps", "registry.json"), "w") as f:
+        json.dump(registry, f)
+    with open(os.path.join(root, "apps", "virtual-apps.json"), "w") as f:
+        json.dump({"lightning": ["lnd", "core-ln"]}, f)
+    with open(os.path.join(root, "db", "user.json"), "w") as f:
+        json.dump({"installedApps": ["lnd", "lightning"] + ["app-{}".format(i) for i in range(0, args.apps, 10)]}, f)
+    with open(os.path.join(root, ".env"), "w") as f:
+        for i in range(args.apps):
+            f.write("APP_APP_{}_SERVICE_IP=10.21.{}.{}\n".format(i, i // 250, i % 250))
+        f.write("APP_LND_SERVICE_IP=10.21.22.3\n")
+
+def timeRuns(command, cwd: str):
+    durations = []
+    for _ in range(args.runs):
+        start = time.perf_counter()
+        subprocess.run(command, cwd=cwd, stdout=subprocess.DEVNULL, check=True)
+        durations.append(time.perf_counter() - start)
+    return statistics.median(durations) * 1000
+
+with tempfile.TemporaryDirectory() as root:
+    buildNode(root)
+    manager = [sys.executable, os.path.join(root, "app", "app-manager.py")]
+    queries = [["ls-installed"], ["get-ip", "lightning"], ["get-implementation", "lightning"]]
+    # Warm up the catalog index and the page cache
+    subprocess.run(manager + ["--no-daemon", "ls-installed"], stdout=subprocess.DEVNULL, check=True)
+
+    print("{:32} {:>10}".format("python -c pass", "{:.1f}ms".format(timeRuns([sys.executable, "-c", "pass"], root))))
+    print("{:32} {:>10}".format("import lib.manage", "{:.1f}ms".format(
+        timeRuns([sys.executable, "-c", "import sys; sys.path.insert(0, 'app'); import lib.manage"], root))))
+    for query in queries:
+        print("{:32} {:>10}".format(" ".join(query) + " (in process)", "{:.1f}ms".format(timeRuns(manager + ["--no-daemon"] + query, root))))
+
+    daemon = subprocess.Popen(manager + ["serve"], stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    try:
+        socketPath = os.path.join(root, "events", "app-manager.socket")
+        for _ in range(100):
+            try:
+                with socket.socket(socket.AF_UNIX) as probe:
+                    probe.connect(socketPath)
+                break
+            except OSError:
+                time.sleep(0.05)
+        for query in queries:
+            print("{:32} {:>10}".format(" ".join(query) + " (daemon)", "{:.1f}ms".format(timeRuns(manager + query, root))))
+    finally:
+        daemon.terminate()
+        daemon.wait()
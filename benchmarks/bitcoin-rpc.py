@@ -0,0 +1,125 @@
+#!/usr/bin/env python3
+
+# SPDX-FileCopyrightText: 2023 Citadel and contributors
+#
+# SPDX-License-Identifier: GPL-3.0-or-later
+
+# Measures the Bitcoin RPC client against a stub JSON-RPC server that answers like bitcoind:
+# a new connection for every call, reused keep-alive connections, batch requests, and scripts/bitcoin-rpc
+# (the fast path of bin/bitcoin-cli) for a node whose .env points to the stub
+
+import argparse
+import base64
+import json
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+CITADEL_ROOT = os.path.realpath(os.path.join(os.path.dirname(os.path.realpath(__file__)), ".."))
+sys.path.insert(0, os.path.join(CITADEL_ROOT, "scripts"))
+
+from lib.bitcoinrpc import BitcoinRPC
+
+parser = argparse.ArgumentParser(description="Benchmark the Bitcoin RPC client")
+parser.add_argument('--calls', type=int, default=2000)
+parser.add_argument('--latency', type=float, default=0, help='Milliseconds the stub server takes to answer every request')
+args = parser.parse_args()
+
+user, password = "citadel", "benchmark"
+
+results = {
+    "getblockcount": 812345,
+    "getbestblockhash": "00000000000000000002a7c4c1e48d76c5a37902165a270156b7a8d72728a054",
+    "getmempoolinfo": {"loaded": True, "size": 5123, "bytes": 2345678, "total_fee": 0.51234567, "mempoolminfee": 0.00001000},
+    "getnetworkinfo": {"version": 250000, "subversion": "/Satoshi:25.0.0/", "connections": 10, "networks": [], "warnings": ""},
+}
+
+def answer(request: dict) -> dict:
+    if request["method"] not in results:
+        return {"result": None, "error": {"code": -32601, "message": "Method not found"}, "id": request["id"]}
+    return {"result": results[request["method"]], "error": None, "id": request["id"]}
+
+class StubHandler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+    # Like bitcoind, send responses right away instead of waiting for the ACK of the headers
+    disable_nagle_algorithm = True
+    connections = 0
+
+    def setup(self):
+        super().setup()
+        StubHandler.connections += 1
+
+    def do_POST(self):
+        body = self.rfile.read(int(self.headers["Content-Length"]))
+        if self.headers.get("Authorization") != "Basic " + base64.b64encode("{}:{}".format(user, password).encode()).decode():
+            self.send_response(401)
+            self.send_header("Content-Length", "0")
+            self.end_headers()
+            return
+        if args.latency:
+            time.sleep(args.latency / 1000)
+        request = json.loads(body)
+        response = [answer(entry) for entry in request] if isinstance(request, list) else answer(request)
+        status = 200 if isinstance(response, list) or response["error"] is None else 404
+        data = json.dumps(response).encode()
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def log_message(self, format, *args):
+        pass
+
+server = ThreadingHTTPServer(("127.0.0.1", 0), StubHandler)
+threading.Thread(target=server.serve_forever, daemon=True).start()
+port = server.server_address[1]
+methods = list(results)
+
+def measure(name: str, calls: int, run):
+    connections = StubHandler.connections
+    began = time.perf_counter()
+    run()
+    elapsed = time.perf_counter() - began
+    print("{:28} {:>9.1f}us per call, {} connections".format(name, elapsed / calls * 1e6, StubHandler.connections - connections))
+
+def fresh_connections():
+    rpc = BitcoinRPC("127.0.0.1", port, user, password)
+    for i in range(args.calls):
+        rpc.call(methods[i % len(methods)])
+        rpc.close()
+
+def keep_alive():
+    rpc = BitcoinRPC("127.0.0.1", port, user, password)
+    for i in range(args.calls):
+        rpc.call(methods[i % len(methods)])
+    rpc.close()
+
+def batches():
+    rpc = BitcoinRPC("127.0.0.1", port, user, password)
+    for _ in range(args.calls // len(methods)):
+        rpc.batch([(method, []) for method in methods])
+    rpc.close()
+
+measure("new connection per call", args.calls, fresh_connections)
+measure("keep-alive", args.calls, keep_alive)
+measure("batches of {}".format(len(methods)), args.calls // len(methods) * len(methods), batches)
+
+with tempfile.TemporaryDirectory() as node_root:
+    os.makedirs(os.path.join(node_root, "scripts"))
+    os.symlink(os.path.join(CITADEL_ROOT, "scripts", "lib"), os.path.join(node_root, "scripts", "lib"))
+    shutil.copy(os.path.join(CITADEL_ROOT, "scripts", "bitcoin-rpc"), os.path.join(node_root, "scripts", "bitcoin-rpc"))
+    with open(os.path.join(node_root, ".env"), "w") as f:
+        f.write('BITCOIN_IP=127.0.0.1\nBITCOIN_RPC_PORT="{}"\nBITCOIN_RPC_USER={}\nBITCOIN_RPC_PASS={}\n'.format(port, user, password))
+    runs = 20
+    def cli():
+        for _ in range(runs):
+            subprocess.run([os.path.join(node_root, "scripts", "bitcoin-rpc"), "getmempoolinfo"], check=True, stdout=subprocess.DEVNULL)
+    measure("scripts/bitcoin-rpc", runs, cli)
+
+server.shutdown()
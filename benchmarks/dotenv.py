@@ -0,0 +1,54 @@
+#!/usr/bin/env python3
+
+# SPDX-FileCopyrightText: 2023 Citadel and contributors
+#
+# SPDX-License-Identifier: GPL-3.0-or-later
+
+# Compares looking up variables by parsing .env on every call (the old get_var_safe)
+# with the cached store in app/lib/envstore.py, for growing .env files
+
+import argparse
+import os
+import sys
+import tempfile
+import timeit
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.realpath(__file__)), "..", "app"))
+
+from lib.citadelutils import parse_dotenv
+from lib.envstore import EnvStore
+
+parser = argparse.ArgumentParser(description="Benchmark .env lookups")
+parser.add_argument('--sizes', type=int, nargs='+', default=[10, 100, 500, 1000, 5000])
+parser.add_argument('--lookups', type=int, default=50, help='Lookups per round, similar to one compose() call')
+parser.add_argument('--rounds', type=int, default=20)
+args = parser.parse_args()
+
+def write_env(path: str, size: int):
+    with open(path, "w") as f:
+        f.write("# Synthetic .env\n")
+        for i in range(size):
+            f.write("APP_BENCH_{}_SERVICE_IP=10.21.22.{}\n".format(i, i % 255))
+
+print("{:>8} {:>16} {:>16} {:>16} {:>10}".format("entries", "parse/lookup", "store.get", "store.get_many", "speedup"))
+with tempfile.TemporaryDirectory() as tmp:
+    for size in args.sizes:
+        envFile = os.path.join(tmp, "{}.env".format(size))
+        write_env(envFile, size)
+        names = ["APP_BENCH_{}_SERVICE_IP".format(i * size // args.lookups) for i in range(args.lookups)]
+        store = EnvStore(envFile)
+
+        def uncached():
+            for name in names:
+                parse_dotenv(envFile).get(name)
+
+        def cached():
+            for name in names:
+                store.get(name)
+
+        def batched():
+            store.get_many(names)
+
+        results = [min(timeit.repeat(fn, number=1, repeat=args.rounds)) / args.lookups for fn in (uncached, cached, batched)]
+        print("{:>8} {:>14.2f}us {:>14.2f}us {:>14.2f}us {:>9.0f}x".format(
+            size, results[0] * 1e6, results[1] * 1e6, results[2] * 1e6, results[0] / results[1]))
@@ -0,0 +1,41 @@
+#!/usr/bin/env python3
+
+# SPDX-FileCopyrightText: 2023 Citadel and contributors
+#
+# SPDX-License-Identifier: GPL-3.0-or-later
+
+# Measures appending samples to the metric history and querying it, for a synthetic node with many apps,
+# and how much disk space the history takes
+
+import argparse
+import os
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.realpath(__file__)), "..", "scripts"))
+
+from lib.history import MetricHistory, series_name
+
+parser = argparse.ArgumentParser(description="Benchmark the metric history")
+parser.add_argument('--apps', type=int, default=30)
+parser.add_argument('--samples', type=int, default=5000, help='Samples per series, one every 60 seconds')
+args = parser.parse_args()
+
+with tempfile.TemporaryDirectory() as directory:
+    history = MetricHistory(directory)
+    names = [series_name("storage", "used")] + [series_name("storage", "app", "app-{}".format(i)) for i in range(args.apps)]
+    start = time.time() - args.samples * 60
+    began = time.perf_counter()
+    for i in range(args.samples):
+        history.append({name: i * 1000 for name in names}, start + i * 60)
+    elapsed = time.perf_counter() - began
+    print("append:  {:.1f}us per sample ({} series, {} samples each)".format(elapsed / (args.samples * len(names)) * 1e6, len(names), args.samples))
+    began = time.perf_counter()
+    for name in names:
+        history.query(name, time.time() - 7 * 86400)
+    print("query:   {:.2f}ms per series (last 7 days)".format((time.perf_counter() - began) / len(names) * 1000))
+    used = sum(os.stat(os.path.join(directory, entry)).st_blocks * 512 for entry in os.listdir(directory))
+    size = sum(os.path.getsize(os.path.join(directory, entry)) for entry in os.listdir(directory))
+    print("disk:    {:.1f} MiB used of {:.1f} MiB reserved".format(used / 2**20, size / 2**20))
+    history.close()
@@ -0,0 +1,144 @@
+#!/usr/bin/env python3
+
+# SPDX-FileCopyrightText: 2023 Citadel and contributors
+#
+# SPDX-License-Identifier: GPL-3.0-or-later
+
+# Compares the ways to get a new release with scripts/lib/ota.py: the release's tarball, the manifest and objects
+# of a mirror, and a local directory, against a stub HTTP server that supports range requests and can drop
+# every connection after some bytes, like a flaky Tor link.
+# The node is a copy of this checkout, the release changes some of its files and adds a large one.
+# Every run stages the release, applies it, and checks that the node then matches the release.
+
+import argparse
+import hashlib
+import os
+import random
+import shutil
+import sys
+import tarfile
+import tempfile
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+CITADEL_ROOT = os.path.realpath(os.path.join(os.path.dirname(os.path.realpath(__file__)), ".."))
+sys.path.insert(0, os.path.join(CITADEL_ROOT, "scripts"))
+
+from lib.ota import (DirSource, HTTPSource, ObjectStore, TarballSource, UpdateStatus, apply_staged, plan_update, stage_release,
+                     store_dir_name, write_mirror)
+
+parser = argparse.ArgumentParser(description="Benchmark delta updates")
+parser.add_argument('--changed', type=int, default=20, help='Number of files the release changes')
+parser.add_argument('--large-file', type=int, default=8, help='Size of the file the release adds, in MiB')
+parser.add_argument('--drop-after', type=int, default=256 * 1024, help='Drop every connection after this many bytes (0 to never drop)')
+parser.add_argument('--latency', type=float, default=0, help='Milliseconds before every response')
+args = parser.parse_args()
+
+release = "bench"
+
+class StubHandler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+    disable_nagle_algorithm = True
+    root = ""
+    sent = 0
+    requests = 0
+
+    def do_GET(self):
+        StubHandler.requests += 1
+        if args.latency:
+            time.sleep(args.latency / 1000)
+        path = os.path.join(self.root, self.path.lstrip("/"))
+        if not os.path.isfile(path):
+            self.send_error(404)
+            return
+        size = os.path.getsize(path)
+        etag = '"{}"'.format(hashlib.sha256(self.path.encode() + str(size).encode()).hexdigest()[:16])
+        start = 0
+        requested = self.headers.get("Range")
+        if requested and self.headers.get("If-Range", etag) == etag:
+            start = int(requested.split("=")[1].split("-")[0])
+            if start >= size:
+                self.send_error(416)
+                return
+            self.send_response(206)
+            self.send_header("Content-Range", "bytes {}-{}/{}".format(start, size - 1, size))
+        else:
+            self.send_response(200)
+        self.send_header("Content-Length", str(size - start))
+        self.send_header("ETag", etag)
+        self.end_headers()
+        with open(path, "rb") as f:
+            f.seek(start)
+            data = f.read()
+        if args.drop_after and len(data) > args.drop_after:
+            data = data[:args.drop_after]
+            self.close_connection = True
+        self.wfile.write(data)
+        StubHandler.sent += len(data)
+
+    def log_message(self, format, *args):
+        pass
+
+def copy_checkout(destination: str):
+    shutil.copytree(CITADEL_ROOT, destination, symlinks=True, ignore=shutil.ignore_patterns(".git", "__pycache__"))
+
+def make_release(node: str, destination: str):
+    shutil.copytree(node, destination, symlinks=True)
+    candidates = sorted(os.path.join(dirpath, name) for dirpath, _, names in os.walk(os.path.join(destination, "scripts")) for name in names)
+    for path in random.Random(1).sample(candidates, min(args.changed, len(candidates))):
+        with open(path, "a") as f:
+            f.write("\n# {}\n".format(release))
+    with open(os.path.join(destination, "templates", "large-file"), "wb") as f:
+        f.write(random.Random(2).randbytes(args.large_file * 1024 * 1024))
+
+def make_tarball(tree: str, path: str):
+    with tarfile.open(path, "w:gz") as tar:
+        tar.add(tree, arcname="core-{}".format(release))
+
+def run(name: str, node: str, source):
+    sent, requests = StubHandler.sent, StubHandler.requests
+    os.makedirs(os.path.join(node, "statuses"), exist_ok=True)
+    status = UpdateStatus(os.path.join(node, "statuses", "update-status.json"), release)
+    began = time.perf_counter()
+    result = stage_release(node, release, source, os.path.join(node, ".citadel-" + release), status)
+    staged = time.perf_counter() - began
+    applied = apply_staged(node, os.path.join(node, ".citadel-" + release))
+    elapsed = time.perf_counter() - began
+    remaining = plan_update(result.plan.manifest, node)
+    assert not (remaining.changed or remaining.chmod or remaining.links or remaining.removed), remaining
+    print("{:10} {:>7.2f}s (staging {:.2f}s), {:>8.1f} KiB served in {:>4} requests, {} objects, replaced {} files".format(
+        name, elapsed, staged, (StubHandler.sent - sent) / 1024, StubHandler.requests - requests, result.downloaded_files, applied.replaced))
+
+with tempfile.TemporaryDirectory() as tmp:
+    original = os.path.join(tmp, "node")
+    copy_checkout(original)
+    release_tree = os.path.join(tmp, "release")
+    make_release(original, release_tree)
+    served = os.path.join(tmp, "served")
+    write_mirror(release_tree, release, os.path.join(served, release))
+    make_tarball(release_tree, os.path.join(served, "{}.tar.gz".format(release)))
+    StubHandler.root = served
+
+    server = ThreadingHTTPServer(("127.0.0.1", 0), StubHandler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    url = "http://127.0.0.1:{}".format(server.server_address[1])
+    print("Release changes {} files and adds {} MiB, tarball is {:.1f} KiB, connections dropped after {} KiB".format(
+        args.changed, args.large_file, os.path.getsize(os.path.join(served, "{}.tar.gz".format(release))) / 1024, args.drop_after // 1024))
+
+    def fresh_node(name: str) -> str:
+        node = os.path.join(tmp, name)
+        shutil.copytree(original, node, symlinks=True)
+        return node
+
+    node = fresh_node("tarball")
+    run("tarball", node, TarballSource("{}/{}.tar.gz".format(url, release), os.path.join(node, store_dir_name)))
+    run("mirror", fresh_node("mirror"), HTTPSource("{}/{}".format(url, release)))
+    run("directory", fresh_node("directory"), DirSource(release_tree))
+    # An update after a failed attempt, which already got all objects
+    node = fresh_node("stored")
+    source = HTTPSource("{}/{}".format(url, release))
+    store = ObjectStore(os.path.join(node, store_dir_name, "objects"))
+    source.fetch(plan_update(source.manifest(release), node).missing_objects(store), store, lambda size, files: None)
+    run("stored", node, source)
+    server.shutdown()
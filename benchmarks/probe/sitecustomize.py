@@ -0,0 +1,41 @@
+# SPDX-FileCopyrightText: 2023 Citadel and contributors
+#
+# SPDX-License-Identifier: GPL-3.0-or-later
+
+# Loaded into every Python process started by benchmarks/suite.py (it puts this directory on PYTHONPATH)
+#
+# Counts the files opened for reading and the processes spawned with audit hooks,
+# and writes the counts to $BENCH_PROBE_DIR/<pid>.json when the process exits.
+
+import os
+
+if os.environ.get("BENCH_PROBE_DIR"):
+    import atexit
+    import json
+    import sys
+
+    _counts = {"fileReads": 0, "fileWrites": 0, "spawns": 0}
+    # subprocess.Popen may use os.posix_spawn internally, which would count twice, so that isn't counted
+    _spawnEvents = {"subprocess.Popen", "os.system", "os.fork", "os.forkpty"}
+
+    def _hook(event, args):
+        if event == "open":
+            mode = args[1] if len(args) > 1 else None
+            flags = args[2] if len(args) > 2 else 0
+            if isinstance(mode, str):
+                writing = any(char in mode for char in "wax+")
+            else:
+                writing = bool((flags or 0) & (os.O_WRONLY | os.O_RDWR))
+            _counts["fileWrites" if writing else "fileReads"] += 1
+        elif event in _spawnEvents:
+            _counts["spawns"] += 1
+
+    def _dump():
+        try:
+            with open(os.path.join(os.environ["BENCH_PROBE_DIR"], "{}.json".format(os.getpid())), "w") as f:
+                json.dump(_counts, f)
+        except OSError:
+            pass
+
+    sys.addaudithook(_hook)
+    atexit.register(_dump)
@@ -0,0 +1,64 @@
+#!/usr/bin/env python3
+
+# SPDX-FileCopyrightText: 2023 Citadel and contributors
+#
+# SPDX-License-Identifier: GPL-3.0-or-later
+
+# Compares provisioning a synthetic app template with shutil.copytree followed by "chown -R"
+# (what createDataDir used to do) with provisionDir
+
+import argparse
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.realpath(__file__)), "..", "app"))
+
+from lib.provision import provisionDir
+
+parser = argparse.ArgumentParser(description="Benchmark app data provisioning")
+parser.add_argument('--files', type=int, default=20000, help='Number of files in the synthetic template')
+parser.add_argument('--files-per-dir', type=int, default=50)
+parser.add_argument('--large-files', type=int, default=4, help='Number of 64 MiB files in the template')
+parser.add_argument('--jobs', '-j', type=int, default=None)
+args = parser.parse_args()
+
+def build_template(root: str):
+    dirs = max(1, args.files // args.files_per_dir)
+    for i in range(dirs):
+        directory = os.path.join(root, "d{}".format(i // 10), "d{}".format(i))
+        os.makedirs(directory, exist_ok=True)
+        for j in range(args.files_per_dir):
+            with open(os.path.join(directory, "f{}".format(j)), "wb") as f:
+                f.write(b"x" * ((i + j) % 4096))
+        open(os.path.join(directory, ".gitkeep"), "w").close()
+    for i in range(args.large_files):
+        with open(os.path.join(root, "large-{}".format(i)), "wb") as f:
+            f.write(os.urandom(1024 * 1024) * 64)
+
+def timed(fn):
+    start = time.perf_counter()
+    fn()
+    return time.perf_counter() - start
+
+def copytree(src: str, dst: str):
+    shutil.copytree(src, dst, symlinks=False, ignore=shutil.ignore_patterns(".gitkeep"))
+    subprocess.check_call(["chown", "-R", "1000:1000", dst])
+
+with tempfile.TemporaryDirectory(dir=os.environ.get("TMPDIR", "/var/tmp")) as tmp:
+    template = os.path.join(tmp, "template")
+    print("Building a template with {} files and {} large files...".format(args.files, args.large_files))
+    build_template(template)
+    os.sync()
+
+    print("copytree + chown -R: {:8.3f}s".format(timed(lambda: copytree(template, os.path.join(tmp, "copytree")))))
+    print("provisionDir:        {:8.3f}s".format(timed(lambda: provisionDir(template, os.path.join(tmp, "provisioned"), 1000, 1000, args.jobs))))
+    # Provisioning again replaces the existing copy
+    print("provisionDir again:  {:8.3f}s".format(timed(lambda: provisionDir(template, os.path.join(tmp, "provisioned"), 1000, 1000, args.jobs))))
+
+    diff = subprocess.run(["diff", "-r", os.path.join(tmp, "copytree"), os.path.join(tmp, "provisioned")], stdout=subprocess.DEVNULL)
+    if diff.returncode != 0:
+        print("Warning: the copies differ")
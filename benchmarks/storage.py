@@ -0,0 +1,62 @@
+#!/usr/bin/env python3
+
+# SPDX-FileCopyrightText: 2023 Citadel and contributors
+#
+# SPDX-License-Identifier: GPL-3.0-or-later
+
+# Compares a cold scan of a synthetic app-data tree with a warm rescan using the storage cache,
+# and with "du" if it is available
+
+import argparse
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.realpath(__file__)), "..", "scripts"))
+
+from lib.storage import StorageAccountant
+
+parser = argparse.ArgumentParser(description="Benchmark app storage accounting")
+parser.add_argument('--files', type=int, default=100000, help='Number of files in the synthetic tree')
+parser.add_argument('--files-per-dir', type=int, default=100)
+parser.add_argument('--apps', type=int, default=4)
+args = parser.parse_args()
+
+def build_tree(root: str):
+    dirs = max(1, args.files // args.files_per_dir)
+    for i in range(dirs):
+        directory = os.path.join(root, "app-{}".format(i % args.apps), "data", "d{}".format(i // 10), "d{}".format(i))
+        os.makedirs(directory, exist_ok=True)
+        for j in range(args.files_per_dir):
+            with open(os.path.join(directory, "f{}".format(j)), "wb") as f:
+                f.write(b"x" * ((i + j) % 4096))
+
+def timed(fn):
+    start = time.perf_counter()
+    result = fn()
+    return result, time.perf_counter() - start
+
+with tempfile.TemporaryDirectory() as tmp:
+    print("Building a tree with {} files...".format(args.files))
+    build_tree(tmp)
+    apps = [os.path.join(tmp, "app-{}".format(i)) for i in range(args.apps)]
+    cache_file = os.path.join(tmp, "storage-cache")
+
+    cold = StorageAccountant(cache_file)
+    sizes, cold_time = timed(lambda: cold.scan(apps))
+    cold.save()
+    print("cold scan:   {:8.3f}s  ({} dirs listed)".format(cold_time, cold.dirs_listed))
+
+    # A new accountant, so the cache is loaded from disk like in a new status run
+    warm = StorageAccountant(cache_file)
+    warm_sizes, warm_time = timed(lambda: warm.scan(apps))
+    print("warm rescan: {:8.3f}s  ({} dirs listed, {} reused)".format(warm_time, warm.dirs_listed, warm.dirs_reused))
+    if warm_sizes != sizes:
+        print("Warning: warm rescan returned different sizes")
+
+    if shutil.which("du"):
+        _, du_time = timed(lambda: subprocess.check_output(["du", "--block-size=1", "--max-depth=0"] + apps))
+        print("du:          {:8.3f}s".format(du_time))
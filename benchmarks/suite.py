@@ -0,0 +1,265 @@
+#!/usr/bin/env python3
+
+# SPDX-FileCopyrightText: 2023 Citadel and contributors
+#
+# SPDX-License-Identifier: GPL-3.0-or-later
+
+# Benchmarks the hot paths of a node on a synthetic node root:
+# app-manager.py actions, "scripts/app start installed", the memory and storage status scripts and scripts/configure
+#
+# The node root is built from a checkout (this one by default), with a configurable number of apps, registry size,
+# .env size and files in every app's data dir. docker is replaced by benchmarks/fake-docker, which records its calls
+# and can simulate latency. Every operation is run a few times after a warmup, and the results are written as JSON,
+# so the results of two checkouts can be compared with --compare:
+#
+#   benchmarks/suite.py --output before.json --checkout /path/to/old/checkout
+#   benchmarks/suite.py --output after.json
+#   benchmarks/suite.py --compare before.json after.json
+#
+# Per operation, this reports the wall time, CPU time, processes forked (from /proc/stat, so this counts everything
+# running on the machine, run it on an otherwise idle one), processes spawned and files read by Python processes,
+# docker calls and, if strace is installed, the number of syscalls.
+# app-manager.py and scripts/configure have to run as root, so this has to as well.
+
+import argparse
+import json
+import os
+import platform
+import shutil
+import statistics
+import subprocess
+import tempfile
+import time
+from typing import Dict, List, Optional
+
+benchmarkDir = os.path.dirname(os.path.realpath(__file__))
+repoRoot = os.path.realpath(os.path.join(benchmarkDir, ".."))
+
+# Bump this if the layout of the results changes
+resultsVersion = 1
+
+parser = argparse.ArgumentParser(description="Benchmark app lifecycle, status collection and configure on a synthetic node")
+parser.add_argument('--checkout', default=repoRoot, help='The Citadel checkout to benchmark (Default: this one)')
+parser.add_argument('--apps', type=int, default=20, help='Number of installed apps')
+parser.add_argument('--registry-size', type=int, default=200, help='Number of apps in the registry')
+parser.add_argument('--env-size', type=int, default=500, help='Number of extra variables in .env')
+parser.add_argument('--data-files', type=int, default=1000, help='Number of files in the data dir of every installed app')
+parser.add_argument('--docker-latency', type=float, default=0.05, help='Seconds every docker call takes')
+parser.add_argument('--runs', type=int, default=5)
+parser.add_argument('--only', nargs='+', help='Only run these operations')
+parser.add_argument('--keep', metavar='DIR', help='Build the synthetic node in this directory and keep it, to look into failures')
+parser.add_argument('--output', '-o', help='Write the results to this file')
+parser.add_argument('--compare', nargs=2, metavar=('BASE', 'NEW'), help='Compare two results files instead of running the benchmarks')
+args = parser.parse_args()
+
+# Name -> command, relative to the node root
+operations = {
+    "app-manager ls-installed": ["app/app-manager.py", "ls-installed"],
+    "app-manager get-ip": ["app/app-manager.py", "get-ip", "lightning"],
+    "app-manager get-implementation": ["app/app-manager.py", "get-implementation", "lightning"],
+    "app-manager compose ps": ["app/app-manager.py", "compose", "app-0", "ps"],
+    "app-manager start": ["app/app-manager.py", "start", "app-0"],
+    "app-manager install": ["app/app-manager.py", "install", "bench-target"],
+    "scripts/app start installed": ["scripts/app", "start", "installed"],
+    "status memory": ["scripts/status/memory"],
+    "status storage": ["scripts/status/storage"],
+    "configure": ["scripts/configure"],
+}
+
+# Metrics where lower is better, in the order they are printed
+metrics = ["wallMs", "cpuMs", "forks", "pythonSpawns", "dockerCalls", "fileReads", "syscalls"]
+
+def writeFile(path: str, content: str):
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    with open(path, "w") as f:
+        f.write(content)
+
+def composeFile(app: str) -> str:
+    return "version: '3.8'\nservices:\n  web:\n    image: bench/{}:v1.0.0\n    restart: on-failure\n    environment:\n      APP_PORT: 3000\n".format(app)
+
+def buildNode(root: str):
+    shutil.copytree(args.checkout, root, symlinks=True, dirs_exist_ok=True, ignore=shutil.ignore_patterns(
+        ".git", "__pycache__", "benchmarks", "app-data", "logs", "statuses", "events", "requests.jsonl"))
+    for directory in ["app-data", "logs", "statuses", "events", os.path.join("events", "signals"), os.path.join("tor", "data")]:
+        os.makedirs(os.path.join(root, directory), exist_ok=True)
+    registryApps = ["app-{}".format(i) for i in range(max(args.registry_size, args.apps))] + ["bench-target"]
+    installed = registryApps[:args.apps]
+    registry = [{"id": app, "name": app, "version": "1.0.0", "hiddenServices": ["app-{}".format(app)],
+                 "description": "A synthetic app. " * 20} for app in registryApps]
+    registry.append({"id": "lnd", "name": "LND", "version": "1.0.0", "hiddenServices": []})
+    writeFile(os.path.join(root, "apps", "registry.json"), json.dumps(registry))
+    writeFile(os.path.join(root, "apps", "virtual-apps.json"), json.dumps({"lightning": ["lnd", "core-ln"]}))
+    for app in installed + ["bench-target", "lnd"]:
+        writeFile(os.path.join(root, "apps", app, "docker-compose.yml"), composeFile(app))
+        writeFile(os.path.join(root, "apps", app, "app.yml"), "version: 1\n")
+        writeFile(os.path.join(root, "apps", app, "data", ".gitkeep"), "")
+        writeFile(os.path.join(root, "tor", "data", "app-{}".format(app), "hostname"), "{}.onion\n".format(app))
+    writeFile(os.path.join(root, "db", "user.json"), json.dumps({"installedApps": installed + ["lnd", "lightning"]}))
+    env = ["APP_{}_SERVICE_IP=10.21.{}.{}".format(app.upper().replace("-", "_"), i // 250, i % 250 + 2)
+           for i, app in enumerate(registryApps + ["lnd"])]
+    # scripts/configure needs these for the lightning implementation
+    env += ["APP_LND_MIDDLEWARE_IP=10.21.22.4", "APP_LND_MIDDLEWARE_IP6=fd00:21::4"]
+    env += ["BENCH_VARIABLE_{}=value-{}".format(i, i) for i in range(args.env_size)]
+    writeFile(os.path.join(root, ".env"), "\n".join(env) + "\n")
+    # scripts/configure renders .env from its template, the fake app-cli adds these back, like the real one adds the apps' variables
+    writeFile(os.path.join(root, ".bench", "app-env"), "\n".join(env) + "\n")
+    for app in installed + ["lnd"]:
+        for i in range(args.data_files):
+            writeFile(os.path.join(root, "app-data", app, "d{}".format(i // 100), "f{}".format(i)), "x" * (i % 512))
+    # Fake docker
+    binDir = os.path.join(root, ".bench", "bin")
+    os.makedirs(binDir, exist_ok=True)
+    shutil.copy(os.path.join(benchmarkDir, "fake-docker"), os.path.join(binDir, "docker"))
+    writeFile(os.path.join(root, ".bench", "docker-ps"), "".join(
+        "{:064x}\t{}_web_1\t{}\n".format(i, app, app) for i, app in enumerate(installed + ["lnd"])))
+    writeFile(os.path.join(root, ".bench", "docker-images"), "".join(
+        "bench/{} v1.0.0 <none>\n".format(app) for app in installed + ["bench-target", "lnd"]))
+
+def dependencyVersion(root: str, name: str) -> str:
+    import yaml
+    with open(os.path.join(root, "db", "dependencies.yml")) as f:
+        return str(yaml.safe_load(f).get(name, ""))
+
+def processesForked() -> int:
+    with open("/proc/stat") as f:
+        for line in f:
+            if line.startswith("processes "):
+                return int(line.split()[1])
+    return 0
+
+# Run a command once, returns its exit code and metrics
+def runOnce(command: List[str], root: str, env: Dict[str, str]) -> dict:
+    probeDir = env["BENCH_PROBE_DIR"]
+    for entry in os.listdir(probeDir):
+        os.remove(os.path.join(probeDir, entry))
+    open(env["BENCH_DOCKER_LOG"], "w").close()
+    forksBefore = processesForked()
+    start = time.perf_counter()
+    process = subprocess.Popen(command, cwd=root, env=env, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    _, status, usage = os.wait4(process.pid, 0)
+    wall = time.perf_counter() - start
+    forks = processesForked() - forksBefore
+    probes = []
+    for entry in os.listdir(probeDir):
+        try:
+            with open(os.path.join(probeDir, entry)) as f:
+                probes.append(json.load(f))
+        except (OSError, ValueError):
+            pass
+    with open(env["BENCH_DOCKER_LOG"]) as f:
+        dockerCalls = sum(1 for _ in f)
+    return {
+        "exitCode": os.waitstatus_to_exitcode(status),
+        "wallMs": wall * 1000,
+        # Only includes children that were waited for, background processes like the reaper aren't counted
+        "cpuMs": (usage.ru_utime + usage.ru_stime) * 1000,
+        "forks": forks,
+        "pythonSpawns": sum(probe["spawns"] for probe in probes),
+        "dockerCalls": dockerCalls,
+        "fileReads": sum(probe["fileReads"] for probe in probes),
+    }
+
+# Count the syscalls of one run with strace, if it is installed
+def countSyscalls(command: List[str], root: str, env: Dict[str, str]) -> Optional[int]:
+    if not shutil.which("strace"):
+        return None
+    with tempfile.NamedTemporaryFile() as output:
+        subprocess.run(["strace", "-f", "-c", "-o", output.name] + command, cwd=root, env=env,
+                       stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+        for line in output.read().decode("utf-8").splitlines():
+            fields = line.split()
+            if fields and fields[-1] == "total":
+                # % time, seconds, usecs/call, calls, (errors), total
+                return int(fields[3])
+    return None
+
+def benchmark(root: str) -> Dict[str, dict]:
+    env = os.environ.copy()
+    env.update({
+        "PATH": os.path.join(root, ".bench", "bin") + os.pathsep + env.get("PATH", ""),
+        "PYTHONPATH": os.path.join(benchmarkDir, "probe"),
+        "BENCH_PROBE_DIR": os.path.join(root, ".bench", "probes"),
+        "BENCH_DOCKER_LOG": os.path.join(root, ".bench", "docker-calls"),
+        "BENCH_DOCKER_LATENCY": str(args.docker_latency),
+        "BENCH_DOCKER_PS": os.path.join(root, ".bench", "docker-ps"),
+        "BENCH_DOCKER_IMAGES": os.path.join(root, ".bench", "docker-images"),
+        "BENCH_COMPOSE_VERSION": dependencyVersion(root, "compose"),
+        "BENCH_APP_ENV": os.path.join(root, ".bench", "app-env"),
+        "BENCH_NODE_ROOT": root,
+        "NETWORK": "regtest",
+    })
+    os.makedirs(env["BENCH_PROBE_DIR"])
+    results = {}
+    for name, command in operations.items():
+        if args.only and name not in args.only:
+            continue
+        command = [os.path.join(root, command[0])] + command[1:]
+        # The first run fills caches (and configures the node, so the measured runs reconfigure it like every boot does),
+        # it isn't measured
+        runOnce(command, root, env)
+        runs = [runOnce(command, root, env) for _ in range(args.runs)]
+        result = {"runs": args.runs, "exitCode": next((run["exitCode"] for run in runs if run["exitCode"]), 0),
+                  "wallMsMin": min(run["wallMs"] for run in runs)}
+        for metric in metrics[:-1]:
+            result[metric] = statistics.median(run[metric] for run in runs)
+        result["syscalls"] = countSyscalls(command, root, env)
+        results[name] = result
+        print("{:32} {:>10} {:>10} {:>6g} {:>6g} {:>6g} {:>8g}{}".format(
+            name, "{:.1f}ms".format(result["wallMs"]), "{:.1f}ms".format(result["cpuMs"]), result["forks"],
+            result["pythonSpawns"], result["dockerCalls"], result["fileReads"],
+            "" if result["exitCode"] == 0 else "  (exit code {})".format(result["exitCode"])), flush=True)
+    return results
+
+def gitCommit(path: str) -> Optional[str]:
+    try:
+        return subprocess.check_output(["git", "-C", path, "rev-parse", "HEAD"], stderr=subprocess.DEVNULL).decode("utf-8").strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+def compare(baseFile: str, newFile: str):
+    with open(baseFile) as f:
+        base = json.load(f)
+    with open(newFile) as f:
+        new = json.load(f)
+    if base.get("parameters") != new.get("parameters"):
+        print("Warning: The results were measured with different parameters")
+    print("{:32} {:16} {:>12} {:>12} {:>8}".format("operation", "metric", "base", "new", "change"))
+    for name, result in new["operations"].items():
+        if name not in base["operations"]:
+            continue
+        for metric in metrics:
+            before, after = base["operations"][name].get(metric), result.get(metric)
+            if before is None or after is None:
+                continue
+            change = "" if not before else "{:+.0f}%".format((after - before) / before * 100)
+            print("{:32} {:16} {:>12.1f} {:>12.1f} {:>8}".format(name, metric, before, after, change))
+
+if args.compare:
+    compare(*args.compare)
+    exit(0)
+
+if os.getuid() != 0:
+    print("This benchmark must be run as root!")
+    exit(1)
+
+with tempfile.TemporaryDirectory() as tmp:
+    root = os.path.realpath(args.keep) if args.keep else os.path.join(tmp, "citadel")
+    buildNode(root)
+    print("{:32} {:>10} {:>10} {:>6} {:>6} {:>6} {:>8}".format("operation", "wall", "cpu", "forks", "spawns", "docker", "reads"))
+    results = benchmark(root)
+
+report = {
+    "version": resultsVersion,
+    "checkout": os.path.realpath(args.checkout),
+    "commit": gitCommit(args.checkout),
+    "python": platform.python_version(),
+    "machine": platform.machine(),
+    "date": time.strftime("%Y-%m-%dT%H:%M:%SZ", time.gmtime()),
+    "parameters": {"apps": args.apps, "registrySize": args.registry_size, "envSize": args.env_size,
+                   "dataFiles": args.data_files, "dockerLatency": args.docker_latency, "runs": args.runs},
+    "operations": results,
+}
+if args.output:
+    with open(args.output, "w") as f:
+        json.dump(report, f, indent=2)
+    print("Results written to {}".format(args.output))
@@ -32,6 +32,7 @@ Commands:
     configure <service>                Edit service & app configuration files
     logs [service]                     Show logs for an app or service
     debug [options]                    View logs for troubleshooting
+    trace [on|off] [options]           Show the slowest phases of recent operations
 EOF
 }
 
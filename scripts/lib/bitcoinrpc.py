@@ -0,0 +1,264 @@
+# SPDX-FileCopyrightText: 2023 Citadel and contributors
+#
+# SPDX-License-Identifier: GPL-3.0-or-later
+
+# A JSON-RPC client for the node's Bitcoin Core
+#
+# Calls go straight to bitcoind's RPC port instead of through "docker compose exec", which starts an exec session and
+# parses the whole compose project for every call.
+# Connections are kept alive and reused, and several calls can be sent as one JSON-RPC batch request.
+
+import base64
+import http.client
+import json
+import os
+import queue
+import socket
+from decimal import Decimal
+from typing import Any, Callable, Dict, List, Optional, Sequence, Tuple, Union
+
+# How long to wait for a connection, bitcoind is on a local docker network, so this only fails if it isn't running
+default_connect_timeout = 3
+# How long to wait for a response, some calls (like gettxoutsetinfo) can take many minutes, like bitcoin-cli's default
+default_timeout = 900
+default_pool_size = 4
+
+class RPCError(Exception):
+    def __init__(self, code: int, message: str):
+        super().__init__("{} (code {})".format(message, code))
+        self.code = code
+        self.message = message
+
+# The RPC server couldn't be reached, or didn't accept the credentials
+class ConnectionFailed(Exception):
+    pass
+
+# Errors of a connection that was closed by bitcoind while it was idle in the pool, the request can be sent again
+stale_connection_errors = (http.client.RemoteDisconnected, http.client.CannotSendRequest, BrokenPipeError, ConnectionResetError)
+
+# Keeps numbers as the exact text bitcoind sent (like "0.00000000" for amounts), used to print results like bitcoin-cli
+class RawNumber(str):
+    pass
+
+# Read BITCOIN_* from the node's .env, which configure wrote
+def read_rpc_env(node_root: str) -> Dict[str, str]:
+    env: Dict[str, str] = {}
+    with open(os.path.join(node_root, ".env"), "r") as f:
+        for line in f:
+            line = line.strip()
+            if not line.startswith("BITCOIN_") or "=" not in line:
+                continue
+            key, value = line.split("=", 1)
+            env[key] = value.strip('"').strip("'")
+    return env
+
+class BitcoinRPC:
+    def __init__(self, host: str, port: int, user: str, password: str, timeout: float = default_timeout,
+                 connect_timeout: float = default_connect_timeout, pool_size: int = default_pool_size,
+                 parse_float: Callable[[str], Any] = Decimal, parse_int: Optional[Callable[[str], Any]] = None):
+        self.host = host
+        self.port = port
+        self.timeout = timeout
+        self.connect_timeout = connect_timeout
+        self.parse_float = parse_float
+        self.parse_int = parse_int
+        self.authorization = "Basic " + base64.b64encode("{}:{}".format(user, password).encode("utf-8")).decode("ascii")
+        self.pool: "queue.LifoQueue[http.client.HTTPConnection]" = queue.LifoQueue(pool_size)
+        self.next_id = 0
+
+    @classmethod
+    def from_env(cls, node_root: str, **kwargs) -> "BitcoinRPC":
+        env = read_rpc_env(node_root)
+        return cls(env["BITCOIN_IP"], int(env["BITCOIN_RPC_PORT"]), env["BITCOIN_RPC_USER"], env["BITCOIN_RPC_PASS"], **kwargs)
+
+    def _connect(self) -> http.client.HTTPConnection:
+        connection = http.client.HTTPConnection(self.host, self.port, timeout=self.connect_timeout)
+        try:
+            connection.connect()
+        except OSError as e:
+            raise ConnectionFailed("Can't connect to {}:{}: {}".format(self.host, self.port, e))
+        connection.sock.settimeout(self.timeout)
+        connection.sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        return connection
+
+    def _release(self, connection: http.client.HTTPConnection):
+        try:
+            self.pool.put_nowait(connection)
+        except queue.Full:
+            connection.close()
+
+    def _post(self, payload: Any) -> Any:
+        body = json.dumps(payload, default=_encode).encode("utf-8")
+        headers = {"Authorization": self.authorization, "Content-Type": "application/json", "Connection": "keep-alive"}
+        try:
+            connection = self.pool.get_nowait()
+            reused = True
+        except queue.Empty:
+            connection = self._connect()
+            reused = False
+        try:
+            try:
+                connection.request("POST", "/", body, headers)
+                response = connection.getresponse()
+            except stale_connection_errors:
+                connection.close()
+                if not reused:
+                    raise
+                connection = self._connect()
+                connection.request("POST", "/", body, headers)
+                response = connection.getresponse()
+            data = response.read()
+        except BaseException:
+            connection.close()
+            raise
+        if response.will_close:
+            connection.close()
+        else:
+            self._release(connection)
+        if response.status in [401, 403]:
+            raise ConnectionFailed("The RPC server didn't accept the credentials (HTTP {})".format(response.status))
+        # Errors of single calls come with an HTTP error status, but still have a JSON-RPC response
+        try:
+            return json.loads(data, parse_float=self.parse_float, parse_int=self.parse_int)
+        except ValueError:
+            raise ConnectionFailed("Invalid response from the RPC server (HTTP {}): {!r}".format(response.status, data[:200]))
+
+    def _request(self, method: str, params: Sequence[Any]) -> dict:
+        self.next_id += 1
+        return {"jsonrpc": "1.0", "id": self.next_id, "method": method, "params": list(params)}
+
+    def call(self, method: str, *params: Any) -> Any:
+        response = self._post(self._request(method, params))
+        if response.get("error") is not None:
+            raise RPCError(response["error"]["code"], response["error"]["message"])
+        return response["result"]
+
+    # Send several calls in one request, as (method, params) tuples
+    # Returns the results in the same order, calls that failed have an RPCError instead of a result
+    def batch(self, calls: Sequence[Tuple[str, Sequence[Any]]]) -> List[Union[Any, RPCError]]:
+        if not calls:
+            return []
+        requests = [self._request(method, params) for method, params in calls]
+        responses = self._post(requests)
+        if isinstance(responses, dict):
+            # The whole batch was rejected, like when bitcoind is still starting
+            error = responses.get("error") or {"code": -1, "message": "Invalid batch response"}
+            raise RPCError(error["code"], error["message"])
+        by_id = {response["id"]: response for response in responses}
+        results: List[Union[Any, RPCError]] = []
+        for request in requests:
+            response = by_id.get(request["id"])
+            if response is None:
+                results.append(RPCError(-1, "No response to {}".format(request["method"])))
+            elif response.get("error") is not None:
+                results.append(RPCError(response["error"]["code"], response["error"]["message"]))
+            else:
+                results.append(response["result"])
+        return results
+
+    def close(self):
+        while True:
+            try:
+                self.pool.get_nowait().close()
+            except queue.Empty:
+                return
+
+def _encode(value: Any) -> Any:
+    if isinstance(value, Decimal):
+        return float(value)
+    raise TypeError("Can't send {!r} to the RPC server".format(value))
+
+##########################################################
+################ bitcoin-cli compatibility ###############
+##########################################################
+
+# Format a result like bitcoin-cli does: strings as they are, null as nothing, everything else as JSON indented by 2
+# Unlike Python's json module, bitcoind writes empty objects and arrays over two lines
+def format_result(value: Any) -> str:
+    if value is None:
+        return ""
+    if isinstance(value, str) and not isinstance(value, RawNumber):
+        return value
+    return _format_json(value, 1)
+
+def _format_json(value: Any, level: int) -> str:
+    if isinstance(value, dict):
+        entries = ["{}{}: {}".format("  " * level, _format_string(key), _format_json(item, level + 1)) for key, item in value.items()]
+        return "{\n" + "".join(entry + (",\n" if i < len(entries) - 1 else "\n") for i, entry in enumerate(entries)) + "  " * (level - 1) + "}"
+    if isinstance(value, list):
+        entries = ["{}{}".format("  " * level, _format_json(item, level + 1)) for item in value]
+        return "[\n" + "".join(entry + (",\n" if i < len(entries) - 1 else "\n") for i, entry in enumerate(entries)) + "  " * (level - 1) + "]"
+    if isinstance(value, RawNumber):
+        return str(value)
+    if isinstance(value, str):
+        return _format_string(value)
+    if value is True:
+        return "true"
+    if value is False:
+        return "false"
+    if value is None:
+        return "null"
+    if isinstance(value, Decimal):
+        return format(value, "f")
+    return json.dumps(value)
+
+def _format_string(value: str) -> str:
+    return json.dumps(value, ensure_ascii=False).replace("\x7f", "\\u007f")
+
+# The parameters bitcoin-cli parses as JSON for the calls that can be made without it, by position
+# (from the conversion table of bitcoin-cli), all other parameters are sent as strings
+# These are only reads, anything else (wallets, sending transactions, changing the node's state) still goes through bitcoin-cli
+cli_json_params: Dict[str, List[int]] = {
+    "getbestblockhash": [],
+    "getblock": [1],
+    "getblockchaininfo": [],
+    "getblockcount": [],
+    "getblockfilter": [],
+    "getblockhash": [0],
+    "getblockheader": [1],
+    "getblockstats": [0, 1],
+    "getchaintips": [],
+    "getchaintxstats": [0],
+    "getconnectioncount": [],
+    "getdeploymentinfo": [],
+    "getdifficulty": [],
+    "getindexinfo": [],
+    "getmempoolancestors": [1],
+    "getmempooldescendants": [1],
+    "getmempoolentry": [],
+    "getmempoolinfo": [],
+    "getmininginfo": [],
+    "getnettotals": [],
+    "getnetworkhashps": [0, 1],
+    "getnetworkinfo": [],
+    "getnodeaddresses": [0],
+    "getpeerinfo": [],
+    "getrawmempool": [0, 1],
+    "getrawtransaction": [1],
+    "gettxout": [1, 2],
+    "estimatesmartfee": [0],
+    "uptime": [],
+}
+
+# Parameters that are either a number or a block hash, which isn't valid JSON
+cli_hash_or_height_params = {("getblockstats", 0)}
+
+# Turn bitcoin-cli's command line arguments into a method and parameters
+# Returns None if bitcoin-cli has to handle the call itself (options, or calls that aren't reads)
+def parse_cli_args(args: List[str]) -> Optional[Tuple[str, List[Any]]]:
+    if not args or args[0].startswith("-") or args[0] not in cli_json_params:
+        return None
+    method = args[0]
+    params: List[Any] = []
+    for index, arg in enumerate(args[1:]):
+        if index not in cli_json_params[method]:
+            params.append(arg)
+            continue
+        try:
+            params.append(json.loads(arg))
+        except ValueError:
+            if (method, index) not in cli_hash_or_height_params:
+                # Let bitcoin-cli print its own error
+                return None
+            params.append(arg)
+    return method, params
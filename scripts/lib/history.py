@@ -0,0 +1,223 @@
+# SPDX-FileCopyrightText: 2023 Citadel and contributors
+#
+# SPDX-License-Identifier: GPL-3.0-or-later
+
+# History of the status metrics (memory and storage usage of the node and every app, temperature, uptime)
+#
+# Every series is a fixed-size file in db/history, memory-mapped, with one ring buffer per tier:
+# raw samples, and 5-minute and hourly buckets with the count, sum, minimum and maximum of the samples in them.
+# Appending a sample updates one slot per tier in place, so only a few bytes (a few pages for the kernel to write back)
+# change per sample, files never grow and are never rewritten.
+# The number of series is limited and series that weren't updated for longer than the hourly tier holds are removed,
+# so the history never takes more than max_series * the size of one file.
+#
+# File layout (little endian):
+#   header: magic "CTSR", version (uint16), number of tiers (uint16), last update (uint32)
+#   per tier: bucket width in seconds (uint32, 0 for raw samples), capacity (uint32), head (uint32), filled slots (uint32)
+#   per tier: capacity slots of: bucket start (uint32), count (uint32), sum (float64), min (float32), max (float32)
+
+import mmap
+import os
+import re
+import struct
+import threading
+import time
+from typing import Dict, List, Optional, Tuple
+
+magic = b"CTSR"
+# Bump this if the file layout changes, files of other versions are recreated
+file_version = 1
+
+header_format = struct.Struct("<4sHHI")
+tier_format = struct.Struct("<IIII")
+slot_format = struct.Struct("<IIdff")
+
+# Name, bucket width in seconds (0 keeps every sample), number of slots
+# 1440 samples (5 days of memory samples, 6 hours of temperature), 7 days of 5-minute buckets and a year of hourly ones
+default_tiers: List[Tuple[str, int, int]] = [("raw", 0, 1440), ("5m", 300, 2016), ("1h", 3600, 8760)]
+
+# At most this many series are kept, about 72 MiB with the default tiers
+default_max_series = 256
+
+series_name_pattern = re.compile(r"^[A-Za-z0-9_.-]+$")
+
+# Turn an app id or other name into something that can be part of a series name
+def series_name(*parts: str) -> str:
+    return ".".join(re.sub(r"[^A-Za-z0-9_-]", "_", part) for part in parts)
+
+class Series:
+    def __init__(self, path: str, tiers: List[Tuple[str, int, int]]):
+        self.path = path
+        self.tiers = tiers
+        self.size = header_format.size + tier_format.size * len(tiers) + sum(capacity for _, _, capacity in tiers) * slot_format.size
+        fd = os.open(path, os.O_RDWR | os.O_CREAT, 0o644)
+        try:
+            if os.fstat(fd).st_size != self.size or not self._valid_header(fd):
+                self._create(fd)
+            self.map = mmap.mmap(fd, self.size)
+        finally:
+            os.close(fd)
+        self.slot_offsets = []
+        offset = header_format.size + tier_format.size * len(tiers)
+        for _, _, capacity in tiers:
+            self.slot_offsets.append(offset)
+            offset += capacity * slot_format.size
+
+    def _valid_header(self, fd: int) -> bool:
+        data = os.pread(fd, header_format.size + tier_format.size * len(self.tiers), 0)
+        file_magic, version, tier_count, _ = header_format.unpack_from(data)
+        if file_magic != magic or version != file_version or tier_count != len(self.tiers):
+            return False
+        for i, (_, width, capacity) in enumerate(self.tiers):
+            file_width, file_capacity, _, _ = tier_format.unpack_from(data, header_format.size + i * tier_format.size)
+            if (file_width, file_capacity) != (width, capacity):
+                return False
+        return True
+
+    # Write an empty file, the size is reserved up front so appending never grows it
+    def _create(self, fd: int):
+        os.ftruncate(fd, 0)
+        os.ftruncate(fd, self.size)
+        header = header_format.pack(magic, file_version, len(self.tiers), 0)
+        header += b"".join(tier_format.pack(width, capacity, capacity - 1, 0) for _, width, capacity in self.tiers)
+        os.pwrite(fd, header, 0)
+
+    def _tier_state(self, index: int) -> Tuple[int, int, int, int]:
+        return tier_format.unpack_from(self.map, header_format.size + index * tier_format.size)
+
+    def last_update(self) -> int:
+        return header_format.unpack_from(self.map)[3]
+
+    def append(self, timestamp: float, value: float):
+        second = int(timestamp)
+        for index, (width, capacity, head, filled) in enumerate(self._tier_state(i) for i in range(len(self.tiers))):
+            slot_offset = self.slot_offsets[index] + head * slot_format.size
+            bucket = second - second % width if width else second
+            if width and filled:
+                start, count, total, minimum, maximum = slot_format.unpack_from(self.map, slot_offset)
+                if start == bucket:
+                    slot_format.pack_into(self.map, slot_offset, start, count + 1, total + value, min(minimum, value), max(maximum, value))
+                    continue
+                # Samples from the past (e.g. after the clock was changed) are added to the newest bucket instead of reordering
+                if bucket < start:
+                    slot_format.pack_into(self.map, slot_offset, start, count + 1, total + value, min(minimum, value), max(maximum, value))
+                    continue
+            head = (head + 1) % capacity
+            filled = min(filled + 1, capacity)
+            slot_format.pack_into(self.map, self.slot_offsets[index] + head * slot_format.size, bucket, 1, value, value, value)
+            tier_format.pack_into(self.map, header_format.size + index * tier_format.size, width, capacity, head, filled)
+        struct.pack_into("<I", self.map, 8, second)
+
+    # The slots of a tier, oldest first
+    def slots(self, index: int) -> List[Tuple[int, int, float, float, float]]:
+        _, capacity, head, filled = self._tier_state(index)
+        result = []
+        for i in range(filled):
+            slot = (head - filled + 1 + i) % capacity
+            result.append(slot_format.unpack_from(self.map, self.slot_offsets[index] + slot * slot_format.size))
+        return result
+
+    def close(self):
+        self.map.close()
+
+class MetricHistory:
+    def __init__(self, directory: str, tiers: List[Tuple[str, int, int]] = default_tiers, max_series: int = default_max_series):
+        self.directory = directory
+        self.tiers = tiers
+        self.max_series = max_series
+        self.open_series: Dict[str, Series] = {}
+        self.lock = threading.Lock()
+        os.makedirs(directory, exist_ok=True)
+
+    def _path(self, name: str) -> str:
+        if not series_name_pattern.match(name):
+            raise ValueError("Invalid series name: {}".format(name))
+        return os.path.join(self.directory, "{}.ring".format(name))
+
+    def names(self) -> List[str]:
+        try:
+            return sorted(entry[:-len(".ring")] for entry in os.listdir(self.directory) if entry.endswith(".ring"))
+        except FileNotFoundError:
+            return []
+
+    def _series(self, name: str, create: bool) -> Optional[Series]:
+        series = self.open_series.get(name)
+        if series is not None:
+            return series
+        path = self._path(name)
+        if not os.path.exists(path):
+            if not create:
+                return None
+            if len(self.names()) >= self.max_series:
+                self.prune()
+                if len(self.names()) >= self.max_series:
+                    raise ValueError("Too many series, not adding {}".format(name))
+        series = Series(path, self.tiers)
+        self.open_series[name] = series
+        return series
+
+    # Add samples, as a dict of series name -> value, all taken at the same time
+    def append(self, samples: Dict[str, float], timestamp: Optional[float] = None):
+        timestamp = time.time() if timestamp is None else timestamp
+        with self.lock:
+            for name, value in samples.items():
+                self._series(name, True).append(timestamp, float(value))
+
+    # Get the points of a series between start and end (unix timestamps)
+    # Unless a tier is given, the finest tier that has all samples since start is used
+    def query(self, name: str, start: float = 0, end: Optional[float] = None, tier: Optional[str] = None) -> dict:
+        end = time.time() if end is None else end
+        with self.lock:
+            series = self._series(name, False)
+            if series is None:
+                raise KeyError(name)
+            tier_slots = [series.slots(index) for index in range(len(self.tiers))]
+        if tier is not None:
+            index = [tier_name for tier_name, _, _ in self.tiers].index(tier)
+        else:
+            index = len(self.tiers) - 1
+            for i, slots in enumerate(tier_slots):
+                # A tier that didn't wrap around yet has everything since the series was created
+                if slots and (slots[0][0] <= start or len(slots) < self.tiers[i][2]):
+                    index = i
+                    break
+        tier_name, width, _ = self.tiers[index]
+        # A bucket is included if any part of it is between start and end, the first one can start before start
+        points = [{"time": bucket, "avg": total / count, "min": minimum, "max": maximum, "count": count}
+                  for bucket, count, total, minimum, maximum in tier_slots[index] if bucket + max(width, 1) > start and bucket <= end]
+        return {"series": name, "tier": tier_name, "resolution": width, "points": points}
+
+    # Remove series that weren't updated for longer than the coarsest tier holds, like those of uninstalled apps
+    def prune(self, now: Optional[float] = None) -> List[str]:
+        now = time.time() if now is None else now
+        _, width, capacity = self.tiers[-1]
+        retention = max(width, 1) * capacity
+        removed = []
+        for name in self.names():
+            series = self._series(name, False)
+            if series is None or now - series.last_update() <= retention:
+                continue
+            series.close()
+            del self.open_series[name]
+            os.remove(self._path(name))
+            removed.append(name)
+        return removed
+
+    def close(self):
+        with self.lock:
+            for series in self.open_series.values():
+                series.close()
+            self.open_series = {}
+
+##########################################################
+################# Samples from status files ##############
+##########################################################
+
+# Memory and storage status have the same layout: total, used and a breakdown of used by app
+def usage_samples(resource: str, status: dict) -> Dict[str, float]:
+    samples = {series_name(resource, "used"): status["used"]}
+    for entry in status.get("breakdown", []):
+        samples[series_name(resource, "app", entry["id"])] = entry["used"]
+    if "pendingDeletion" in status:
+        samples[series_name(resource, "pendingDeletion")] = status["pendingDeletion"]
+    return samples
@@ -0,0 +1,255 @@
+# SPDX-FileCopyrightText: 2023 Citadel and contributors
+#
+# SPDX-License-Identifier: GPL-3.0-or-later
+
+# Karen runs triggers (scripts/triggers/*) on request of the manager or other services
+#
+# Messages are lines of text sent over a unix socket:
+#   trigger <name> [args...]    Run scripts/triggers/<name> with args
+#   exec <command...>           Run a shell command
+# Prefixing a message with "reply " makes karen answer with JSON lines: one when the job is accepted,
+# and one with the exit code when it finished. Without the prefix, the connection is closed once the job finished,
+# like older versions of karen did.
+#
+# Triggers run concurrently, but some of them have to wait for others:
+#  - App triggers that change the configuration of the apps (install, uninstall, update, generate, ...) and other
+#    triggers that regenerate it (app-update, caddy-config-update) run one at a time, and not while any other app trigger runs,
+#    because they all rewrite the generated app configuration, the Tor placement and the list of installed apps
+#  - Other app triggers ("trigger app start <app>", stop, restart, compose) for different apps run concurrently,
+#    for the same app one after another
+#  - Global triggers (like update) wait until all other jobs are done, and block new jobs until they are done
+#  - Reboot and shutdown run immediately
+#  - All other triggers only run once at a time per trigger name
+# A request identical to a job that is still waiting to run is merged into that job.
+
+import asyncio
+import json
+import os
+import time
+from typing import Dict, List, Optional
+
+from lib.tracing import start_operation
+
+# Triggers that need the node for themselves
+global_triggers = ["update", "set-update-channel", "change-password"]
+# Triggers that run immediately, no matter what else is running
+immediate_triggers = ["reboot", "shutdown"]
+# App actions that only work on the app they're given, all other app actions need the apps for themselves
+per_app_actions = ["start", "stop", "restart", "compose"]
+# Triggers other than "app" that regenerate the app configuration
+configuration_triggers = ["app-update", "caddy-config-update"]
+
+# Messages without a newline are complete if nothing else arrives within this time
+legacy_message_timeout = 0.2
+
+# A lock that can be held by many jobs at once, or exclusively by one job
+# Waiting exclusive jobs take priority over new shared ones, so global triggers don't starve
+class SharedLock:
+    def __init__(self):
+        self._shared = 0
+        self._exclusive = False
+        self._exclusive_waiting = 0
+        self._condition = asyncio.Condition()
+
+    async def acquire_shared(self):
+        async with self._condition:
+            await self._condition.wait_for(lambda: not self._exclusive and self._exclusive_waiting == 0)
+            self._shared += 1
+
+    async def release_shared(self):
+        async with self._condition:
+            self._shared -= 1
+            self._condition.notify_all()
+
+    async def acquire_exclusive(self):
+        async with self._condition:
+            self._exclusive_waiting += 1
+            try:
+                await self._condition.wait_for(lambda: not self._exclusive and self._shared == 0)
+            finally:
+                self._exclusive_waiting -= 1
+            self._exclusive = True
+
+    async def release_exclusive(self):
+        async with self._condition:
+            self._exclusive = False
+            self._condition.notify_all()
+
+class Job:
+    def __init__(self, job_id: int, kind: str, args: List[str]):
+        self.id = job_id
+        self.kind = kind
+        self.args = args
+        self.status = "queued"
+        self.exit_code: Optional[int] = None
+        self.done = asyncio.Event()
+        self.submitted = time.monotonic()
+
+    @property
+    def description(self) -> str:
+        return " ".join([self.kind] + self.args)
+
+    # How the job holds the apps lock: "exclusive" if it changes the configuration of the apps,
+    # "shared" if it only works on one app, or None if it doesn't touch the apps
+    @property
+    def apps_mode(self) -> Optional[str]:
+        if self.kind != "trigger":
+            return None
+        name = self.args[0]
+        if name == "app":
+            if len(self.args) >= 3 and self.args[1] in per_app_actions and self.args[2] != "installed":
+                return "shared"
+            return "exclusive"
+        if name in configuration_triggers:
+            return "exclusive"
+        return None
+
+    # The key of the lock that serializes this job
+    @property
+    def lock_key(self) -> str:
+        if self.kind == "exec":
+            return "exec"
+        if self.apps_mode == "shared":
+            return "app:{}".format(self.args[2])
+        if self.apps_mode == "exclusive":
+            return "apps"
+        return "trigger:{}".format(self.args[0])
+
+    @property
+    def mode(self) -> str:
+        if self.kind == "trigger" and self.args[0] in immediate_triggers:
+            return "immediate"
+        if self.kind == "trigger" and self.args[0] in global_triggers:
+            return "exclusive"
+        return "shared"
+
+    def result(self) -> dict:
+        return {"job": self.id, "status": self.status, "exitCode": self.exit_code}
+
+class Karen:
+    def __init__(self, root: str):
+        self.root = root
+        self.next_id = 1
+        # Jobs that didn't start yet, by description, for coalescing identical requests
+        self.pending: Dict[str, Job] = {}
+        self.locks: Dict[str, asyncio.Lock] = {}
+        self.global_lock = SharedLock()
+        self.apps_lock = SharedLock()
+
+    # Parse a message, returns the job kind and arguments, or None if the message is invalid
+    def parse(self, message: str):
+        instructions = message.strip().split()
+        if len(instructions) < 2 or instructions[0] not in ["trigger", "exec"]:
+            return None
+        if instructions[0] == "trigger":
+            trigger = instructions[1]
+            if "/" in trigger or trigger.startswith(".") or not os.path.isfile(os.path.join(self.root, "scripts", "triggers", trigger)):
+                return None
+        return instructions[0], instructions[1:]
+
+    # Queue a job, or return an identical job that is still waiting to run
+    def submit(self, kind: str, args: List[str]) -> Job:
+        description = " ".join([kind] + args)
+        if description in self.pending:
+            return self.pending[description]
+        job = Job(self.next_id, kind, args)
+        self.next_id += 1
+        self.pending[description] = job
+        asyncio.ensure_future(self.run(job))
+        return job
+
+    async def run(self, job: Job):
+        if job.mode == "exclusive":
+            await self.global_lock.acquire_exclusive()
+        elif job.mode == "shared":
+            await self.global_lock.acquire_shared()
+        lock = None
+        apps_mode = job.apps_mode if job.mode == "shared" else None
+        if apps_mode == "exclusive":
+            await self.apps_lock.acquire_exclusive()
+        elif apps_mode == "shared":
+            await self.apps_lock.acquire_shared()
+        if job.mode == "shared":
+            lock = self.locks.setdefault(job.lock_key, asyncio.Lock())
+            await lock.acquire()
+        # From now on, new identical requests create a new job
+        del self.pending[job.description]
+        job.status = "running"
+        start = time.monotonic()
+        print("Job {}: {} started".format(job.id, job.description), flush=True)
+        # If tracing is enabled, every job is a trace, which the app-manager calls of the trigger are part of
+        operation, trace_env = start_operation(self.root, "karen", job.description, queuedMs=round((start - job.submitted) * 1000, 2))
+        env = dict(os.environ, **trace_env) if trace_env else None
+        try:
+            if job.kind == "trigger":
+                process = await asyncio.create_subprocess_exec(
+                    os.path.join(self.root, "scripts", "triggers", job.args[0]), *job.args[1:], cwd=self.root, env=env)
+            else:
+                process = await asyncio.create_subprocess_shell(" ".join(job.args), cwd=self.root, env=env)
+            job.exit_code = await process.wait()
+            job.status = "done" if job.exit_code == 0 else "failed"
+        except Exception as e:
+            print("Job {}: {} could not be started: {}".format(job.id, job.description, e), flush=True)
+            job.status = "failed"
+        finally:
+            if lock is not None:
+                lock.release()
+            if apps_mode == "exclusive":
+                await self.apps_lock.release_exclusive()
+            elif apps_mode == "shared":
+                await self.apps_lock.release_shared()
+            if job.mode == "exclusive":
+                await self.global_lock.release_exclusive()
+            elif job.mode == "shared":
+                await self.global_lock.release_shared()
+        print("Job {}: {} {} with exit code {} after {:.1f}s".format(
+            job.id, job.description, job.status, job.exit_code, time.monotonic() - start), flush=True)
+        operation.end(status=job.status, exitCode=job.exit_code)
+        job.done.set()
+
+    # Read one message: until a newline, EOF, or a short pause if the client neither sends a newline nor closes
+    async def read_message(self, reader: asyncio.StreamReader) -> str:
+        data = b""
+        while not data.endswith(b"\n"):
+            try:
+                chunk = await asyncio.wait_for(reader.read(65536), legacy_message_timeout if data else None)
+            except asyncio.TimeoutError:
+                break
+            if not chunk:
+                break
+            data += chunk
+        return data.decode("utf-8")
+
+    async def handle(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+        try:
+            message = await self.read_message(reader)
+            reply = message.startswith("reply ")
+            if reply:
+                message = message[len("reply "):]
+            parsed = self.parse(message)
+            if parsed is None:
+                if message.strip():
+                    print("Ignoring invalid message: {}".format(message.strip()), flush=True)
+                if reply:
+                    writer.write((json.dumps({"job": None, "status": "invalid", "exitCode": None}) + "\n").encode("utf-8"))
+                    await writer.drain()
+                return
+            job = self.submit(*parsed)
+            if reply:
+                writer.write((json.dumps(job.result()) + "\n").encode("utf-8"))
+                await writer.drain()
+            await job.done.wait()
+            if reply:
+                writer.write((json.dumps(job.result()) + "\n").encode("utf-8"))
+                await writer.drain()
+        except (ConnectionError, UnicodeDecodeError):
+            pass
+        finally:
+            writer.close()
+
+    async def serve(self, socket_path: str):
+        if os.path.exists(socket_path):
+            os.remove(socket_path)
+        server = await asyncio.start_unix_server(self.handle, path=socket_path)
+        async with server:
+            await server.serve_forever()
@@ -0,0 +1,134 @@
+# SPDX-FileCopyrightText: 2023 Citadel and contributors
+#
+# SPDX-License-Identifier: GPL-3.0-or-later
+
+# Memory usage of the node and its apps
+# Container usage is read straight from the cgroup filesystem instead of sampling with "docker stats",
+# and containers are mapped to apps by their compose project label, so this only runs "docker ps" once
+
+import os
+import subprocess
+from typing import Dict, List, NamedTuple, Optional
+
+from lib.apps import installed_apps
+
+class Container(NamedTuple):
+    id: str
+    name: str
+    project: str
+
+# List all running containers with their compose project (empty for containers not started by compose)
+def list_containers() -> List[Container]:
+    output = subprocess.check_output([
+        "docker", "ps", "--no-trunc", "--format",
+        '{{.ID}}\t{{.Names}}\t{{.Label "com.docker.compose.project"}}'
+    ]).decode("utf-8")
+    containers = []
+    for line in output.splitlines():
+        fields = line.split("\t")
+        if len(fields) < 2:
+            continue
+        containers.append(Container(fields[0], fields[1], fields[2] if len(fields) > 2 else ""))
+    return containers
+
+def read_int(file_path: str) -> Optional[int]:
+    try:
+        with open(file_path, "r") as f:
+            return int(f.read().strip())
+    except (OSError, ValueError):
+        return None
+
+def read_stat(file_path: str) -> Dict[str, int]:
+    stats = {}
+    try:
+        with open(file_path, "r") as f:
+            for line in f:
+                key, _, value = line.partition(" ")
+                try:
+                    stats[key] = int(value)
+                except ValueError:
+                    continue
+    except OSError:
+        pass
+    return stats
+
+# Reads container memory usage from cgroup v2 or v1
+# Like "docker stats", inactive page cache is not counted as used memory
+class CgroupMemory:
+    def __init__(self, root: str = "/sys/fs/cgroup"):
+        self.root = root
+        self.is_v2 = os.path.isfile(os.path.join(root, "cgroup.controllers"))
+
+    # The directories a container's cgroup can be in, depending on the cgroup driver
+    def candidate_dirs(self, container_id: str) -> List[str]:
+        base = self.root if self.is_v2 else os.path.join(self.root, "memory")
+        return [
+            os.path.join(base, "system.slice", "docker-{}.scope".format(container_id)),
+            os.path.join(base, "docker", container_id),
+        ]
+
+    def container_usage(self, container_id: str) -> int:
+        for cgroup_dir in self.candidate_dirs(container_id):
+            if self.is_v2:
+                usage = read_int(os.path.join(cgroup_dir, "memory.current"))
+                inactive_key = "inactive_file"
+            else:
+                usage = read_int(os.path.join(cgroup_dir, "memory.usage_in_bytes"))
+                inactive_key = "total_inactive_file"
+            if usage is None:
+                continue
+            inactive = read_stat(os.path.join(cgroup_dir, "memory.stat")).get(inactive_key, 0)
+            return usage - inactive if inactive < usage else usage
+        return 0
+
+# Total and used memory in bytes, with the same meaning as the "total" and "used" columns of "free"
+def system_memory(meminfo_file: str = "/proc/meminfo"):
+    meminfo = {}
+    with open(meminfo_file, "r") as f:
+        for line in f:
+            key, _, value = line.partition(":")
+            meminfo[key] = int(value.split()[0]) * 1024
+    total = meminfo["MemTotal"]
+    available = meminfo.get("MemAvailable", meminfo.get("MemFree", 0) + meminfo.get("Buffers", 0) + meminfo.get("Cached", 0))
+    return total, total - available
+
+# Memory usage per compose project, and per container name
+def container_usage(containers: List[Container], cgroups: CgroupMemory):
+    by_project: Dict[str, int] = {}
+    by_name: Dict[str, int] = {}
+    for container in containers:
+        usage = cgroups.container_usage(container.id)
+        by_name[container.name] = usage
+        by_project[container.project] = by_project.get(container.project, 0) + usage
+    return by_project, by_name
+
+# Build the contents of statuses/memory-status.json
+def memory_status(node_root: str, containers: List[Container], cgroups: CgroupMemory, meminfo_file: str = "/proc/meminfo") -> dict:
+    total, used = system_memory(meminfo_file)
+    by_project, _ = container_usage(containers, cgroups)
+    breakdown = []
+    cumulative_app_memory = 0
+    for app in installed_apps(node_root):
+        app_memory = by_project.get(app, 0)
+        cumulative_app_memory += app_memory
+        breakdown.append({"id": app, "used": app_memory})
+    breakdown.append({"id": "citadel", "used": used - cumulative_app_memory})
+    breakdown.sort(key=lambda entry: -entry["used"])
+    return {"total": total, "used": used, "breakdown": breakdown}
+
+# The lines printed by scripts/memory-usage, as percentages of total memory
+# Like before, total and system have one decimal, services and apps two
+def memory_usage_report(node_root: str, containers: List[Container], cgroups: CgroupMemory, meminfo_file: str = "/proc/meminfo") -> List[str]:
+    total, used = system_memory(meminfo_file)
+    by_project, by_name = container_usage(containers, cgroups)
+    percent = lambda value: 100 * value / total
+    lines = [
+        ("total", percent(used), 1),
+        ("system", percent(used - sum(by_name.values())), 1),
+    ]
+    for service in ["bitcoin", "lightning", "tor"]:
+        lines.append((service, percent(by_name.get(service, 0)), 2))
+    for app in installed_apps(node_root):
+        lines.append((app, percent(by_project.get(app, 0)), 2))
+    lines.sort(key=lambda line: -line[1])
+    return ["{}: {:.{}f}%".format(name, value, decimals) for name, value, decimals in lines]
@@ -0,0 +1,656 @@
+# SPDX-FileCopyrightText: 2023 Citadel and contributors
+#
+# SPDX-License-Identifier: GPL-3.0-or-later
+
+# Delta updates of the node's directory tree
+#
+# Every release is described by a manifest: the sha256, size and executable bit of every file an update installs
+# (and the target of every symlink), plus the update's include and ignore rules (scripts/update/.updateinclude and
+# .updateignore, with the same meaning as for rsync).
+# The manifest is compared against the installed tree, and only the files that changed are fetched, into a
+# content-addressed object store (.citadel-update/objects) that survives failed attempts:
+# objects are verified against their hash, and interrupted downloads are resumed from the partial file.
+#
+# The new release is then staged in .citadel-<release>: changed files are copied from the object store,
+# unchanged ones are hard links to the installed files, so the update scripts of the new release can run from it
+# like from a full copy. Applying the staged release replaces every changed file with a rename,
+# removes the files the release doesn't have anymore, and only changes the owner of files it wrote.
+#
+# Sources of a release:
+#   DirSource: a directory with the release (--path and --repo updates)
+#   HTTPSource: a server with <url>/manifest.json and <url>/objects/<first 2 hex digits>/<sha256> (see write_mirror)
+#   TarballSource: a .tar.gz of the release, like GitHub's archives, only the changed files are extracted from it
+
+import concurrent.futures
+import hashlib
+import http.client
+import json
+import os
+import re
+import shutil
+import stat
+import tarfile
+import threading
+import time
+import urllib.error
+import urllib.request
+from typing import Callable, Dict, Iterable, List, NamedTuple, Optional, Tuple
+
+# Bump this if the manifest format changes
+manifest_version = 1
+# The manifest of a staged release, in the root of .citadel-<release>
+staged_manifest_name = ".citadel-manifest.json"
+# The object store and downloads, relative to the node root
+store_dir_name = ".citadel-update"
+
+chunk_size = 1024 * 1024
+default_timeout = 60
+# How often a download is resumed in a row without getting any further, before the update fails
+default_retries = 5
+default_workers = 4
+# Write the status file at most this often while downloading
+status_interval = 0.5
+
+class UpdateError(Exception):
+    pass
+
+def file_digest(path: str) -> str:
+    digest = hashlib.sha256()
+    with open(path, "rb") as f:
+        for chunk in iter(lambda: f.read(chunk_size), b""):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+def _is_executable(mode: int) -> bool:
+    return bool(mode & stat.S_IXUSR)
+
+def _file_mode(executable: bool) -> int:
+    return 0o755 if executable else 0o644
+
+# Translate an rsync pattern to a regex: * and ? don't match /, ** matches anything
+def _glob_regex(pattern: str) -> str:
+    regex = ""
+    i = 0
+    while i < len(pattern):
+        char = pattern[i]
+        if pattern.startswith("**", i):
+            regex += ".*"
+            i += 2
+            continue
+        if char == "*":
+            regex += "[^/]*"
+        elif char == "?":
+            regex += "[^/]"
+        elif char == "[" and "]" in pattern[i + 1:]:
+            end = pattern.index("]", i + 1)
+            regex += pattern[i:end + 1]
+            i = end
+        else:
+            regex += re.escape(char)
+        i += 1
+    return regex
+
+class FilterRule(NamedTuple):
+    include: bool
+    regex: "re.Pattern"
+    # Only matches against the last component of the path
+    basename: bool
+    directory_only: bool
+
+# The include and ignore rules of an update, evaluated like rsync --include-from=... --exclude-from=...:
+# the first matching rule decides, and nothing below an excluded directory is transferred (or deleted)
+class UpdateFilter:
+    def __init__(self, include: Iterable[str], ignore: Iterable[str]):
+        self.include = [line for line in include if self._is_rule(line)]
+        self.ignore = [line for line in ignore if self._is_rule(line)]
+        self.rules = [self._compile(True, line) for line in self.include] + [self._compile(False, line) for line in self.ignore]
+
+    @classmethod
+    def from_tree(cls, root: str) -> "UpdateFilter":
+        return cls(_read_lines(os.path.join(root, "scripts", "update", ".updateinclude")),
+                   _read_lines(os.path.join(root, "scripts", "update", ".updateignore")))
+
+    @staticmethod
+    def _is_rule(line: str) -> bool:
+        return line.strip() != "" and not line.startswith(("#", ";"))
+
+    @staticmethod
+    def _compile(include: bool, pattern: str) -> FilterRule:
+        pattern = pattern.strip()
+        directory_only = pattern.endswith("/")
+        pattern = pattern.rstrip("/")
+        if pattern.startswith("/"):
+            return FilterRule(include, re.compile("^" + _glob_regex(pattern[1:]) + "$"), False, directory_only)
+        if "/" in pattern or "**" in pattern:
+            return FilterRule(include, re.compile("(^|/)" + _glob_regex(pattern) + "$"), False, directory_only)
+        return FilterRule(include, re.compile("^" + _glob_regex(pattern) + "$"), True, directory_only)
+
+    def _rule(self, path: str, is_dir: bool) -> Optional[FilterRule]:
+        name = path.rsplit("/", 1)[-1]
+        for rule in self.rules:
+            if rule.directory_only and not is_dir:
+                continue
+            if rule.regex.search(name if rule.basename else path):
+                return rule
+        return None
+
+    def _included(self, path: str, is_dir: bool) -> bool:
+        rule = self._rule(path, is_dir)
+        return rule is None or rule.include
+
+    # Files matched by a rule of .updateinclude (like .env or tor/torrc-core) are generated on the node,
+    # so they are replaced if the release has them, but never removed because it doesn't
+    def protected(self, path: str) -> bool:
+        rule = self._rule(path, False)
+        return rule is not None and rule.include
+
+    # Whether an update touches this path (relative to the root, with / as separator)
+    # The directories it is in are checked too, so this can be used for paths that weren't reached by walking the tree
+    def matches(self, path: str, is_dir: bool = False) -> bool:
+        parts = path.split("/")
+        for i in range(1, len(parts)):
+            if not self._included("/".join(parts[:i]), True):
+                return False
+        return self._included(path, is_dir)
+
+    def walk(self, root: str) -> Iterable[Tuple[str, os.DirEntry]]:
+        stack = [""]
+        while stack:
+            relative = stack.pop()
+            with os.scandir(os.path.join(root, relative)) as entries:
+                for entry in entries:
+                    path = relative + "/" + entry.name if relative else entry.name
+                    is_dir = entry.is_dir(follow_symlinks=False)
+                    if not self._included(path, is_dir):
+                        continue
+                    if is_dir:
+                        stack.append(path)
+                    else:
+                        yield path, entry
+
+def _read_lines(path: str) -> List[str]:
+    with open(path, "r") as f:
+        return f.read().splitlines()
+
+def _write_json(path: str, data, indent: Optional[int] = None):
+    tmp = path + ".tmp"
+    with open(tmp, "w") as f:
+        json.dump(data, f, indent=indent, sort_keys=True)
+    os.replace(tmp, path)
+
+def _empty_manifest(release: str, update_filter: UpdateFilter) -> dict:
+    return {"version": manifest_version, "release": release, "include": update_filter.include, "ignore": update_filter.ignore,
+            "files": {}, "links": {}}
+
+# Describe the files of the release in root that an update installs
+def build_manifest(root: str, release: str) -> dict:
+    update_filter = UpdateFilter.from_tree(root)
+    manifest = _empty_manifest(release, update_filter)
+    for path, entry in update_filter.walk(root):
+        if entry.is_symlink():
+            manifest["links"][path] = os.readlink(entry.path)
+        elif entry.is_file(follow_symlinks=False):
+            info = entry.stat(follow_symlinks=False)
+            manifest["files"][path] = {"sha256": file_digest(entry.path), "size": info.st_size, "executable": _is_executable(info.st_mode)}
+    return manifest
+
+def load_manifest(data: bytes) -> dict:
+    try:
+        manifest = json.loads(data)
+    except ValueError as e:
+        raise UpdateError("Invalid manifest: {}".format(e))
+    if not isinstance(manifest, dict) or manifest.get("version") != manifest_version:
+        raise UpdateError("Unsupported manifest version: {}".format(manifest.get("version") if isinstance(manifest, dict) else None))
+    for path in list(manifest["files"]) + list(manifest["links"]):
+        if path.startswith("/") or ".." in path.split("/"):
+            raise UpdateError("Invalid path in manifest: {}".format(path))
+    return manifest
+
+def manifest_filter(manifest: dict) -> UpdateFilter:
+    return UpdateFilter(manifest["include"], manifest["ignore"])
+
+# Publish the release in root for HTTPSource: out/manifest.json and out/objects/<aa>/<sha256>
+def write_mirror(root: str, release: str, out: str) -> dict:
+    manifest = build_manifest(root, release)
+    store = ObjectStore(os.path.join(out, "objects"))
+    for path, entry in manifest["files"].items():
+        if not store.has(entry["sha256"]):
+            store.add_file(entry["sha256"], os.path.join(root, path))
+    os.makedirs(out, exist_ok=True)
+    _write_json(os.path.join(out, "manifest.json"), manifest)
+    return manifest
+
+class Plan(NamedTuple):
+    manifest: dict
+    # Files that are new or have a different content
+    changed: List[str]
+    # Files that only need a different executable bit
+    chmod: List[str]
+    # Symlinks that are new or point somewhere else
+    links: List[str]
+    # Installed files and symlinks the release doesn't have anymore
+    removed: List[str]
+
+    # The objects of changed files that aren't in the store yet, sha256 -> (path in the release, size)
+    def missing_objects(self, store: "ObjectStore") -> Dict[str, Tuple[str, int]]:
+        objects: Dict[str, Tuple[str, int]] = {}
+        for path in self.changed:
+            entry = self.manifest["files"][path]
+            if entry["sha256"] not in objects and not store.has(entry["sha256"]):
+                objects[entry["sha256"]] = (path, entry["size"])
+        return objects
+
+# Compare a manifest against the tree at root
+def plan_update(manifest: dict, root: str) -> Plan:
+    update_filter = manifest_filter(manifest)
+    files = manifest["files"]
+    links = manifest["links"]
+    changed: List[str] = []
+    chmod: List[str] = []
+    changed_links: List[str] = []
+    for path, entry in files.items():
+        if not update_filter.matches(path):
+            continue
+        target = os.path.join(root, path)
+        try:
+            info = os.lstat(target)
+        except (FileNotFoundError, NotADirectoryError):
+            changed.append(path)
+            continue
+        if not stat.S_ISREG(info.st_mode) or info.st_size != entry["size"] or file_digest(target) != entry["sha256"]:
+            changed.append(path)
+        elif _is_executable(info.st_mode) != entry["executable"]:
+            chmod.append(path)
+    for path, destination in links.items():
+        if not update_filter.matches(path):
+            continue
+        target = os.path.join(root, path)
+        if not os.path.islink(target) or os.readlink(target) != destination:
+            changed_links.append(path)
+    removed = [path for path, _ in update_filter.walk(root) if path not in files and path not in links and not update_filter.protected(path)]
+    return Plan(manifest, sorted(changed), sorted(chmod), sorted(changed_links), sorted(removed))
+
+# Objects by their sha256, every object is verified before it is added
+class ObjectStore:
+    def __init__(self, directory: str):
+        self.directory = directory
+
+    def path(self, sha256: str) -> str:
+        return os.path.join(self.directory, sha256[:2], sha256)
+
+    def partial_path(self, sha256: str) -> str:
+        return self.path(sha256) + ".part"
+
+    def has(self, sha256: str) -> bool:
+        return os.path.isfile(self.path(sha256))
+
+    # Move a complete download into the store, if it has the expected content
+    def commit(self, sha256: str, partial: str):
+        actual = file_digest(partial)
+        if actual != sha256:
+            os.unlink(partial)
+            raise UpdateError("Object {} has the wrong hash {}".format(sha256, actual))
+        os.replace(partial, self.path(sha256))
+
+    def add_file(self, sha256: str, source: str, progress: Optional[Callable[[int], None]] = None):
+        partial = self.partial_path(sha256)
+        os.makedirs(os.path.dirname(partial), exist_ok=True)
+        with open(source, "rb") as src, open(partial, "wb") as dst:
+            for chunk in iter(lambda: src.read(chunk_size), b""):
+                dst.write(chunk)
+                if progress:
+                    progress(len(chunk))
+        self.commit(sha256, partial)
+
+    def add_stream(self, sha256: str, stream, progress: Optional[Callable[[int], None]] = None):
+        partial = self.partial_path(sha256)
+        os.makedirs(os.path.dirname(partial), exist_ok=True)
+        with open(partial, "wb") as dst:
+            for chunk in iter(lambda: stream.read(chunk_size), b""):
+                dst.write(chunk)
+                if progress:
+                    progress(len(chunk))
+        self.commit(sha256, partial)
+
+# Download url into path, continuing a previous partial download in path + ".part" with a range request
+# The ETag of the partial download is kept next to it, so it is only continued if the file didn't change on the server
+def download(url: str, path: str, progress: Optional[Callable[[int], None]] = None, timeout: float = default_timeout,
+             retries: int = default_retries) -> str:
+    partial = path + ".part"
+    etag_file = partial + ".etag"
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    # Bytes passed to progress so far, a download that starts over only counts again once it gets past them
+    reported = 0
+    failures = 0
+    while True:
+        offset = os.path.getsize(partial) if os.path.exists(partial) else 0
+        request = urllib.request.Request(url)
+        if offset:
+            request.add_header("Range", "bytes={}-".format(offset))
+            if os.path.exists(etag_file):
+                with open(etag_file, "r") as f:
+                    request.add_header("If-Range", f.read().strip())
+        try:
+            with urllib.request.urlopen(request, timeout=timeout) as response:
+                position = offset if response.status == 206 else 0
+                etag = response.headers.get("ETag")
+                if etag and not etag.startswith("W/"):
+                    with open(etag_file, "w") as f:
+                        f.write(etag)
+                elif os.path.exists(etag_file):
+                    os.unlink(etag_file)
+                with open(partial, "ab" if position else "wb") as f:
+                    if progress and position > reported:
+                        progress(position - reported)
+                        reported = position
+                    for chunk in iter(lambda: response.read(chunk_size), b""):
+                        f.write(chunk)
+                        position += len(chunk)
+                        if progress and position > reported:
+                            progress(position - reported)
+                            reported = position
+                    if response.length:
+                        raise UpdateError("Download of {} ended early".format(url))
+        except urllib.error.HTTPError as e:
+            # The partial download is already complete
+            if e.code == 416 and offset:
+                break
+            if e.code < 500 and e.code != 429:
+                raise UpdateError("Download of {} failed: HTTP {}".format(url, e.code))
+            error: Exception = e
+        except (OSError, http.client.HTTPException, UpdateError) as e:
+            error = e
+        else:
+            break
+        # Links that drop connections often still get there, as long as every attempt gets a bit further
+        if os.path.exists(partial) and os.path.getsize(partial) > offset:
+            failures = 0
+            continue
+        failures += 1
+        if failures > retries:
+            raise UpdateError("Download of {} failed: {}".format(url, error))
+        print("Download of {} failed ({}), trying again".format(url, error))
+        time.sleep(min(2 ** failures, 30))
+    if os.path.exists(etag_file):
+        os.unlink(etag_file)
+    os.replace(partial, path)
+    return path
+
+class DirSource:
+    def __init__(self, root: str):
+        self.root = root
+
+    def manifest(self, release: str) -> dict:
+        return build_manifest(self.root, release)
+
+    def fetch(self, objects: Dict[str, Tuple[str, int]], store: ObjectStore, progress: Callable[[int, int], None]):
+        for sha256, (path, _) in objects.items():
+            store.add_file(sha256, os.path.join(self.root, path), lambda size: progress(size, 0))
+            progress(0, 1)
+
+class HTTPSource:
+    def __init__(self, url: str, timeout: float = default_timeout, workers: int = default_workers):
+        self.url = url.rstrip("/")
+        self.timeout = timeout
+        self.workers = workers
+
+    def manifest(self, release: str) -> dict:
+        try:
+            with urllib.request.urlopen(self.url + "/manifest.json", timeout=self.timeout) as response:
+                manifest = load_manifest(response.read())
+        except (OSError, urllib.error.URLError) as e:
+            raise UpdateError("Failed to get the manifest from {}: {}".format(self.url, e))
+        if manifest["release"] != release:
+            raise UpdateError("The manifest at {} is for {}, not {}".format(self.url, manifest["release"], release))
+        return manifest
+
+    def _fetch_one(self, sha256: str, store: ObjectStore, progress: Callable[[int, int], None]):
+        path = download("{}/objects/{}/{}".format(self.url, sha256[:2], sha256), store.path(sha256) + ".download",
+                        lambda size: progress(size, 0), self.timeout)
+        store.commit(sha256, path)
+        progress(0, 1)
+
+    # Objects are downloaded in parallel, which helps a lot on links with a high latency like Tor
+    def fetch(self, objects: Dict[str, Tuple[str, int]], store: ObjectStore, progress: Callable[[int, int], None]):
+        with concurrent.futures.ThreadPoolExecutor(self.workers) as pool:
+            futures = [pool.submit(self._fetch_one, sha256, store, progress) for sha256 in objects]
+            for future in concurrent.futures.as_completed(futures):
+                future.result()
+
+class TarballSource:
+    def __init__(self, url: str, download_dir: str, timeout: float = default_timeout):
+        self.url = url
+        self.download_dir = download_dir
+        self.timeout = timeout
+        self.tarball: Optional[str] = None
+        # Path in the release -> name of the member in the tarball
+        self.members: Dict[str, str] = {}
+
+    # Like GitHub's archives, everything is in a single top-level directory, which isn't part of the paths
+    @staticmethod
+    def _release_path(name: str) -> Optional[str]:
+        parts = name.strip("/").split("/", 1)
+        return parts[1] if len(parts) == 2 and parts[1] != "" else None
+
+    def _open(self):
+        try:
+            return tarfile.open(self.tarball, "r|gz")
+        except tarfile.TarError as e:
+            raise UpdateError("Invalid tarball {}: {}".format(self.url, e))
+
+    def manifest(self, release: str) -> dict:
+        self.tarball = os.path.join(self.download_dir, "{}.tar.gz".format(release))
+        if not os.path.exists(self.tarball):
+            download(self.url, self.tarball, timeout=self.timeout)
+        entries: Dict[str, dict] = {}
+        links: Dict[str, str] = {}
+        rules: Dict[str, List[str]] = {"scripts/update/.updateinclude": [], "scripts/update/.updateignore": []}
+        try:
+            with self._open() as tar:
+                for member in tar:
+                    path = self._release_path(member.name)
+                    if path is None:
+                        continue
+                    if member.issym():
+                        links[path] = member.linkname
+                    elif member.isfile():
+                        data = tar.extractfile(member).read()
+                        self.members[path] = member.name
+                        entries[path] = {"sha256": hashlib.sha256(data).hexdigest(), "size": member.size, "executable": _is_executable(member.mode)}
+                        if path in rules:
+                            rules[path] = data.decode().splitlines()
+        except (tarfile.TarError, EOFError, OSError) as e:
+            # The download is broken, get it again next time
+            os.unlink(self.tarball)
+            raise UpdateError("Failed to read {}: {}".format(self.url, e))
+        update_filter = UpdateFilter(rules["scripts/update/.updateinclude"], rules["scripts/update/.updateignore"])
+        manifest = _empty_manifest(release, update_filter)
+        manifest["files"] = {path: entry for path, entry in entries.items() if update_filter.matches(path)}
+        manifest["links"] = {path: target for path, target in links.items() if update_filter.matches(path)}
+        return manifest
+
+    # Extract only the changed files, in one pass over the tarball
+    def fetch(self, objects: Dict[str, Tuple[str, int]], store: ObjectStore, progress: Callable[[int, int], None]):
+        wanted = {self.members[path]: sha256 for sha256, (path, _) in objects.items()}
+        with self._open() as tar:
+            for member in tar:
+                if member.name in wanted and not store.has(wanted[member.name]):
+                    store.add_stream(wanted[member.name], tar.extractfile(member), lambda size: progress(size, 0))
+                    progress(0, 1)
+
+# Progress of the update in statuses/update-status.json
+# While the release is downloaded, the progress goes from start to end by the downloaded bytes
+class UpdateStatus:
+    def __init__(self, status_file: str, release: str, start: int = 10, end: int = 19):
+        self.status_file = status_file
+        self.release = release
+        self.start = start
+        self.end = end
+        self.lock = threading.Lock()
+        self.files = 0
+        self.total_files = 0
+        self.bytes = 0
+        self.total_bytes = 0
+        self.written = 0.0
+
+    def write(self, description: str, state: str = "installing", progress: Optional[int] = None):
+        status = {"state": state, "progress": self.start if progress is None else progress, "description": description, "updateTo": self.release}
+        if self.total_files:
+            status.update({"files": self.files, "totalFiles": self.total_files, "bytes": self.bytes, "totalBytes": self.total_bytes})
+        _write_json(self.status_file, status)
+        self.written = time.monotonic()
+
+    def begin(self, total_files: int, total_bytes: int):
+        self.total_files = total_files
+        self.total_bytes = total_bytes
+        self._write_progress(force=True)
+
+    def advance(self, size: int, files: int):
+        with self.lock:
+            self.bytes += size
+            self.files += files
+            self._write_progress(force=False)
+
+    def _write_progress(self, force: bool):
+        if not force and time.monotonic() - self.written < status_interval:
+            return
+        done = self.bytes / self.total_bytes if self.total_bytes else 1
+        progress = self.start + int((self.end - self.start) * min(done, 1))
+        self.write("Downloading Citadel {}: {} of {} files, {:.1f} of {:.1f} MB".format(
+            self.release, self.files, self.total_files, self.bytes / 1e6, self.total_bytes / 1e6), progress=progress)
+
+    def finish(self):
+        with self.lock:
+            self._write_progress(force=True)
+
+class StageResult(NamedTuple):
+    plan: Plan
+    downloaded_files: int
+    downloaded_bytes: int
+
+# Get the changed files of a release from source and stage the release in staged_root
+def stage_release(node_root: str, release: str, source, staged_root: str, status: Optional[UpdateStatus] = None) -> StageResult:
+    store = ObjectStore(os.path.join(node_root, store_dir_name, "objects"))
+    plan = plan_update(source.manifest(release), node_root)
+    objects = plan.missing_objects(store)
+    total_bytes = sum(size for _, size in objects.values())
+    if status:
+        status.begin(len(objects), total_bytes)
+    source.fetch(objects, store, status.advance if status else lambda size, files: None)
+    if status:
+        status.finish()
+    _stage(node_root, plan, store, staged_root)
+    return StageResult(plan, len(objects), total_bytes)
+
+def _link_or_copy(source: str, destination: str):
+    try:
+        os.link(source, destination)
+    except OSError:
+        shutil.copy2(source, destination)
+
+# Build the complete release in staged_root, so the update scripts of the new release can run from it
+def _stage(node_root: str, plan: Plan, store: ObjectStore, staged_root: str):
+    manifest = plan.manifest
+    changed = set(plan.changed)
+    chmod = set(plan.chmod)
+    update_filter = manifest_filter(manifest)
+    if os.path.exists(staged_root):
+        shutil.rmtree(staged_root)
+    os.makedirs(staged_root)
+    for path, entry in manifest["files"].items():
+        if not update_filter.matches(path):
+            continue
+        destination = os.path.join(staged_root, path)
+        os.makedirs(os.path.dirname(destination), exist_ok=True)
+        if path in changed or path in chmod:
+            # Copies, so files with the same content never end up as links to the same file once installed,
+            # and the mode of the installed file stays as it is until the release is applied
+            shutil.copyfile(store.path(entry["sha256"]) if path in changed else os.path.join(node_root, path), destination)
+            os.chmod(destination, _file_mode(entry["executable"]))
+        else:
+            _link_or_copy(os.path.join(node_root, path), destination)
+    for path, target in manifest["links"].items():
+        if update_filter.matches(path):
+            destination = os.path.join(staged_root, path)
+            os.makedirs(os.path.dirname(destination), exist_ok=True)
+            os.symlink(target, destination)
+    _write_json(os.path.join(staged_root, staged_manifest_name), manifest, indent=1)
+
+def read_staged_manifest(staged_root: str) -> dict:
+    with open(os.path.join(staged_root, staged_manifest_name), "rb") as f:
+        return load_manifest(f.read())
+
+def _remove(path: str):
+    if os.path.isdir(path) and not os.path.islink(path):
+        shutil.rmtree(path)
+    elif os.path.lexists(path):
+        os.unlink(path)
+
+class ApplyResult(NamedTuple):
+    replaced: int
+    chmod: int
+    removed: int
+
+# Install the release staged in staged_root over node_root
+# Every changed file is written next to its destination first, then renamed over it, so no file is ever half-written.
+# If owner is set, it is the owner of the written files and created directories, nothing else is chowned.
+def apply_staged(node_root: str, staged_root: str, owner: Optional[Tuple[int, int]] = None) -> ApplyResult:
+    manifest = read_staged_manifest(staged_root)
+    plan = plan_update(manifest, node_root)
+
+    def make_dirs(directory: str):
+        missing = []
+        while not os.path.isdir(directory):
+            missing.append(directory)
+            directory = os.path.dirname(directory)
+        for directory in reversed(missing):
+            # A file where the release has a directory
+            if os.path.lexists(directory):
+                os.unlink(directory)
+            os.mkdir(directory)
+            if owner:
+                os.chown(directory, *owner)
+
+    def replace(path: str, write: Callable[[str], None]):
+        destination = os.path.join(node_root, path)
+        make_dirs(os.path.dirname(destination))
+        tmp = os.path.join(os.path.dirname(destination), ".{}.citadel-update".format(os.path.basename(destination)))
+        _remove(tmp)
+        write(tmp)
+        if owner:
+            os.chown(tmp, *owner, follow_symlinks=False)
+        # A directory where the release has a file
+        if os.path.isdir(destination) and not os.path.islink(destination):
+            shutil.rmtree(destination)
+        os.replace(tmp, destination)
+
+    for path in plan.removed:
+        _remove(os.path.join(node_root, path))
+    for path in plan.changed:
+        replace(path, lambda tmp: _link_or_copy(os.path.join(staged_root, path), tmp))
+    for path in plan.links:
+        replace(path, lambda tmp: os.symlink(manifest["links"][path], tmp))
+    for path in plan.chmod:
+        os.chmod(os.path.join(node_root, path), _file_mode(manifest["files"][path]["executable"]))
+    _remove_empty_dirs(node_root, plan)
+    return ApplyResult(len(plan.changed) + len(plan.links), len(plan.chmod), len(plan.removed))
+
+# Remove directories that only contained removed files, like rsync --delete, except for directories the release still has
+def _remove_empty_dirs(node_root: str, plan: Plan):
+    keep = set()
+    for path in list(plan.manifest["files"]) + list(plan.manifest["links"]):
+        while "/" in path:
+            path = path.rsplit("/", 1)[0]
+            keep.add(path)
+    candidates = set()
+    for path in plan.removed:
+        while "/" in path:
+            path = path.rsplit("/", 1)[0]
+            candidates.add(path)
+    for path in sorted(candidates, key=lambda path: path.count("/"), reverse=True):
+        if path in keep:
+            continue
+        try:
+            os.rmdir(os.path.join(node_root, path))
+        except OSError:
+            pass
@@ -0,0 +1,193 @@
+# SPDX-FileCopyrightText: 2023 Citadel and contributors
+#
+# SPDX-License-Identifier: GPL-3.0-or-later
+
+# The service configuration of the node: the main docker-compose.yml and services/installed.yml
+#
+# Both files are loaded once, all changes (selected service implementations, image pins) are applied in memory in one batch,
+# and save() writes each file only if its serialized content actually changed.
+# An unchanged docker-compose.yml is never rewritten, so docker compose doesn't have to re-evaluate the services.
+# The libyaml based loader and dumper are used if PyYAML was built with it.
+
+import copy
+import json
+import os
+import re
+from typing import Dict, List, Optional
+
+import yaml
+
+try:
+    from yaml import CDumper as Dumper
+    from yaml import CSafeLoader as SafeLoader
+except ImportError:
+    from yaml import Dumper, SafeLoader  # type: ignore
+
+# The services that are installed if services/installed.yml doesn't exist
+default_services = {"bitcoin": "core"}
+
+# The number of app Tor instances is managed by the app-manager (app/lib/torplacement.py), which stores it in db/tor-placement.json
+# The names, torrc files and addresses of the instances have to match what it uses
+tor_placement_version = 1
+builtin_app_tor_instances = 3
+
+def app_tor_instance_name(index: int) -> str:
+    return "app-tor" if index == 0 else "app-{}-tor".format(index + 1)
+
+def app_tor_torrc_name(index: int) -> str:
+    return "torrc-apps" if index == 0 else "torrc-apps-{}".format(index + 1)
+
+def app_tor_ip_var(index: int) -> str:
+    return "APPS_TOR_IP" if index == 0 else "APPS_{}_TOR_IP".format(index + 1)
+
+def is_app_tor_instance(name: str) -> bool:
+    return re.match(r"^app(-[0-9]+)?-tor$", name) is not None
+
+# The number of app Tor instances and the addresses of the ones that aren't in .env, or None if it was never changed
+def load_tor_placement(node_root: str) -> Optional[dict]:
+    try:
+        with open(os.path.join(node_root, "db", "tor-placement.json"), "r") as f:
+            state = json.load(f)
+    except (OSError, ValueError):
+        return None
+    return state if state.get("version") == tor_placement_version else None
+
+# The services of a compose file with the given number of app Tor instances, added instances are copies of app-tor
+# Instances that are in the file already are kept as they are, all of them are where app-tor is in the file
+def compose_app_tor_instances(services: dict, count: int, addresses: Dict[str, List[str]]) -> dict:
+    wanted = {}
+    for index in range(count):
+        name = app_tor_instance_name(index)
+        if name in services:
+            wanted[name] = services[name]
+            continue
+        definition = copy.deepcopy(services[app_tor_instance_name(0)])
+        definition["container_name"] = name
+        definition["volumes"] = ["${{PWD}}/tor/{}:/etc/tor/torrc".format(app_tor_torrc_name(index)) if volume.endswith(":/etc/tor/torrc") else volume
+                                 for volume in definition["volumes"]]
+        if index < builtin_app_tor_instances:
+            address = ["$" + app_tor_ip_var(index), "$" + app_tor_ip_var(index) + "6"]
+        else:
+            address = addresses[name]
+        definition["networks"] = {"default": {"ipv4_address": address[0], "ipv6_address": address[1]}}
+        wanted[name] = definition
+    result = {}
+    for name, definition in services.items():
+        if name == app_tor_instance_name(0):
+            result.update(wanted)
+        elif not is_app_tor_instance(name):
+            result[name] = definition
+    return result
+
+def load_yaml(file_path: str):
+    with open(file_path, "r") as f:
+        return yaml.load(f, Loader=SafeLoader)
+
+def dump_yaml(data) -> str:
+    return yaml.dump(data, Dumper=Dumper, sort_keys=False)
+
+# Write content to a file atomically, keeping the owner and permissions of the existing file
+# Returns False without touching the file if it already has this content
+def write_if_changed(file_path: str, content: str) -> bool:
+    try:
+        with open(file_path, "r") as f:
+            if f.read() == content:
+                return False
+        st: Optional[os.stat_result] = os.stat(file_path)
+    except FileNotFoundError:
+        st = None
+    tmp_file = "{}.{}.tmp".format(file_path, os.getpid())
+    try:
+        with open(tmp_file, "w") as f:
+            if st is not None:
+                os.fchown(f.fileno(), st.st_uid, st.st_gid)
+                os.fchmod(f.fileno(), st.st_mode & 0o7777)
+            f.write(content)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp_file, file_path)
+    except BaseException:
+        try:
+            os.remove(tmp_file)
+        except OSError:
+            pass
+        raise
+    return True
+
+class ServiceConfig:
+    def __init__(self, node_root: str):
+        self.node_root = node_root
+        self.services_dir = os.path.join(node_root, "services")
+        self.compose_file = os.path.join(node_root, "docker-compose.yml")
+        self.installed_file = os.path.join(self.services_dir, "installed.yml")
+        self.compose = load_yaml(self.compose_file)
+        try:
+            self.installed: Dict[str, str] = load_yaml(self.installed_file)
+        except FileNotFoundError:
+            self.installed = dict(default_services)
+
+    def available_services(self) -> List[str]:
+        return sorted(entry.name for entry in os.scandir(self.services_dir) if entry.is_dir())
+
+    def available_implementations(self, name: str) -> List[str]:
+        try:
+            return sorted(entry.name.split(".")[0] for entry in os.scandir(os.path.join(self.services_dir, name)) if entry.is_file())
+        except FileNotFoundError:
+            return []
+
+    # Add a service implementation (services/<name>/<implementation>.yml) to the main compose file
+    # Raises a ValueError if the service or implementation doesn't exist
+    def set_service(self, name: str, implementation: str):
+        if name not in self.available_services():
+            raise ValueError("\"{}\" is not a valid service.".format(name))
+        if implementation not in self.available_implementations(name):
+            raise ValueError("\"{}\" is not a valid implementation.".format(implementation))
+        self.compose["services"].update(load_yaml(os.path.join(self.services_dir, name, implementation + ".yml")))
+        self.installed[name] = implementation
+
+    # Remove a service from the main compose file
+    # Raises a ValueError if there's no definition of the service, to avoid removing core services
+    def uninstall_service(self, name: str):
+        if not os.path.isdir(os.path.join(self.services_dir, name)):
+            raise ValueError("Service definition not found, cannot uninstall")
+        self.compose["services"].pop(name, None)
+        self.installed.pop(name, None)
+
+    # Add or remove app Tor instances, as set with "app-manager.py tor-scale" (which is stored in db/tor-placement.json)
+    # Without a state, the instances of docker-compose.yml are kept as they are
+    def set_app_tor_instances(self):
+        state = load_tor_placement(self.node_root)
+        if state is None:
+            return
+        self.compose["services"] = compose_app_tor_instances(self.compose["services"], state["instances"], state["addresses"])
+
+    # The app Tor instances in the main compose file
+    def app_tor_instances(self) -> List[str]:
+        return [name for name in self.compose["services"] if is_app_tor_instance(name)]
+
+    # Apply all service selections of installed.yml, and the number of app Tor instances
+    def apply(self):
+        self.set_app_tor_instances()
+        for name, implementation in list(self.installed.items()):
+            self.set_service(name, implementation)
+
+    # Set the images of services, as a dict of service -> image
+    def pin_images(self, images: Dict[str, str]):
+        for service, image in images.items():
+            self.compose["services"][service]["image"] = image
+
+    # Write all files that changed, returns the paths of the files that were written
+    def save(self) -> List[str]:
+        changed = []
+        if write_if_changed(self.compose_file, dump_yaml(self.compose)):
+            changed.append(self.compose_file)
+        if write_if_changed(self.installed_file, dump_yaml(self.installed)):
+            changed.append(self.installed_file)
+        return changed
+
+# The images of the core services, as pinned in db/dependencies.yml
+def core_images(dependencies: dict, app_tor_instances: List[str]) -> Dict[str, str]:
+    images = {service: dependencies[service] for service in ["manager", "dashboard"]}
+    for service in ["tor"] + app_tor_instances:
+        images[service] = dependencies["tor"]
+    return images
@@ -0,0 +1,161 @@
+# SPDX-FileCopyrightText: 2023 Citadel and contributors
+#
+# SPDX-License-Identifier: GPL-3.0-or-later
+
+# The status service: runs all status collectors from a single long-running process
+#
+# Every collector runs on its own interval (with some jitter, so they don't all fire at once).
+# If a collector is still running when its next tick comes, that tick is skipped.
+# Status files are written atomically, so the dashboard never reads a half-written file.
+
+import asyncio
+import glob
+import json
+import os
+import random
+import shutil
+import subprocess
+import time
+from typing import Callable, Dict, List, Optional
+
+from lib.history import MetricHistory, usage_samples
+from lib.memory import CgroupMemory, list_containers, memory_status
+from lib.storage import StorageAccountant, storage_status
+
+# Write a file by writing to a temporary file in the same directory and renaming it over the target
+def write_atomic(file_path: str, content: str):
+    tmp_file = "{}.{}.tmp".format(file_path, os.getpid())
+    try:
+        with open(tmp_file, "w") as f:
+            f.write(content)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp_file, file_path)
+    except BaseException:
+        try:
+            os.remove(tmp_file)
+        except OSError:
+            pass
+        raise
+
+class Collector:
+    # record is called with the output of every successful run, to keep a history of it
+    def __init__(self, name: str, interval: float, collect: Callable[[], str], record: Optional[Callable[[str], None]] = None):
+        self.name = name
+        self.interval = interval
+        self.collect = collect
+        self.record = record
+        self.runs = 0
+        self.failures = 0
+        self.skipped = 0
+        self.last_duration: Optional[float] = None
+        self.last_success: Optional[float] = None
+        self.last_error: Optional[str] = None
+        self.task: Optional[asyncio.Future] = None
+
+    def metrics(self) -> dict:
+        return {
+            "interval": self.interval,
+            "running": self.task is not None and not self.task.done(),
+            "runs": self.runs,
+            "failures": self.failures,
+            "skipped": self.skipped,
+            "lastDuration": self.last_duration,
+            "lastSuccess": self.last_success,
+            "lastError": self.last_error,
+        }
+
+class StatusService:
+    def __init__(self, status_dir: str, collectors: List[Collector], jitter: float = 0.1):
+        self.status_dir = status_dir
+        self.collectors = collectors
+        self.jitter = jitter
+        self.metrics_file = os.path.join(status_dir, "status-monitor.json")
+
+    def write_metrics(self):
+        metrics: Dict[str, dict] = {collector.name: collector.metrics() for collector in self.collectors}
+        try:
+            write_atomic(self.metrics_file, json.dumps(metrics, indent=2) + "\n")
+        except OSError as e:
+            print("Failed to write {}: {}".format(self.metrics_file, e))
+
+    async def run_once(self, collector: Collector):
+        loop = asyncio.get_running_loop()
+        start = time.monotonic()
+        collector.runs += 1
+        try:
+            # Collectors block on file and subprocess I/O, so run them outside the event loop
+            output = await loop.run_in_executor(None, collector.collect)
+            write_atomic(os.path.join(self.status_dir, "{}-status.json".format(collector.name)), output)
+            collector.last_success = time.time()
+            collector.last_error = None
+        except Exception as e:
+            collector.failures += 1
+            collector.last_error = str(e)
+            print("Status collector {} failed: {}".format(collector.name, e))
+        else:
+            if collector.record is not None:
+                try:
+                    collector.record(output)
+                except Exception as e:
+                    print("Failed to record the history of {}: {}".format(collector.name, e))
+        collector.last_duration = time.monotonic() - start
+        self.write_metrics()
+
+    async def schedule(self, collector: Collector):
+        while True:
+            if collector.task is not None and not collector.task.done():
+                collector.skipped += 1
+            else:
+                collector.task = asyncio.ensure_future(self.run_once(collector))
+            await asyncio.sleep(collector.interval * (1 + random.uniform(0, self.jitter)))
+
+    async def run(self):
+        await asyncio.gather(*[self.schedule(collector) for collector in self.collectors])
+
+
+##########################################################
+####################### Collectors #######################
+##########################################################
+
+def collect_uptime() -> str:
+    with open("/proc/uptime", "r") as f:
+        return "{}\n".format(int(float(f.read().split()[0])))
+
+def collect_temperature() -> str:
+    # If vcgencmd is available, use it to get the temperature
+    if shutil.which("vcgencmd"):
+        output = subprocess.check_output(["vcgencmd", "measure_temp"]).decode("utf-8")
+        return "{}\n".format(output.strip().split("=")[1].split(".")[0])
+    for name_file in sorted(glob.glob("/sys/class/hwmon/hwmon*/name")):
+        with open(name_file, "r") as f:
+            if f.read().strip() != "coretemp":
+                continue
+        inputs = sorted(glob.glob(os.path.join(os.path.dirname(name_file), "temp*_input")))
+        if inputs:
+            with open(inputs[0], "r") as f:
+                return "{}\n".format(int(f.read().strip()) // 1000)
+    with open("/sys/class/thermal/thermal_zone0/temp", "r") as f:
+        return "{}\n".format(int(f.read().strip()) // 1000)
+
+# Run a status script from scripts/status and return its output
+def script_collector(node_root: str, name: str) -> Callable[[], str]:
+    def collect() -> str:
+        return subprocess.check_output([os.path.join(node_root, "scripts", "status", name)]).decode("utf-8")
+    return collect
+
+def default_collectors(node_root: str) -> List[Collector]:
+    cgroups = CgroupMemory()
+    # Keep the storage accountant in memory, so its cache doesn't have to be loaded on every run
+    accountant = StorageAccountant(os.path.join(node_root, "db", "storage-cache"))
+    history = MetricHistory(os.path.join(node_root, "db", "history"))
+    history.prune()
+    return [
+        Collector("memory", 300, lambda: json.dumps(memory_status(node_root, list_containers(), cgroups), indent=2) + "\n",
+                  lambda output: history.append(usage_samples("memory", json.loads(output)))),
+        Collector("storage", 60, lambda: json.dumps(storage_status(node_root, accountant), indent=2) + "\n",
+                  lambda output: history.append(usage_samples("storage", json.loads(output)))),
+        Collector("temperature", 15, collect_temperature, lambda output: history.append({"temperature": int(output)})),
+        Collector("uptime", 15, collect_uptime, lambda output: history.append({"uptime": int(output)})),
+        Collector("app-updates", 1800, script_collector(node_root, "app-updates")),
+    ]
@@ -0,0 +1,159 @@
+# SPDX-FileCopyrightText: 2023 Citadel and contributors
+#
+# SPDX-License-Identifier: GPL-3.0-or-later
+
+# Storage usage of the node and its apps
+#
+# Instead of running "du" over every app's data dir, the size of every directory's own entries is cached together
+# with the directory's mtime. A directory's mtime changes when entries are added, removed or renamed,
+# so on later scans unchanged directories are not listed again, only stat()ed.
+# Files that grow in place don't change their directory's mtime, so a full rescan still happens on a slow cadence.
+
+import marshal
+import os
+import stat
+import time
+from typing import Dict, List, Optional, Tuple
+
+from lib.apps import installed_apps
+
+# Bump this if the layout of the cache changes
+cache_version = 1
+
+# Do a full rescan of everything at least this often (in seconds)
+default_full_scan_interval = 6 * 60 * 60
+
+# Path -> (mtime_ns, bytes used by the directory itself and its non-directory entries, names of subdirectories)
+DirCache = Dict[str, Tuple[int, int, List[str]]]
+
+class StorageAccountant:
+    def __init__(self, cache_file: Optional[str] = None, full_scan_interval: int = default_full_scan_interval):
+        self.cache_file = cache_file
+        self.full_scan_interval = full_scan_interval
+        self.dirs: DirCache = {}
+        self.last_full_scan = 0.0
+        # Statistics about the last scan
+        self.dirs_listed = 0
+        self.dirs_reused = 0
+        self._load()
+
+    def _load(self):
+        if not self.cache_file:
+            return
+        try:
+            with open(self.cache_file, "rb") as f:
+                cache = marshal.load(f)
+        except (OSError, EOFError, ValueError, TypeError):
+            return
+        if isinstance(cache, dict) and cache.get("version") == cache_version:
+            self.dirs = cache["dirs"]
+            self.last_full_scan = cache["last_full_scan"]
+
+    # Write the cache atomically
+    def save(self):
+        if not self.cache_file:
+            return
+        tmp_file = "{}.{}.tmp".format(self.cache_file, os.getpid())
+        try:
+            with open(tmp_file, "wb") as f:
+                marshal.dump({"version": cache_version, "last_full_scan": self.last_full_scan, "dirs": self.dirs}, f)
+            os.replace(tmp_file, self.cache_file)
+        except OSError:
+            try:
+                os.remove(tmp_file)
+            except OSError:
+                pass
+
+    # Get the disk usage of multiple directories in bytes, like "du --block-size=1 --max-depth=0" for each of them
+    # If full is None, a full rescan is done if the last one is older than the full scan interval
+    def scan(self, directories: List[str], full: Optional[bool] = None) -> Dict[str, int]:
+        now = time.time()
+        if full is None:
+            full = now - self.last_full_scan >= self.full_scan_interval
+        self.dirs_listed = 0
+        self.dirs_reused = 0
+        new_dirs: DirCache = {}
+        sizes = {}
+        for directory in directories:
+            sizes[directory] = self._scan_tree(directory, full, new_dirs)
+        # Only keep directories that still exist. On other scans, cached entries of other directories are kept
+        # so scanning a subset of the apps doesn't throw away the cache of the others. A full scan covers
+        # everything that is still wanted, so it drops them, like the trees of apps that were uninstalled.
+        if not full:
+            prefixes = tuple(os.path.join(directory, "") for directory in directories)
+            for path, entry in self.dirs.items():
+                if path not in new_dirs and path not in directories and not path.startswith(prefixes):
+                    new_dirs[path] = entry
+        self.dirs = new_dirs
+        if full:
+            self.last_full_scan = now
+        return sizes
+
+    def _scan_tree(self, root: str, full: bool, new_dirs: DirCache) -> int:
+        try:
+            root_stat = os.lstat(root)
+        except OSError:
+            return 0
+        if not stat.S_ISDIR(root_stat.st_mode):
+            return root_stat.st_blocks * 512
+        total = 0
+        stack = [(root, root_stat)]
+        while stack:
+            path, dir_stat = stack.pop()
+            cached = None if full else self.dirs.get(path)
+            if cached is not None and cached[0] == dir_stat.st_mtime_ns:
+                self.dirs_reused += 1
+                own_size, subdirs = cached[1], cached[2]
+                for name in subdirs:
+                    subdir = os.path.join(path, name)
+                    try:
+                        subdir_stat = os.lstat(subdir)
+                    except OSError:
+                        continue
+                    if stat.S_ISDIR(subdir_stat.st_mode):
+                        stack.append((subdir, subdir_stat))
+            else:
+                self.dirs_listed += 1
+                own_size = dir_stat.st_blocks * 512
+                subdirs = []
+                try:
+                    with os.scandir(path) as entries:
+                        for entry in entries:
+                            try:
+                                entry_stat = entry.stat(follow_symlinks=False)
+                            except OSError:
+                                continue
+                            if stat.S_ISDIR(entry_stat.st_mode):
+                                subdirs.append(entry.name)
+                                stack.append((entry.path, entry_stat))
+                            else:
+                                own_size += entry_stat.st_blocks * 512
+                except OSError:
+                    pass
+            new_dirs[path] = (dir_stat.st_mtime_ns, own_size, subdirs)
+            total += own_size
+        return total
+
+# Size and used bytes of the filesystem a path is on, like the "size" and "used" columns of "df"
+def filesystem_usage(path: str):
+    st = os.statvfs(path)
+    return st.f_blocks * st.f_frsize, (st.f_blocks - st.f_bfree) * st.f_frsize
+
+# Build the contents of statuses/storage-status.json
+def storage_status(node_root: str, accountant: StorageAccountant) -> dict:
+    total, used = filesystem_usage(node_root)
+    apps = installed_apps(node_root)
+    app_data_dir = os.path.join(node_root, "app-data")
+    # Data of uninstalled apps that the reaper hasn't deleted yet
+    trash_dir = os.path.join(app_data_dir, ".trash")
+    sizes = accountant.scan([os.path.join(app_data_dir, app) for app in apps] + [trash_dir])
+    accountant.save()
+    breakdown = []
+    cumulative_app_size = 0
+    for app in apps:
+        app_size = sizes[os.path.join(app_data_dir, app)]
+        cumulative_app_size += app_size
+        breakdown.append({"id": app, "used": app_size})
+    breakdown.append({"id": "citadel", "used": used - cumulative_app_size - sizes[trash_dir]})
+    breakdown.sort(key=lambda entry: -entry["used"])
+    return {"total": total, "used": used, "pendingDeletion": sizes[trash_dir], "breakdown": breakdown}
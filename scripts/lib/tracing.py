@@ -0,0 +1,331 @@
+# SPDX-FileCopyrightText: 2023 Citadel and contributors
+#
+# SPDX-License-Identifier: GPL-3.0-or-later
+
+# Tracing for scripts (configure and karen), and summaries of the recorded traces for "citadel trace"
+#
+# This writes the same spans to the same file as app/lib/tracing.py does for the app-manager, and passes the trace
+# to subprocesses the same way, so an app-manager call made by karen or configure becomes part of their trace.
+# Both are kept in sync by test_implementations_match in tests/test_tracing.py, change them together.
+# Tracing is off unless db/tracing exists or CITADEL_TRACE=1 is set, then span() only returns a shared no-op.
+#
+# start_trace() replaces subprocess.call, subprocess.run, subprocess.check_call, subprocess.check_output and os.system
+# for the whole process, including other modules that imported subprocess, so every command run while tracing gets a span.
+# Code that did "from subprocess import run" before start_trace() keeps the original function and isn't timed.
+
+import atexit
+import fcntl
+import json
+import os
+import statistics
+import subprocess
+import sys
+import threading
+import time
+from typing import Any, Dict, List, Optional
+
+# Spans are written to this file in logs/
+trace_file_name = "trace.ndjson"
+# Rotate the trace file once it is this big, and keep this many rotated files
+max_trace_file_size = 4 * 1024 * 1024
+kept_trace_files = 2
+# Spans are written in batches of this size, and when the process exits
+flush_threshold = 64
+# Longer subprocess commands are shortened in spans
+max_command_length = 160
+
+class NoopSpan:
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, traceback):
+        return False
+
+    def set(self, **attributes):
+        pass
+
+    def end(self, **attributes):
+        pass
+
+noop_span = NoopSpan()
+
+class Span:
+    def __init__(self, tracer: "Tracer", name: str, parent: Optional[str], attributes: Dict[str, Any]):
+        self.tracer = tracer
+        self.name = name
+        self.id = tracer.new_id()
+        self.parent = parent
+        self.attributes = attributes
+        self.start = time.time()
+        self.start_counter = time.perf_counter()
+        self.ended = False
+
+    def set(self, **attributes):
+        self.attributes.update(attributes)
+
+    def end(self, **attributes):
+        if self.ended:
+            return
+        self.ended = True
+        self.attributes.update(attributes)
+        self.tracer.record(self, (time.perf_counter() - self.start_counter) * 1000)
+
+    def __enter__(self):
+        self.tracer.push(self)
+        return self
+
+    def __exit__(self, exc_type, exc, traceback):
+        self.tracer.pop(self)
+        if exc_type is not None and not (exc_type is SystemExit and exc.code in [None, 0]):
+            self.attributes["error"] = "{}: {}".format(exc_type.__name__, exc)
+        self.end()
+        return False
+
+class Tracer:
+    def __init__(self, node_root: str, component: str, trace_id: Optional[str], parent: Optional[str]):
+        self.path = os.path.join(node_root, "logs", trace_file_name)
+        self.component = component
+        self.trace_id = trace_id or os.urandom(8).hex()
+        # The span of the parent process this process was started in
+        self.parent = parent
+        self.root: Optional[Span] = None
+        self.subprocesses = 0
+        self.buffer: List[str] = []
+        self.lock = threading.Lock()
+        self.local = threading.local()
+
+    def new_id(self) -> str:
+        return os.urandom(4).hex()
+
+    # The innermost span that is open in this thread, spans opened in other threads are children of the root span
+    def current(self) -> Optional[str]:
+        stack = getattr(self.local, "stack", None)
+        if stack:
+            return stack[-1].id
+        return self.root.id if self.root else self.parent
+
+    def push(self, span: Span):
+        if not hasattr(self.local, "stack"):
+            self.local.stack = []
+        self.local.stack.append(span)
+
+    def pop(self, span: Span):
+        stack = getattr(self.local, "stack", [])
+        if stack and stack[-1] is span:
+            stack.pop()
+
+    def span(self, name: str, attributes: Dict[str, Any]) -> Span:
+        return Span(self, name, self.current(), attributes)
+
+    def record(self, span: Span, duration_ms: float):
+        entry = {"trace": self.trace_id, "span": span.id, "parent": span.parent, "component": self.component,
+                 "name": span.name, "start": round(span.start, 3), "durationMs": round(duration_ms, 2), "pid": os.getpid()}
+        if span.attributes:
+            entry["attributes"] = span.attributes
+        line = json.dumps(entry, default=str)
+        with self.lock:
+            self.buffer.append(line)
+            full = len(self.buffer) >= flush_threshold
+        if full or span is self.root:
+            self.flush()
+
+    def flush(self):
+        with self.lock:
+            lines, self.buffer = self.buffer, []
+        if lines:
+            try:
+                append_rotated(self.path, ("\n".join(lines) + "\n").encode("utf-8"))
+            except OSError:
+                pass
+
+# Append data to a file, rotating it first if it would get bigger than max_size
+# The file is locked while it is written, so concurrent processes neither interleave lines nor rotate it twice
+def append_rotated(path: str, data: bytes, max_size: int = max_trace_file_size, kept: int = kept_trace_files):
+    fd = os.open(path, os.O_WRONLY | os.O_APPEND | os.O_CREAT, 0o600)
+    try:
+        fcntl.flock(fd, fcntl.LOCK_EX)
+        st = os.fstat(fd)
+        if st.st_size and st.st_size + len(data) > max_size:
+            try:
+                rotated = os.stat(path).st_ino != st.st_ino
+            except FileNotFoundError:
+                rotated = True
+            # Only rotate if another process didn't already do that while this one waited for the lock
+            if not rotated:
+                for i in range(kept - 1, 0, -1):
+                    if os.path.exists("{}.{}".format(path, i)):
+                        os.replace("{}.{}".format(path, i), "{}.{}".format(path, i + 1))
+                os.replace(path, "{}.1".format(path))
+            os.close(fd)
+            fd = os.open(path, os.O_WRONLY | os.O_APPEND | os.O_CREAT, 0o600)
+            fcntl.flock(fd, fcntl.LOCK_EX)
+        os.write(fd, data)
+    finally:
+        os.close(fd)
+
+_tracer: Optional[Tracer] = None
+
+def is_enabled(node_root: str) -> bool:
+    setting = os.environ.get("CITADEL_TRACE")
+    if setting is not None:
+        return setting == "1"
+    return os.path.exists(os.path.join(node_root, "db", "tracing"))
+
+# Start tracing this process, the returned root span ends when the process exits
+# If tracing is disabled, this returns a no-op and span() stays a no-op
+def start_trace(node_root: str, component: str, name: str, **attributes):
+    global _tracer
+    if _tracer is not None:
+        return _tracer.root
+    if not is_enabled(node_root):
+        return noop_span
+    _tracer = Tracer(node_root, component, os.environ.get("CITADEL_TRACE_ID"), os.environ.get("CITADEL_TRACE_PARENT"))
+    _tracer.root = _tracer.span(name, attributes)
+    # Subprocesses (like app-manager called by configure) add their spans to this trace
+    os.environ["CITADEL_TRACE"] = "1"
+    os.environ["CITADEL_TRACE_ID"] = _tracer.trace_id
+    os.environ["CITADEL_TRACE_PARENT"] = _tracer.root.id
+    _instrument_subprocesses()
+    atexit.register(_finish)
+    return _tracer.root
+
+# Start a separate trace for one operation of a long-running process, like a job of karen
+# Returns the operation's span, which has to be ended, and the environment to pass to the operation's subprocesses
+def start_operation(node_root: str, component: str, name: str, **attributes):
+    if not is_enabled(node_root):
+        return noop_span, {}
+    tracer = Tracer(node_root, component, None, None)
+    tracer.root = tracer.span(name, attributes)
+    return tracer.root, {"CITADEL_TRACE": "1", "CITADEL_TRACE_ID": tracer.trace_id, "CITADEL_TRACE_PARENT": tracer.root.id}
+
+def _finish():
+    if _tracer is None or _tracer.root is None:
+        return
+    _tracer.root.end(subprocesses=_tracer.subprocesses)
+    _tracer.flush()
+
+# Time a phase of the current operation
+def span(name: str, **attributes):
+    if _tracer is None:
+        return noop_span
+    return _tracer.span(name, attributes)
+
+def _describe(command) -> str:
+    if isinstance(command, (list, tuple)):
+        command = " ".join(str(part) for part in command)
+    command = str(command)
+    return command if len(command) <= max_command_length else command[:max_command_length - 3] + "..."
+
+# Count all subprocesses, and time the ones run by os.system() and the subprocess helpers that wait for them
+def _instrument_subprocesses():
+    local = threading.local()
+
+    def count_spawns(event, args):
+        if event in ["subprocess.Popen", "os.system"] and _tracer is not None:
+            _tracer.subprocesses += 1
+
+    def timed(function, exit_code):
+        def wrapper(command, *args, **kwargs):
+            # subprocess.check_output() calls subprocess.run(), only time the outer call
+            if getattr(local, "active", False):
+                return function(command, *args, **kwargs)
+            local.active = True
+            main_thread = threading.current_thread() is threading.main_thread()
+            parent = os.environ.get("CITADEL_TRACE_PARENT")
+            try:
+                with span("subprocess", command=_describe(command)) as subprocess_span:
+                    # Spans of the subprocess become children of this span, other threads' subprocesses are children of the root span
+                    if main_thread:
+                        os.environ["CITADEL_TRACE_PARENT"] = subprocess_span.id
+                    result = function(command, *args, **kwargs)
+                    code = exit_code(result)
+                    if code is not None:
+                        subprocess_span.set(exitCode=code)
+                    return result
+            finally:
+                local.active = False
+                if main_thread and parent is not None:
+                    os.environ["CITADEL_TRACE_PARENT"] = parent
+        return wrapper
+
+    sys.addaudithook(count_spawns)
+    os.system = timed(os.system, lambda status: os.waitstatus_to_exitcode(status) if status >= 0 else status)
+    subprocess.call = timed(subprocess.call, lambda code: code)
+    subprocess.run = timed(subprocess.run, lambda process: process.returncode)
+    subprocess.check_call = timed(subprocess.check_call, lambda code: code)
+    subprocess.check_output = timed(subprocess.check_output, lambda output: 0)
+
+# Time the phases of a script that runs one after another, each phase ends when the next one starts
+class Phases:
+    def __init__(self):
+        self.current = None
+
+    def start(self, name: str, **attributes):
+        self.end()
+        self.current = span(name, **attributes)
+        self.current.__enter__()
+
+    def end(self):
+        if self.current is not None:
+            self.current.__exit__(None, None, None)
+            self.current = None
+
+# Read all spans from logs/trace.ndjson and its rotated files, oldest first
+def read_spans(node_root: str) -> List[dict]:
+    path = os.path.join(node_root, "logs", trace_file_name)
+    spans = []
+    for file_path in ["{}.{}".format(path, i) for i in range(kept_trace_files, 0, -1)] + [path]:
+        try:
+            with open(file_path, "r") as f:
+                for line in f:
+                    try:
+                        spans.append(json.loads(line))
+                    except ValueError:
+                        # A line may have been cut off by a crash
+                        continue
+        except FileNotFoundError:
+            continue
+    return spans
+
+# Group spans by trace, a trace's operation is its span without a parent
+# Returns the most recent operations first, each with its spans
+def group_traces(spans: List[dict]) -> List[dict]:
+    traces: Dict[str, dict] = {}
+    for entry in spans:
+        trace = traces.setdefault(entry["trace"], {"id": entry["trace"], "root": None, "spans": []})
+        trace["spans"].append(entry)
+        if entry.get("parent") is None:
+            trace["root"] = entry
+    operations = [trace for trace in traces.values() if trace["root"] is not None]
+    operations.sort(key=lambda trace: -trace["root"]["start"])
+    return operations
+
+# Summarize the most recent operations: their slowest phases, and statistics per phase over all of them
+def summarize(spans: List[dict], operations: int = 10, top: int = 5, name: Optional[str] = None) -> dict:
+    traces = group_traces(spans)
+    if name:
+        traces = [trace for trace in traces if name in trace["root"]["name"]]
+    traces = traces[:operations]
+    summary = {"operations": [], "phases": []}
+    durations: Dict[str, List[float]] = {}
+    for trace in traces:
+        root = trace["root"]
+        phases = [entry for entry in trace["spans"] if entry is not root]
+        for entry in phases:
+            durations.setdefault(entry["name"], []).append(entry["durationMs"])
+        phases.sort(key=lambda entry: -entry["durationMs"])
+        summary["operations"].append({
+            "name": root["name"],
+            "start": root["start"],
+            "durationMs": root["durationMs"],
+            # Every process of the operation records how many subprocesses it started in its first span
+            "subprocesses": sum(entry.get("attributes", {}).get("subprocesses", 0) for entry in trace["spans"]),
+            "error": root.get("attributes", {}).get("error"),
+            "slowest": [{"name": entry["name"], "component": entry["component"], "durationMs": entry["durationMs"],
+                         "attributes": entry.get("attributes", {})} for entry in phases[:top]],
+        })
+    for phase, values in durations.items():
+        summary["phases"].append({"name": phase, "count": len(values), "totalMs": round(sum(values), 2),
+                                  "medianMs": round(statistics.median(values), 2), "maxMs": round(max(values), 2)})
+    summary["phases"].sort(key=lambda entry: -entry["totalMs"])
+    return summary
@@ -82,17 +82,23 @@ EOF
 
 # Overlay home dir structure with new dir tree
 echo "Overlaying $CITADEL_ROOT/ with new directory tree"
-rsync --archive \
-    --verbose \
-    --include-from="$CITADEL_ROOT/.citadel-$RELEASE/scripts/update/.updateinclude" \
-    --exclude-from="$CITADEL_ROOT/.citadel-$RELEASE/scripts/update/.updateignore" \
-    --delete \
-    "$CITADEL_ROOT"/.citadel-"$RELEASE"/ \
-    "$CITADEL_ROOT"/
-
-# Fix permissions
-echo "Fixing permissions"
-find "$CITADEL_ROOT" -path "$CITADEL_ROOT/app-data" -prune -o -exec chown 1000:1000 {} + || true
+if [[ -f "$CITADEL_ROOT/.citadel-$RELEASE/.citadel-manifest.json" ]]; then
+    # Staged by scripts/update/ota: only the changed files are replaced (with renames) and chowned
+    "$CITADEL_ROOT/.citadel-$RELEASE/scripts/update/ota" apply "$CITADEL_ROOT/.citadel-$RELEASE" "$CITADEL_ROOT"
+else
+    # A full copy of the release, from the update script of an older release
+    rsync --archive \
+        --verbose \
+        --include-from="$CITADEL_ROOT/.citadel-$RELEASE/scripts/update/.updateinclude" \
+        --exclude-from="$CITADEL_ROOT/.citadel-$RELEASE/scripts/update/.updateignore" \
+        --delete \
+        "$CITADEL_ROOT"/.citadel-"$RELEASE"/ \
+        "$CITADEL_ROOT"/
+
+    # Fix permissions
+    echo "Fixing permissions"
+    find "$CITADEL_ROOT" -path "$CITADEL_ROOT/app-data" -prune -o -exec chown 1000:1000 {} + || true
+fi
 chmod -R 700 "$CITADEL_ROOT"/tor/data/* || true
 
 # Start updated containers
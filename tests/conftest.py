@@ -0,0 +1,17 @@
+# SPDX-FileCopyrightText: 2023 Citadel and contributors
+#
+# SPDX-License-Identifier: GPL-3.0-or-later
+
+import pytest
+
+from trees import use_tree
+
+# Modules imported lazily inside functions of app/lib or scripts/lib have to come from the tree the test is for
+@pytest.fixture(autouse=True)
+def _lib_tree(request):
+    tree = getattr(request.module, "tree", None)
+    if tree is None:
+        yield
+        return
+    with use_tree(tree):
+        yield
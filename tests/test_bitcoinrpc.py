@@ -0,0 +1,213 @@
+# SPDX-FileCopyrightText: 2023 Citadel and contributors
+#
+# SPDX-License-Identifier: GPL-3.0-or-later
+
+# The Bitcoin RPC client and scripts/bitcoin-rpc against a stub JSON-RPC server that answers like bitcoind
+
+import base64
+import json
+import os
+import re
+import shutil
+import socket
+import subprocess
+import threading
+from decimal import Decimal
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import pytest
+
+from trees import load, repo_root
+
+tree = "scripts"
+bitcoinrpc = load("scripts", "bitcoinrpc")
+
+user, password = "citadel", "test"
+
+# bitcoind writes amounts with all 8 decimals, which json.dumps doesn't, so they are marked and written as they are
+def amount(value: str) -> str:
+    return "amount:" + value
+
+def dumps(response) -> bytes:
+    return re.sub(r'"amount:([0-9.]+)"', r"\1", json.dumps(response)).encode()
+
+results = {
+    "getblockcount": 812345,
+    "getbestblockhash": "00000000000000000002a7c4c1e48d76c5a37902165a270156b7a8d72728a054",
+    "getmempoolinfo": {"loaded": True, "size": 5123, "total_fee": amount("0.51234567"), "mempoolminfee": amount("0.00001000")},
+    "getblockhash": "000000000000000000026c3b8dcb6c1d0f6e0bdc5a2e4a1ba7ed1d1e2c3b4a59",
+}
+
+def answer(request: dict) -> dict:
+    if request["method"] not in results:
+        return {"result": None, "error": {"code": -32601, "message": "Method not found"}, "id": request["id"]}
+    return {"result": results[request["method"]], "error": None, "id": request["id"]}
+
+class StubServer(ThreadingHTTPServer):
+    daemon_threads = True
+
+    def __init__(self):
+        super().__init__(("127.0.0.1", 0), StubHandler)
+        self.connections = 0
+        self.requests = []
+        # Close connections after answering, without telling the client, like bitcoind does with idle connections
+        self.drop_connections = False
+
+class StubHandler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+
+    def setup(self):
+        super().setup()
+        self.server.connections += 1
+
+    def do_POST(self):
+        body = self.rfile.read(int(self.headers["Content-Length"]))
+        if self.headers.get("Authorization") != "Basic " + base64.b64encode("{}:{}".format(user, password).encode()).decode():
+            self.send_response(401)
+            self.send_header("Content-Length", "0")
+            self.end_headers()
+            return
+        request = json.loads(body)
+        self.server.requests.append(request)
+        response = [answer(entry) for entry in request] if isinstance(request, list) else answer(request)
+        status = 200 if isinstance(response, list) or response["error"] is None else 404
+        data = dumps(response)
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+        if self.server.drop_connections:
+            self.close_connection = True
+
+    def log_message(self, format, *args):
+        pass
+
+@pytest.fixture
+def server():
+    server = StubServer()
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    yield server
+    server.shutdown()
+    server.server_close()
+
+def client(server, **kwargs) -> "bitcoinrpc.BitcoinRPC":
+    return bitcoinrpc.BitcoinRPC("127.0.0.1", server.server_address[1], user, password, **kwargs)
+
+def test_keep_alive(server):
+    rpc = client(server)
+    for _ in range(10):
+        assert rpc.call("getblockcount") == 812345
+    assert rpc.call("getblockhash", 800000) == results["getblockhash"]
+    assert server.connections == 1
+    assert server.requests[-1]["params"] == [800000]
+    rpc.close()
+
+def test_pool_size(server):
+    rpc = client(server, pool_size=2)
+    connections = [rpc._connect() for _ in range(3)]
+    for connection in connections:
+        rpc._release(connection)
+    # The pool only keeps two of them, the third one is closed
+    assert rpc.pool.qsize() == 2
+    assert connections[2].sock is None
+    rpc.close()
+    assert rpc.pool.empty()
+
+def test_stale_connection_is_replaced(server):
+    rpc = client(server)
+    assert rpc.call("getblockcount") == 812345
+    server.drop_connections = True
+    for _ in range(3):
+        assert rpc.call("getbestblockhash") == results["getbestblockhash"]
+    assert len(server.requests) == 4
+    rpc.close()
+
+def test_errors(server):
+    rpc = client(server)
+    assert rpc.call("getmempoolinfo")["total_fee"] == Decimal("0.51234567")
+    with pytest.raises(bitcoinrpc.RPCError) as error:
+        rpc.call("stop")
+    assert error.value.code == -32601
+    # The connection is still usable after an error
+    assert rpc.call("getblockcount") == 812345
+    assert server.connections == 1
+    with pytest.raises(bitcoinrpc.ConnectionFailed):
+        bitcoinrpc.BitcoinRPC("127.0.0.1", server.server_address[1], user, "wrong").call("getblockcount")
+
+def test_batch(server):
+    rpc = client(server)
+    batch = rpc.batch([("getblockcount", []), ("stop", []), ("getblockcount", []), ("getblockhash", [1])])
+    assert batch[0] == 812345 and batch[2] == 812345
+    assert isinstance(batch[1], bitcoinrpc.RPCError) and batch[1].code == -32601
+    assert batch[3] == results["getblockhash"]
+    assert len(server.requests) == 1
+    assert rpc.batch([]) == []
+
+def test_connection_refused():
+    with socket.socket() as unused:
+        unused.bind(("127.0.0.1", 0))
+        port = unused.getsockname()[1]
+    with pytest.raises(bitcoinrpc.ConnectionFailed):
+        bitcoinrpc.BitcoinRPC("127.0.0.1", port, user, password, connect_timeout=1).call("getblockcount")
+
+# scripts/bitcoin-rpc in a node root whose .env points to the given port
+@pytest.fixture
+def node_root(tmp_path):
+    os.makedirs(tmp_path / "scripts")
+    os.symlink(os.path.join(repo_root, "scripts", "lib"), tmp_path / "scripts" / "lib")
+    shutil.copy(os.path.join(repo_root, "scripts", "bitcoin-rpc"), tmp_path / "scripts" / "bitcoin-rpc")
+    return tmp_path
+
+def write_env(node_root, port: int):
+    (node_root / ".env").write_text('BITCOIN_IP=127.0.0.1\nBITCOIN_RPC_PORT="{}"\nBITCOIN_RPC_USER={}\nBITCOIN_RPC_PASS={}\n'.format(port, user, password))
+
+def bitcoin_rpc(node_root, *args: str) -> subprocess.CompletedProcess:
+    return subprocess.run([str(node_root / "scripts" / "bitcoin-rpc"), *args], capture_output=True, text=True, timeout=30)
+
+def test_script(server, node_root):
+    write_env(node_root, server.server_address[1])
+    result = bitcoin_rpc(node_root, "getmempoolinfo")
+    assert result.returncode == 0
+    # Amounts are printed exactly like bitcoind sent them
+    assert '"mempoolminfee": 0.00001000\n' in result.stdout
+    assert bitcoin_rpc(node_root, "getblockhash", "800000").stdout == results["getblockhash"] + "\n"
+    assert server.requests[-1]["params"] == [800000]
+    error = bitcoin_rpc(node_root, "getmempoolentry", "missing")
+    # Like bitcoin-cli, the exit code is the absolute error code (which the OS truncates to 8 bits)
+    assert error.returncode == 32601 % 256
+    assert error.stderr == "error code: -32601\nerror message:\nMethod not found\n"
+
+def test_script_batch(server, node_root):
+    write_env(node_root, server.server_address[1])
+    result = bitcoin_rpc(node_root, "--batch", "getblockcount", "getbestblockhash", "getblockcount", "getblockhash")
+    assert result.returncode == 0
+    # Repeated methods each get their result, in the order they were given
+    assert json.loads(result.stdout) == [812345, results["getbestblockhash"], 812345, results["getblockhash"]]
+    assert len(server.requests) == 1
+
+@pytest.mark.parametrize("args", [
+    ["-rpcwallet=test", "getbalance"],
+    ["sendtoaddress", "bc1q", "1"],
+    ["getblock", "hash", "not-json"],
+    [],
+    ["--batch"],
+    ["--batch", "getblockcount", "getbalance"],
+])
+def test_script_falls_back_to_bitcoin_cli(server, node_root, args):
+    write_env(node_root, server.server_address[1])
+    result = bitcoin_rpc(node_root, *args)
+    assert (result.returncode, result.stdout, result.stderr) == (125, "", "")
+    assert server.requests == []
+
+def test_script_falls_back_without_rpc(node_root):
+    # No .env
+    assert bitcoin_rpc(node_root, "getblockcount").returncode == 125
+    # Nothing listening on the port
+    with socket.socket() as unused:
+        unused.bind(("127.0.0.1", 0))
+        write_env(node_root, unused.getsockname()[1])
+    for args in [["getblockcount"], ["--batch", "getblockcount"]]:
+        result = bitcoin_rpc(node_root, *args)
+        assert (result.returncode, result.stdout, result.stderr) == (125, "", "")
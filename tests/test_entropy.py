@@ -0,0 +1,50 @@
+# SPDX-FileCopyrightText: 2023 Citadel and contributors
+#
+# SPDX-License-Identifier: GPL-3.0-or-later
+
+# The derived seeds must never change, every app's secrets are derived from them
+
+import shutil
+import subprocess
+
+import pytest
+
+from trees import load
+
+tree = "app"
+entropy = load("app", "entropy")
+
+seed = "d2f1c8b47a9e0c35f6a18b2e4d7c9f01a3b5e6d8c0f2a4b6d8e0f1a3c5e7b9d1"
+
+# Output of: printf "%s" "<identifier>" | openssl dgst -sha256 -binary -hmac "<seed>" | xxd -p | tr --delete "\n"
+known_vectors = {
+    "app-lnd-seed": "c42acc06e06dcc815b4c3ec105acf2491718edc8062c912ffac412d19aa69e1b",
+    "app-lnd-seed1": "7d71fbb754edb6649e261170fc1c3cc85e85ca2e4ca1f813b5fbe83c9eade674",
+    "app-btcpay-seed5": "d4800d94473e6fa5db435b610afbbde985f869dc28ab0f6883e9e7a78737720f",
+    "app-bitcoin knots-seed": "a55b63a6f24402d5517735dc7422ac3f0b06b4ac55e64256cc7f1c16fb10e4f8",
+}
+
+@pytest.fixture
+def node_seed(monkeypatch):
+    monkeypatch.setattr(entropy, "getNodeSeed", lambda: seed)
+    entropy.deriveEntropy.cache_clear()
+    yield
+    entropy.deriveEntropy.cache_clear()
+
+@pytest.mark.parametrize("identifier", sorted(known_vectors))
+def test_known_vectors(identifier):
+    assert entropy.hmacEntropy(seed, identifier) == known_vectors[identifier]
+
+def test_app_seeds(node_seed):
+    seeds = entropy.deriveAppSeeds("lnd")
+    assert list(seeds) == ["APP_SEED"] + ["APP_SEED_{}".format(i) for i in range(1, 6)]
+    assert seeds["APP_SEED"] == known_vectors["app-lnd-seed"]
+    assert seeds["APP_SEED_1"] == known_vectors["app-lnd-seed1"]
+    assert len(set(seeds.values())) == 6
+
+@pytest.mark.skipif(not (shutil.which("openssl") and shutil.which("xxd")), reason="openssl and xxd are needed to run the old pipeline")
+def test_matches_openssl():
+    identifier = "app-mempool-seed3"
+    expected = subprocess.check_output(
+        'printf "%s" "{}" | openssl dgst -sha256 -binary -hmac "{}" | xxd -p | tr --delete "\\n"'.format(identifier, seed), shell=True).decode()
+    assert entropy.hmacEntropy(seed, identifier) == expected
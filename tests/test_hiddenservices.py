@@ -0,0 +1,174 @@
+# SPDX-FileCopyrightText: 2023 Citadel and contributors
+#
+# SPDX-License-Identifier: GPL-3.0-or-later
+
+# Hidden services of apps with stub Tor instances: control port servers that create the hostname files
+# of the hidden services in their torrc when they are reloaded, like Tor does
+
+import os
+import socketserver
+import threading
+import time
+
+import pytest
+
+from trees import load
+
+tree = "app"
+hiddenservices = load("app", "hiddenservices")
+
+class ControlPort(socketserver.ThreadingTCPServer):
+    daemon_threads = True
+    allow_reuse_address = True
+
+    def __init__(self, tor_data_dir: str, services, cookie: bytes = None, delay: float = 0):
+        super().__init__(("127.0.0.1", 0), ControlPortHandler)
+        self.tor_data_dir = tor_data_dir
+        self.services = services
+        self.cookie = cookie
+        self.delay = delay
+        self.commands = []
+        self.reloads = 0
+
+    @property
+    def port(self) -> int:
+        return self.server_address[1]
+
+    # Like Tor, create the directory first and write the hostname file a bit later
+    def create_services(self):
+        for service in self.services:
+            directory = os.path.join(self.tor_data_dir, service)
+            os.makedirs(directory, exist_ok=True)
+            time.sleep(self.delay)
+            with open(os.path.join(directory, "hostname"), "w") as f:
+                f.write("{}.onion\n".format(service))
+
+class ControlPortHandler(socketserver.StreamRequestHandler):
+    def handle(self):
+        for line in self.rfile:
+            command = line.decode().strip()
+            self.server.commands.append(command)
+            if command.startswith("AUTHENTICATE"):
+                expected = "AUTHENTICATE {}".format(self.server.cookie.hex()) if self.server.cookie else "AUTHENTICATE"
+                self.wfile.write(b"250 OK\r\n" if command == expected else b"515 Authentication failed\r\n")
+            elif command == "SIGNAL RELOAD":
+                self.server.reloads += 1
+                self.wfile.write(b"250 OK\r\n")
+                threading.Thread(target=self.server.create_services).start()
+            elif command == "QUIT":
+                self.wfile.write(b"250 closing connection\r\n")
+                return
+
+@pytest.fixture
+def tor_dir(tmp_path):
+    os.makedirs(tmp_path / "tor" / "data")
+    return tmp_path / "tor"
+
+@pytest.fixture
+def control_ports():
+    servers = []
+
+    def start(*args, **kwargs) -> ControlPort:
+        server = ControlPort(*args, **kwargs)
+        threading.Thread(target=server.serve_forever, daemon=True).start()
+        servers.append(server)
+        return server
+
+    yield start
+    for server in servers:
+        server.shutdown()
+        server.server_close()
+
+def write_torrc(path, control_port: str, services, extra: str = ""):
+    torrc = "SocksPort 0\nControlPort {}\n{}".format(control_port, extra)
+    for service in services:
+        torrc += "\n# {} Hidden Service\nHiddenServiceDir /var/lib/tor/{}\nHiddenServicePort 80 10.21.21.9:3000\n".format(service, service)
+    path.write_text(torrc)
+
+def write_hostname(tor_dir, service: str):
+    os.makedirs(tor_dir / "data" / service)
+    (tor_dir / "data" / service / "hostname").write_text("{}.onion\n".format(service))
+
+# Three app Tor instances, where the services in existing already have their hostname
+@pytest.fixture
+def instances(tor_dir, control_ports):
+    data_dir = str(tor_dir / "data")
+    services = [["app-lnd-rest", "app-lnd-grpc"], ["app-btcpay"], ["app-mempool", "app-electrs"]]
+    cookie = os.urandom(32)
+    servers = [control_ports(data_dir, services[0]), control_ports(data_dir, services[1], cookie), control_ports(data_dir, services[2])]
+    # The control port of the first instance is on the IP in .env
+    write_torrc(tor_dir / "torrc-apps", str(servers[0].port), services[0])
+    write_torrc(tor_dir / "torrc-apps-2", "127.0.0.1:{}".format(servers[1].port), services[1],
+                "CookieAuthentication 1\nCookieAuthFile /var/lib/tor/app-2-tor/control_auth_cookie\n")
+    os.makedirs(tor_dir / "data" / "app-2-tor")
+    (tor_dir / "data" / "app-2-tor" / "control_auth_cookie").write_bytes(cookie)
+    write_torrc(tor_dir / "torrc-apps-3", "127.0.0.1:{}".format(servers[2].port), services[2])
+    for service in ["app-lnd-rest", "app-lnd-grpc", "app-mempool", "app-electrs"]:
+        write_hostname(tor_dir, service)
+    return servers
+
+env = {"APPS_TOR_IP": "127.0.0.1"}
+
+def test_only_instances_with_missing_services_are_reloaded(tor_dir, instances):
+    missing = hiddenservices.ensureHiddenServices(str(tor_dir), ["app-lnd-rest", "app-btcpay", "app-mempool"], env, timeout=10)
+    assert missing == []
+    assert [server.reloads for server in instances] == [0, 1, 0]
+    assert instances[0].commands == [] and instances[2].commands == []
+    # The cookie from the data dir was used
+    assert instances[1].commands[0] == "AUTHENTICATE {}".format(instances[1].cookie.hex())
+    assert (tor_dir / "data" / "app-btcpay" / "hostname").read_text() == "app-btcpay.onion\n"
+
+def test_several_instances(tor_dir, instances):
+    os.unlink(tor_dir / "data" / "app-lnd-grpc" / "hostname")
+    for server in instances:
+        server.delay = 0.2
+    assert hiddenservices.ensureHiddenServices(str(tor_dir), ["app-lnd-grpc", "app-btcpay", "app-mempool"], env, timeout=10) == []
+    assert [server.reloads for server in instances] == [1, 1, 0]
+
+def test_nothing_missing(tor_dir, instances):
+    assert hiddenservices.ensureHiddenServices(str(tor_dir), ["app-lnd-rest", "app-electrs"], env, timeout=10) == []
+    assert [server.reloads for server in instances] == [0, 0, 0]
+    assert all(server.commands == [] for server in instances)
+
+def test_timeout_returns_missing_services(tor_dir, instances):
+    # The second instance doesn't have this service in its torrc, so it never appears
+    instances[1].services = []
+    began = time.monotonic()
+    missing = hiddenservices.ensureHiddenServices(str(tor_dir), ["app-btcpay", "app-lnd-rest"], env, timeout=0.5)
+    assert missing == ["app-btcpay"]
+    assert 0.5 <= time.monotonic() - began < 5
+    assert [server.reloads for server in instances] == [0, 1, 0]
+
+def test_wait_for_hostnames(tmp_path):
+    def create():
+        time.sleep(0.2)
+        write_hostname(tmp_path, "app-lnd")
+        # An empty hostname file doesn't count yet
+        os.makedirs(tmp_path / "data" / "app-btcpay")
+        (tmp_path / "data" / "app-btcpay" / "hostname").write_text("")
+
+    os.makedirs(tmp_path / "data")
+    thread = threading.Thread(target=create)
+    thread.start()
+    began = time.monotonic()
+    assert hiddenservices.waitForHostnames(str(tmp_path / "data"), ["app-lnd", "app-btcpay"], timeout=1) == ["app-btcpay"]
+    assert time.monotonic() - began >= 1
+    thread.join()
+    assert hiddenservices.waitForHostnames(str(tmp_path / "data"), ["app-lnd"], timeout=1) == []
+
+def test_wait_returns_as_soon_as_services_exist(tmp_path):
+    os.makedirs(tmp_path / "data")
+    thread = threading.Timer(0.2, write_hostname, [tmp_path, "app-lnd"])
+    thread.start()
+    began = time.monotonic()
+    assert hiddenservices.waitForHostnames(str(tmp_path / "data"), ["app-lnd"], timeout=10) == []
+    assert time.monotonic() - began < 5
+    thread.join()
+
+def test_failed_authentication_falls_back_to_sighup(tor_dir, instances, monkeypatch):
+    calls = []
+    monkeypatch.setattr(hiddenservices.subprocess, "call", lambda command, **kwargs: calls.append(command) or 0)
+    (tor_dir / "data" / "app-2-tor" / "control_auth_cookie").write_bytes(b"wrong")
+    hiddenservices.ensureHiddenServices(str(tor_dir), ["app-btcpay"], env, timeout=0.2)
+    assert instances[1].reloads == 0
+    assert calls == [["docker", "kill", "--signal", "HUP", "app-2-tor"]]
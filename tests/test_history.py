@@ -0,0 +1,104 @@
+# SPDX-FileCopyrightText: 2023 Citadel and contributors
+#
+# SPDX-License-Identifier: GPL-3.0-or-later
+
+# Metric history with small tiers, so the ring buffers wrap around after a few samples
+
+import os
+import time
+
+import pytest
+
+from trees import load
+
+tree = "scripts"
+history = load("scripts", "history")
+
+# 4 raw samples, 3 buckets of 10 seconds and 2 of a minute
+tiers = [("raw", 0, 4), ("10s", 10, 3), ("1m", 60, 2)]
+
+@pytest.fixture
+def metrics(tmp_path):
+    metrics = history.MetricHistory(str(tmp_path), tiers, max_series=3)
+    yield metrics
+    metrics.close()
+
+def times(result: dict) -> list:
+    return [point["time"] for point in result["points"]]
+
+def test_buckets(metrics):
+    for timestamp, value in [(1000, 1), (1004.5, 5), (1009, 3), (1010, 10)]:
+        metrics.append({"memory.used": value}, timestamp)
+    first, second = metrics.query("memory.used", 1000, 1100, tier="10s")["points"]
+    assert first == {"time": 1000, "avg": 3, "min": 1, "max": 5, "count": 3}
+    assert second == {"time": 1010, "avg": 10, "min": 10, "max": 10, "count": 1}
+    assert times(metrics.query("memory.used", 1000, 1100, tier="raw")) == [1000, 1004, 1009, 1010]
+    assert metrics.query("memory.used", 1000, 1100, tier="1m")["points"] == [{"time": 960, "avg": 4.75, "min": 1, "max": 10, "count": 4}]
+
+def test_wraparound(metrics):
+    for second in range(1000, 1100, 5):
+        metrics.append({"memory.used": second}, second)
+    # Only the newest slots are kept, oldest first
+    assert times(metrics.query("memory.used", 0, 2000, tier="raw")) == [1080, 1085, 1090, 1095]
+    assert times(metrics.query("memory.used", 0, 2000, tier="10s")) == [1070, 1080, 1090]
+    assert times(metrics.query("memory.used", 0, 2000, tier="1m")) == [1020, 1080]
+
+def test_bucket_containing_start(metrics):
+    for second in range(1000, 1030):
+        metrics.append({"memory.used": 1}, second)
+    # The bucket from 1010 to 1020 has samples after 1015
+    assert times(metrics.query("memory.used", 1015, 1100, tier="10s")) == [1010, 1020]
+    assert times(metrics.query("memory.used", 1010, 1019, tier="10s")) == [1010]
+    assert times(metrics.query("memory.used", 1027, 1100, tier="raw")) == [1027, 1028, 1029]
+
+def test_tier_selection(metrics):
+    for second in range(1000, 1100, 5):
+        metrics.append({"memory.used": 1}, second)
+    # The finest tier that still has the samples since start
+    assert metrics.query("memory.used", 1080, 2000)["tier"] == "raw"
+    assert metrics.query("memory.used", 1075, 2000)["tier"] == "10s"
+    assert metrics.query("memory.used", 1030, 2000)["tier"] == "1m"
+    assert metrics.query("memory.used", 0, 2000)["tier"] == "1m"
+    # A tier that didn't wrap around yet has everything
+    metrics.append({"storage.used": 1}, 1000)
+    result = metrics.query("storage.used", 0, 2000)
+    assert result["tier"] == "raw" and result["resolution"] == 0 and times(result) == [1000]
+
+def test_samples_from_the_past(metrics):
+    metrics.append({"memory.used": 1}, 1025)
+    metrics.append({"memory.used": 2}, 1005)
+    # The bucketed tiers add it to the newest bucket, the raw tier keeps it as it came
+    assert metrics.query("memory.used", 0, 2000, tier="10s")["points"] == [{"time": 1020, "avg": 1.5, "min": 1, "max": 2, "count": 2}]
+    assert times(metrics.query("memory.used", 0, 2000, tier="raw")) == [1025, 1005]
+
+def test_prune(tmp_path, metrics):
+    metrics.append({"app.lnd": 1, "app.btcpay": 1}, 1000)
+    metrics.append({"app.lnd": 1}, 1200)
+    # The hourly tier holds 2 minutes
+    assert metrics.prune(now=1120) == []
+    assert metrics.prune(now=1121) == ["app.btcpay"]
+    assert metrics.names() == ["app.lnd"]
+    assert not os.path.exists(tmp_path / "app.btcpay.ring")
+    with pytest.raises(KeyError):
+        metrics.query("app.btcpay")
+
+def test_too_many_series(metrics):
+    now = time.time()
+    metrics.append({"a": 1, "b": 1}, now - 1000)
+    metrics.append({"c": 1}, now)
+    # a and b weren't updated for longer than the hourly tier holds, they make room
+    metrics.append({"d": 1, "e": 1}, now)
+    assert metrics.names() == ["c", "d", "e"]
+    with pytest.raises(ValueError):
+        metrics.append({"f": 1}, now)
+
+def test_files_are_reopened(tmp_path, metrics):
+    metrics.append({"memory.used": 7}, 1000)
+    metrics.close()
+    size = os.path.getsize(tmp_path / "memory.used.ring")
+    reopened = history.MetricHistory(str(tmp_path), tiers)
+    assert reopened.query("memory.used", 0, 2000, tier="raw")["points"][0]["avg"] == 7
+    reopened.append({"memory.used": 8}, 1001)
+    reopened.close()
+    # Appending never grows the file
+    assert os.path.getsize(tmp_path / "memory.used.ring") == size
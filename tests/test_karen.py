@@ -0,0 +1,124 @@
+# SPDX-FileCopyrightText: 2023 Citadel and contributors
+#
+# SPDX-License-Identifier: GPL-3.0-or-later
+
+# Runs karen with stub triggers, which log when they start and end, and checks the order they ran in
+
+import json
+import os
+import socket
+import subprocess
+import sys
+import threading
+import time
+
+import pytest
+
+from trees import repo_root
+
+stub_trigger = """#!/usr/bin/env bash
+echo "start $(basename "$0") $*" >> "$KAREN_TEST_LOG"
+sleep 0.4
+echo "end $(basename "$0") $*" >> "$KAREN_TEST_LOG"
+"""
+
+@pytest.fixture
+def karen(tmp_path):
+    triggers = tmp_path / "scripts" / "triggers"
+    triggers.mkdir(parents=True)
+    for name in ["app", "app-update", "caddy-config-update", "update", "backup"]:
+        (triggers / name).write_text(stub_trigger)
+        (triggers / name).chmod(0o755)
+    log = tmp_path / "log"
+    log.touch()
+    socket_path = str(tmp_path / "karen.socket")
+    process = subprocess.Popen([sys.executable, os.path.join(repo_root, "karen"), "--root", str(tmp_path), "--socket", socket_path],
+                               env=dict(os.environ, KAREN_TEST_LOG=str(log)), stdout=subprocess.DEVNULL)
+    deadline = time.monotonic() + 10
+    while not os.path.exists(socket_path):
+        assert time.monotonic() < deadline, "karen didn't start"
+        time.sleep(0.05)
+    yield socket_path, log
+    process.terminate()
+    process.wait()
+
+class Request(threading.Thread):
+    def __init__(self, socket_path: str, message: str):
+        super().__init__()
+        self.socket_path = socket_path
+        self.message = message
+        self.accepted = threading.Event()
+        self.results = []
+
+    def run(self):
+        with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as client:
+            client.connect(self.socket_path)
+            client.sendall("reply {}\n".format(self.message).encode())
+            with client.makefile("r") as replies:
+                for line in replies:
+                    self.results.append(json.loads(line))
+                    self.accepted.set()
+
+def send(socket_path: str, *messages: str):
+    requests = []
+    for message in messages:
+        request = Request(socket_path, message)
+        request.start()
+        assert request.accepted.wait(5)
+        requests.append(request)
+    return requests
+
+def finish(requests):
+    for request in requests:
+        request.join(15)
+        assert request.results[-1]["status"] == "done", request.results
+
+# The intervals triggers ran in, by their arguments
+def intervals(log) -> dict:
+    runs = {}
+    for index, line in enumerate(log.read_text().splitlines()):
+        event, trigger = line.split(" ", 1)
+        runs.setdefault(trigger.strip(), []).append(index)
+    return runs
+
+def overlap(runs: dict, first: str, second: str) -> bool:
+    return runs[first][0] < runs[second][1] and runs[second][0] < runs[first][1]
+
+def test_configuration_triggers_are_exclusive(karen):
+    socket_path, log = karen
+    finish(send(socket_path, "trigger app install lnd", "trigger app install core-lightning", "trigger app start btcpay",
+                "trigger caddy-config-update", "trigger app update"))
+    runs = intervals(log)
+    names = ["app install lnd", "app install core-lightning", "app start btcpay", "caddy-config-update", "app update"]
+    for i, first in enumerate(names):
+        for second in names[i + 1:]:
+            assert not overlap(runs, first, second), (first, second, log.read_text())
+
+def test_apps_run_concurrently(karen):
+    socket_path, log = karen
+    finish(send(socket_path, "trigger app start lnd", "trigger app start btcpay", "trigger app restart lnd", "trigger backup"))
+    runs = intervals(log)
+    assert overlap(runs, "app start lnd", "app start btcpay")
+    assert overlap(runs, "app start btcpay", "backup")
+    # The same app one after another
+    assert not overlap(runs, "app start lnd", "app restart lnd")
+
+def test_identical_waiting_requests_are_merged(karen):
+    socket_path, log = karen
+    requests = send(socket_path, "trigger app install lnd", "trigger app generate", "trigger app generate")
+    assert requests[1].results[0]["job"] == requests[2].results[0]["job"]
+    assert requests[1].results[0]["status"] == "queued"
+    finish(requests)
+    assert log.read_text().count("start app generate") == 1
+    # Queued jobs run in the order they were submitted
+    runs = intervals(log)
+    assert runs["app install lnd"][1] < runs["app generate"][0]
+
+def test_global_triggers_wait_for_everything(karen):
+    socket_path, log = karen
+    finish(send(socket_path, "trigger app start lnd", "trigger update", "trigger app start btcpay"))
+    runs = intervals(log)
+    assert not overlap(runs, "update", "app start lnd")
+    assert not overlap(runs, "update", "app start btcpay")
+    # A waiting global trigger goes before jobs submitted after it
+    assert runs["update"][1] < runs["app start btcpay"][0]
@@ -0,0 +1,42 @@
+# SPDX-FileCopyrightText: 2023 Citadel and contributors
+#
+# SPDX-License-Identifier: GPL-3.0-or-later
+
+import os
+
+from trees import load
+
+tree = "app"
+lifecycle = load("app", "lifecycle")
+
+def compose_file(app: str) -> str:
+    return os.path.join("apps", app, "docker-compose.yml")
+
+def test_only_changed_installed_apps_are_recreated(monkeypatch):
+    batches = []
+    monkeypatch.setattr(lifecycle, "getUserData", lambda: {"installedApps": ["lnd", "btcpay", "mempool"]})
+    monkeypatch.setattr(lifecycle, "runBatch", lambda action, apps, jobs=0: batches.append((action, apps)) or 0)
+    monkeypatch.setattr(lifecycle, "prefetchAppImages", lambda apps: None)
+    changed = [compose_file("lnd"), compose_file("not-installed"), os.path.join("apps", "mempool", "app.yml"), compose_file("btcpay")]
+    assert lifecycle.recreateChangedApps(changed) == 0
+    assert batches == [("start", ["lnd", "btcpay"])]
+
+def test_nothing_changed(monkeypatch):
+    batches = []
+    monkeypatch.setattr(lifecycle, "getUserData", lambda: {"installedApps": ["lnd"]})
+    monkeypatch.setattr(lifecycle, "runBatch", lambda action, apps, jobs=0: batches.append((action, apps)) or 0)
+    # runBatch with no apps would start all installed apps
+    assert lifecycle.recreateChangedApps([os.path.join("apps", "lnd", "app.yml")]) == 0
+    assert batches == []
+
+def test_images_are_pulled_before_recreating(monkeypatch, tmp_path):
+    calls = []
+    monkeypatch.setattr(lifecycle, "getUserData", lambda: {"installedApps": ["lnd", "btcpay"]})
+    monkeypatch.setattr(lifecycle, "runBatch", lambda action, apps, jobs=0: calls.append((action, apps)) or 0)
+    monkeypatch.setattr(lifecycle, "collectImages", lambda apps_dir, apps, dependencies: ["{}:latest".format(app) for app in apps])
+    monkeypatch.setattr(lifecycle, "prefetchImages", lambda images: calls.append(("pull", images)) or ["lnd:latest"])
+    monkeypatch.setattr(lifecycle, "nodeRoot", str(tmp_path))
+    os.makedirs(tmp_path / "db")
+    # A failed pull doesn't stop the apps from being recreated
+    assert lifecycle.recreateChangedApps([compose_file("lnd"), compose_file("mempool")]) == 0
+    assert calls == [("pull", ["lnd:latest"]), ("start", ["lnd"])]
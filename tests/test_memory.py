@@ -0,0 +1,105 @@
+# SPDX-FileCopyrightText: 2023 Citadel and contributors
+#
+# SPDX-License-Identifier: GPL-3.0-or-later
+
+import json
+
+import pytest
+
+from trees import load
+
+tree = "scripts"
+memory = load("scripts", "memory")
+
+MiB = 1024 * 1024
+
+containers = [
+    memory.Container("aaa", "bitcoin", "citadel"),
+    memory.Container("bbb", "lightning", "citadel"),
+    memory.Container("ccc", "lnd_web_1", "lnd"),
+    memory.Container("ddd", "lnd_db_1", "lnd"),
+    memory.Container("eee", "btcpay_server_1", "btcpay"),
+]
+
+# Memory used by each container (before subtracting the inactive file cache) and its inactive file cache, in MiB
+usage = {"aaa": (600, 100), "bbb": (250, 50), "ccc": (120, 20), "ddd": (60, 0), "eee": (40, 80)}
+
+def write(path, content: str):
+    path.parent.mkdir(parents=True, exist_ok=True)
+    path.write_text(content)
+
+# cgroup v2 with the systemd cgroup driver
+@pytest.fixture
+def cgroup_v2(tmp_path):
+    root = tmp_path / "cgroup"
+    write(root / "cgroup.controllers", "cpu memory pids\n")
+    for container_id, (current, inactive) in usage.items():
+        scope = root / "system.slice" / "docker-{}.scope".format(container_id)
+        write(scope / "memory.current", "{}\n".format(current * MiB))
+        write(scope / "memory.stat", "anon 1234\nfile 5678\ninactive_file {}\nactive_file 42\n".format(inactive * MiB))
+    return memory.CgroupMemory(str(root))
+
+# cgroup v1 with the cgroupfs driver
+@pytest.fixture
+def cgroup_v1(tmp_path):
+    root = tmp_path / "cgroup"
+    for container_id, (current, inactive) in usage.items():
+        cgroup = root / "memory" / "docker" / container_id
+        write(cgroup / "memory.usage_in_bytes", "{}\n".format(current * MiB))
+        write(cgroup / "memory.stat", "cache 5678\ninactive_file 1\ntotal_inactive_file {}\n".format(inactive * MiB))
+    return memory.CgroupMemory(str(root))
+
+@pytest.fixture
+def node_root(tmp_path):
+    root = tmp_path / "node"
+    write(root / "db" / "user.json", json.dumps({"installedApps": ["lnd", "btcpay", "mempool", "lightning"]}))
+    write(root / "apps" / "virtual-apps.json", json.dumps({"lightning": ["lnd"]}))
+    return str(root)
+
+@pytest.fixture
+def meminfo(tmp_path):
+    path = tmp_path / "meminfo"
+    # 4000 MiB total, 1600 MiB used
+    write(path, "MemTotal:        4096000 kB\nMemFree:          100000 kB\nMemAvailable:    2457600 kB\nBuffers:           10000 kB\n")
+    return str(path)
+
+@pytest.mark.parametrize("cgroups", ["cgroup_v2", "cgroup_v1"])
+def test_container_usage(cgroups, request):
+    cgroups = request.getfixturevalue(cgroups)
+    assert cgroups.is_v2 == (request.node.callspec.params["cgroups"] == "cgroup_v2")
+    assert cgroups.container_usage("aaa") == 500 * MiB
+    assert cgroups.container_usage("ddd") == 60 * MiB
+    # More inactive cache than usage is ignored, like docker stats does
+    assert cgroups.container_usage("eee") == 40 * MiB
+    assert cgroups.container_usage("missing") == 0
+    by_project, by_name = memory.container_usage(containers, cgroups)
+    assert by_project == {"citadel": 700 * MiB, "lnd": 160 * MiB, "btcpay": 40 * MiB}
+    assert by_name["lightning"] == 200 * MiB
+
+def test_system_memory(meminfo):
+    assert memory.system_memory(meminfo) == (4000 * MiB, 1600 * MiB)
+
+def test_memory_status(cgroup_v2, node_root, meminfo):
+    assert memory.memory_status(node_root, containers, cgroup_v2, meminfo) == {
+        "total": 4000 * MiB,
+        "used": 1600 * MiB,
+        "breakdown": [
+            {"id": "citadel", "used": 1400 * MiB},
+            {"id": "lnd", "used": 160 * MiB},
+            {"id": "btcpay", "used": 40 * MiB},
+            {"id": "mempool", "used": 0},
+        ],
+    }
+
+# Same format as the old shell script: total and system with one decimal, everything else with two
+def test_memory_usage_report(cgroup_v1, node_root, meminfo):
+    assert memory.memory_usage_report(node_root, containers, cgroup_v1, meminfo) == [
+        "total: 40.0%",
+        "system: 17.5%",
+        "bitcoin: 12.50%",
+        "lightning: 5.00%",
+        "lnd: 4.00%",
+        "btcpay: 1.00%",
+        "tor: 0.00%",
+        "mempool: 0.00%",
+    ]
@@ -0,0 +1,295 @@
+# SPDX-FileCopyrightText: 2023 Citadel and contributors
+#
+# SPDX-License-Identifier: GPL-3.0-or-later
+
+import hashlib
+import json
+import os
+import shutil
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import pytest
+
+from trees import load, repo_root
+
+tree = "scripts"
+ota = load("scripts", "ota")
+
+# The release's own rules, so changes to them are tested too
+def update_rules() -> dict:
+    rules = {}
+    for name in [".updateinclude", ".updateignore"]:
+        with open(os.path.join(repo_root, "scripts", "update", name), "r") as f:
+            rules["scripts/update/" + name] = f.read()
+    return rules
+
+def write_tree(root, files: dict):
+    for path, content in files.items():
+        target = os.path.join(root, path)
+        os.makedirs(os.path.dirname(target), exist_ok=True)
+        with open(target, "w") as f:
+            f.write(content)
+
+# The files in root, without staged releases and the object store
+def installed_files(root) -> dict:
+    return {path: content for path, content in read_tree(root).items() if not path.startswith(".citadel-")}
+
+def read_tree(root) -> dict:
+    files = {}
+    for directory, _, names in os.walk(root):
+        for name in names:
+            path = os.path.join(directory, name)
+            if not os.path.islink(path):
+                with open(path, "r") as f:
+                    files[os.path.relpath(path, root)] = f.read()
+    return files
+
+@pytest.mark.parametrize("path, is_dir, matches", [
+    ("scripts/app", False, True),
+    ("app/lib/manage.py", False, True),
+    # /.* only excludes hidden paths in the root, like the staged releases and the object store
+    (".citadel-1.2.3", True, False),
+    (".citadel-1.2.3/scripts/app", False, False),
+    (".citadel-update/objects/ab/abcd", False, False),
+    (".git", True, False),
+    ("scripts/update/.updateignore", False, True),
+    # Files of .updateinclude are updated even in ignored directories
+    (".env", False, True),
+    ("bitcoin/bitcoin.conf", False, True),
+    ("bitcoin/blocks/blk00000.dat", False, False),
+    ("db/dependencies.yml", False, True),
+    ("db/user.json", False, False),
+    ("apps/stores.yml", False, True),
+    ("apps/docker-compose.common.yml", False, True),
+    ("apps/lnd/app.yml", False, False),
+    ("services/bitcoin/core.yml", False, True),
+    ("services/installed.yml", False, False),
+    ("caddy/.gitkeep", False, True),
+    ("caddy/Caddyfile", False, False),
+    ("tor/torrc-core", False, True),
+    ("tor/data/app-lnd/hostname", False, False),
+    ("statuses/update-status.json", False, False),
+])
+def test_update_rules(tmp_path, path, is_dir, matches):
+    write_tree(tmp_path, update_rules())
+    update_filter = ota.UpdateFilter.from_tree(str(tmp_path))
+    assert update_filter.matches(path, is_dir) == matches
+
+def test_protected_files():
+    rules = update_rules()
+    update_filter = ota.UpdateFilter(rules["scripts/update/.updateinclude"].splitlines(), rules["scripts/update/.updateignore"].splitlines())
+    assert update_filter.protected(".env")
+    assert update_filter.protected("services/lightning/lnd.yml")
+    assert not update_filter.protected("scripts/app")
+
+old_release = dict(update_rules(), **{
+    "info.json": '{"version": "0.1.0"}',
+    "scripts/app": "#!/bin/bash\necho old\n",
+    "scripts/configure": "#!/bin/bash\n",
+    "scripts/removed/old-script": "old\n",
+    "app/lib/manage.py": "# manage\n",
+    "services/bitcoin/core.yml": "image: core:24\n",
+    "README.md": "Citadel\n",
+})
+
+new_release = dict(update_rules(), **{
+    "info.json": '{"version": "0.2.0"}',
+    "scripts/app": "#!/bin/bash\necho new\n",
+    "scripts/configure": "#!/bin/bash\n",
+    "app/lib/manage.py": "# manage\n",
+    "app/lib/new.py": "# new\n",
+    "services/bitcoin/core.yml": "image: core:25\n",
+    "README.md": "Citadel\n",
+})
+
+# Created on the node, the update must never touch them
+node_data = {
+    ".env": "BITCOIN_NETWORK=mainnet\n",
+    "db/user.json": '{"installedApps": ["lnd"]}',
+    "apps/lnd/app.yml": "lnd\n",
+    "statuses/update-status.json": "{}",
+    "tor/data/app-lnd/hostname": "abc.onion\n",
+    ".citadel-0.0.9/scripts/app": "an old staged release\n",
+}
+
+@pytest.fixture
+def node(tmp_path):
+    root = tmp_path / "node"
+    write_tree(root, old_release)
+    write_tree(root, node_data)
+    os.chmod(root / "scripts" / "configure", 0o644)
+    return root
+
+@pytest.fixture
+def release(tmp_path):
+    root = tmp_path / "release"
+    write_tree(root, new_release)
+    for path in ["scripts/app", "scripts/configure"]:
+        os.chmod(root / path, 0o755)
+    os.symlink("../app/lib", root / "scripts" / "app-lib")
+    return root
+
+def test_plan(node, release):
+    plan = ota.plan_update(ota.DirSource(str(release)).manifest("0.2.0"), str(node))
+    assert plan.changed == ["app/lib/new.py", "info.json", "scripts/app", "services/bitcoin/core.yml"]
+    assert plan.chmod == ["scripts/configure"]
+    assert plan.links == ["scripts/app-lib"]
+    assert plan.removed == ["scripts/removed/old-script"]
+
+def test_stage_and_apply(node, release):
+    staged = node / ".citadel-0.2.0"
+    store = ota.ObjectStore(str(node / ota.store_dir_name / "objects"))
+    before = installed_files(node)
+    result = ota.stage_release(str(node), "0.2.0", ota.DirSource(str(release)), str(staged))
+    assert result.downloaded_files == 4
+    assert result.downloaded_bytes == sum(len(new_release[path]) for path in result.plan.changed)
+    assert all(store.has(hashlib.sha256(new_release[path].encode()).hexdigest()) for path in result.plan.changed)
+    # Staging doesn't change the installed node
+    assert installed_files(node) == before
+    # The staged release is complete, unchanged files are links to the installed ones
+    assert {path: content for path, content in read_tree(staged).items() if path != ota.staged_manifest_name} == new_release
+    assert os.path.samefile(staged / "README.md", node / "README.md")
+    assert not os.path.samefile(staged / "scripts" / "configure", node / "scripts" / "configure")
+    assert os.access(staged / "scripts" / "configure", os.X_OK)
+
+    applied = ota.apply_staged(str(node), str(staged))
+    assert applied == ota.ApplyResult(replaced=5, chmod=1, removed=1)
+    installed = read_tree(node)
+    for path, content in new_release.items():
+        assert installed[path] == content
+    for path, content in node_data.items():
+        assert installed[path] == content
+    assert not os.path.exists(node / "scripts" / "removed")
+    assert os.readlink(node / "scripts" / "app-lib") == "../app/lib"
+    assert os.access(node / "scripts" / "configure", os.X_OK)
+    # Nothing is left to do, and nothing has to be fetched again
+    assert ota.plan_update(ota.read_staged_manifest(str(staged)), str(node)) == ota.Plan(
+        ota.read_staged_manifest(str(staged)), [], [], [], [])
+    shutil.rmtree(staged)
+    again = ota.stage_release(str(node), "0.2.0", ota.DirSource(str(release)), str(staged))
+    assert again.downloaded_files == 0
+
+def test_failed_fetch_keeps_the_objects(node, release):
+    class FailingSource(ota.DirSource):
+        def fetch(self, objects, store, progress):
+            first = dict(list(objects.items())[:2])
+            super().fetch(first, store, progress)
+            raise ota.UpdateError("Connection lost")
+
+    with pytest.raises(ota.UpdateError):
+        ota.stage_release(str(node), "0.2.0", FailingSource(str(release)), str(node / ".citadel-0.2.0"))
+    result = ota.stage_release(str(node), "0.2.0", ota.DirSource(str(release)), str(node / ".citadel-0.2.0"))
+    assert result.downloaded_files == 2
+
+class MirrorServer(ThreadingHTTPServer):
+    daemon_threads = True
+
+    def __init__(self, directory: str):
+        super().__init__(("127.0.0.1", 0), MirrorHandler)
+        self.directory = directory
+        self.requests = []
+        # Paths whose next full response is cut off after this many bytes
+        self.cut_off = {}
+
+    @property
+    def url(self) -> str:
+        return "http://127.0.0.1:{}".format(self.server_address[1])
+
+# Serves files with an ETag of their content, and range requests with If-Range like most web servers
+class MirrorHandler(BaseHTTPRequestHandler):
+    def do_GET(self):
+        self.server.requests.append((self.path, self.headers.get("Range"), self.headers.get("If-Range")))
+        path = os.path.join(self.server.directory, self.path.lstrip("/"))
+        if not os.path.isfile(path):
+            self.send_error(404)
+            return
+        with open(path, "rb") as f:
+            data = f.read()
+        etag = '"{}"'.format(hashlib.sha256(data).hexdigest()[:16])
+        start = 0
+        requested = self.headers.get("Range")
+        if requested and self.headers.get("If-Range", etag) == etag:
+            start = int(requested[len("bytes="):].rstrip("-"))
+        if start >= len(data) and start:
+            self.send_error(416)
+            return
+        self.send_response(206 if start else 200)
+        self.send_header("ETag", etag)
+        self.send_header("Content-Length", str(len(data) - start))
+        if start:
+            self.send_header("Content-Range", "bytes {}-{}/{}".format(start, len(data) - 1, len(data)))
+        self.end_headers()
+        cut_off = self.server.cut_off.pop(self.path, None)
+        self.wfile.write(data[start:] if cut_off is None else data[start:start + cut_off])
+
+    def log_message(self, format, *args):
+        pass
+
+@pytest.fixture
+def mirror(tmp_path):
+    server = MirrorServer(str(tmp_path / "mirror"))
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    yield server
+    server.shutdown()
+    server.server_close()
+
+def test_download_resumes(tmp_path, mirror):
+    data = os.urandom(300000)
+    write_path = tmp_path / "mirror" / "file"
+    os.makedirs(write_path.parent)
+    write_path.write_bytes(data)
+    mirror.cut_off["/file"] = 100000
+    progress = []
+    destination = str(tmp_path / "download" / "file")
+    ota.download(mirror.url + "/file", destination, progress.append, timeout=10)
+    with open(destination, "rb") as f:
+        assert f.read() == data
+    assert sum(progress) == len(data)
+    assert len(mirror.requests) == 2
+    # The second request continues where the first one stopped, if the file is still the same
+    _, requested, if_range = mirror.requests[1]
+    assert requested == "bytes=100000-"
+    assert if_range is not None
+    assert not os.path.exists(destination + ".part") and not os.path.exists(destination + ".part.etag")
+
+def test_download_starts_over_if_the_file_changed(tmp_path, mirror):
+    os.makedirs(tmp_path / "mirror")
+    (tmp_path / "mirror" / "file").write_bytes(b"a" * 1000)
+    destination = tmp_path / "download" / "file"
+    os.makedirs(destination.parent)
+    # An earlier attempt downloaded part of another version of the file
+    (tmp_path / "download" / "file.part").write_bytes(b"b" * 600)
+    (tmp_path / "download" / "file.part.etag").write_text('"another version"')
+    ota.download(mirror.url + "/file", str(destination), timeout=10)
+    assert destination.read_bytes() == b"a" * 1000
+    assert mirror.requests == [("/file", "bytes=600-", '"another version"')]
+
+def test_download_of_a_complete_partial_file(tmp_path, mirror):
+    os.makedirs(tmp_path / "mirror")
+    (tmp_path / "mirror" / "file").write_bytes(b"a" * 1000)
+    destination = tmp_path / "download" / "file"
+    os.makedirs(destination.parent)
+    (tmp_path / "download" / "file.part").write_bytes(b"a" * 1000)
+    ota.download(mirror.url + "/file", str(destination), timeout=10)
+    assert destination.read_bytes() == b"a" * 1000
+
+def test_stage_from_mirror(tmp_path, node, release, mirror):
+    manifest = ota.write_mirror(str(release), "0.2.0", mirror.directory)
+    app_object = manifest["files"]["scripts/app"]["sha256"]
+    mirror.cut_off["/objects/{}/{}".format(app_object[:2], app_object)] = 10
+    status = ota.UpdateStatus(str(node / "statuses" / "update-status.json"), "0.2.0")
+    result = ota.stage_release(str(node), "0.2.0", ota.HTTPSource(mirror.url, timeout=10), str(node / ".citadel-0.2.0"), status)
+    assert result.downloaded_files == 4
+    # The manifest, four objects and the resumed one
+    assert len(mirror.requests) == 6
+    assert ("/objects/{}/{}".format(app_object[:2], app_object), "bytes=10-") in [request[:2] for request in mirror.requests]
+    with open(node / "statuses" / "update-status.json", "r") as f:
+        assert json.load(f)["files"] == 4
+    ota.apply_staged(str(node), str(node / ".citadel-0.2.0"))
+    assert read_tree(node)["scripts/app"] == new_release["scripts/app"]
+
+def test_mirror_for_another_release(tmp_path, release, mirror):
+    ota.write_mirror(str(release), "0.2.0", mirror.directory)
+    with pytest.raises(ota.UpdateError):
+        ota.HTTPSource(mirror.url).manifest("0.3.0")
@@ -0,0 +1,68 @@
+# SPDX-FileCopyrightText: 2023 Citadel and contributors
+#
+# SPDX-License-Identifier: GPL-3.0-or-later
+
+import errno
+import os
+import stat
+
+import pytest
+
+from trees import load
+
+tree = "app"
+permissions = load("app", "permissions")
+
+@pytest.fixture
+def data_dir(tmp_path):
+    for directory in ["a/deep/er", "b", "c/sub"]:
+        os.makedirs(tmp_path / "data" / directory)
+        (tmp_path / "data" / directory / "file").write_text("data")
+    os.symlink("a", tmp_path / "data" / "link")
+    return tmp_path / "data"
+
+def modes(root) -> dict:
+    result = {}
+    for directory, dirs, files in os.walk(root):
+        for name in dirs + files:
+            path = os.path.join(directory, name)
+            if not os.path.islink(path):
+                result[os.path.relpath(path, root)] = stat.S_IMODE(os.lstat(path).st_mode)
+    return result
+
+@pytest.mark.parametrize("jobs", [1, 4])
+def test_only_wrong_entries_are_changed(data_dir, jobs):
+    reconciler = permissions.Reconciler(mode=0o750, jobs=jobs)
+    first = reconciler.reconcile(str(data_dir))
+    assert first.scanned == 11 and first.chmodded == 10 and first.failed == 0
+    assert set(modes(data_dir).values()) == {0o750}
+    os.chmod(data_dir / "c" / "sub" / "file", 0o600)
+    assert reconciler.reconcile(str(data_dir)) == permissions.ReconcileStats(scanned=11, chmodded=1)
+
+def test_owner(data_dir):
+    st = os.stat(data_dir)
+    assert permissions.reconcileOwner(str(data_dir), st.st_uid, st.st_gid).chowned == 0
+
+def test_prune(data_dir):
+    stats = permissions.Reconciler(mode=0o700, prune=[str(data_dir / "a")]).reconcile(str(data_dir))
+    assert stats.scanned == 7
+    assert modes(data_dir)["a/deep/er/file"] != 0o700
+
+@pytest.mark.parametrize("jobs", [1, 4])
+def test_errors_dont_stop_the_walk(data_dir, monkeypatch, jobs, capsys):
+    chmod = os.chmod
+
+    # Like a file on a read-only mount inside the tree
+    def failing_chmod(path, mode, **kwargs):
+        if os.path.basename(os.path.dirname(path)) in ["a", "b"] or path == str(data_dir / "c"):
+            raise PermissionError(errno.EPERM, "Operation not permitted", path)
+        chmod(path, mode, **kwargs)
+
+    monkeypatch.setattr(permissions.os, "chmod", failing_chmod)
+    stats = permissions.Reconciler(mode=0o750, jobs=jobs).reconcile(str(data_dir))
+    assert stats.failed == 3
+    assert stats.chmodded == 7
+    # Everything else was fixed, including what's below the directory that failed
+    wrong = sorted(path for path, mode in modes(data_dir).items() if mode != 0o750)
+    assert wrong == ["a/deep", "b/file", "c"]
+    assert "Error changing permissions of {}".format(data_dir / "c") in capsys.readouterr().err
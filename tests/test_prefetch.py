@@ -0,0 +1,112 @@
+# SPDX-FileCopyrightText: 2023 Citadel and contributors
+#
+# SPDX-License-Identifier: GPL-3.0-or-later
+
+# Prefetching images with a fake docker on the PATH, which logs every call,
+# lists the images in images.txt and fails to pull the images in failures.json a given number of times
+
+import json
+import os
+import sys
+
+import pytest
+
+from trees import load
+
+tree = "app"
+prefetch = load("app", "prefetch")
+
+fake_docker = """#!{python}
+import json
+import os
+import sys
+
+state = os.environ["FAKE_DOCKER_STATE"]
+with open(os.path.join(state, "calls"), "a") as f:
+    f.write(" ".join(sys.argv[1:]) + "\\n")
+if sys.argv[1] == "images":
+    with open(os.path.join(state, "images.txt"), "r") as f:
+        sys.stdout.write(f.read())
+elif sys.argv[1] == "pull":
+    image = sys.argv[-1]
+    with open(os.path.join(state, "failures.json"), "r") as f:
+        failures = json.load(f)
+    attempts_file = os.path.join(state, "attempts-" + image.replace("/", "_").replace(":", "_").replace("@", "_"))
+    attempts = int(open(attempts_file).read()) + 1 if os.path.exists(attempts_file) else 1
+    with open(attempts_file, "w") as f:
+        f.write(str(attempts))
+    if attempts <= failures.get(image, 0):
+        sys.exit(1)
+"""
+
+digest = "sha256:" + "ab" * 32
+
+@pytest.fixture
+def docker(tmp_path, monkeypatch):
+    state = tmp_path / "docker"
+    bin_dir = tmp_path / "bin"
+    os.makedirs(state)
+    os.makedirs(bin_dir)
+    (bin_dir / "docker").write_text(fake_docker.format(python=sys.executable))
+    (bin_dir / "docker").chmod(0o755)
+    (state / "images.txt").write_text("")
+    (state / "failures.json").write_text("{}")
+    monkeypatch.setenv("PATH", "{}{}{}".format(bin_dir, os.pathsep, os.environ["PATH"]))
+    monkeypatch.setenv("FAKE_DOCKER_STATE", str(state))
+    # Don't wait between attempts
+    monkeypatch.setattr(prefetch.time, "sleep", lambda seconds: None)
+    return state
+
+def pulls(docker) -> list:
+    calls = (docker / "calls").read_text().splitlines() if (docker / "calls").exists() else []
+    return sorted(call.split()[-1] for call in calls if call.startswith("pull "))
+
+def write_compose(apps_dir, app: str, images: list):
+    os.makedirs(apps_dir / app)
+    services = {"service{}".format(i): {"image": image} for i, image in enumerate(images)}
+    (apps_dir / app / "docker-compose.yml").write_text(json.dumps({"services": services}))
+
+def test_collect_images(tmp_path):
+    write_compose(tmp_path, "lnd", ["lightninglabs/lnd:v0.17.0-beta", "nginx:1.25"])
+    write_compose(tmp_path, "btcpay", ["nginx:1.25", "btcpayserver/btcpayserver:1.11", "postgres:${POSTGRES_VERSION}"])
+    dependencies = {"compose": "v2.22.0", "tor": "nginx:1.25", "dashboard": "citadel/dashboard@" + digest}
+    images = prefetch.collectImages(str(tmp_path), ["lnd", "btcpay", "not-downloaded"], dependencies)
+    # Every image once, without the ones that depend on variables
+    assert images == ["btcpayserver/btcpayserver:1.11", "citadel/dashboard@" + digest, "lightninglabs/lnd:v0.17.0-beta", "nginx:1.25"]
+
+def test_present_images_are_skipped(docker):
+    (docker / "images.txt").write_text("\n".join([
+        "nginx 1.25 <none>",
+        "lightninglabs/lnd v0.17.0-beta <none>",
+        "citadel/dashboard latest " + digest,
+        "harbor.example.org/tor latest sha256:" + "cd" * 32,
+    ]) + "\n")
+    images = ["docker.io/library/nginx:1.25", "lightninglabs/lnd:v0.17.0-beta", "lightninglabs/lnd:v0.18.0-beta", "redis",
+              "citadel/dashboard@" + digest, "harbor.example.org/tor@sha256:" + "ef" * 32]
+    assert prefetch.presentImages(images) == {"docker.io/library/nginx:1.25", "lightninglabs/lnd:v0.17.0-beta", "citadel/dashboard@" + digest}
+    assert prefetch.prefetchImages(images, jobs=2) == []
+    assert pulls(docker) == sorted(["lightninglabs/lnd:v0.18.0-beta", "redis", "harbor.example.org/tor@sha256:" + "ef" * 32])
+
+def test_nothing_to_pull(docker):
+    (docker / "images.txt").write_text("nginx 1.25 <none>\n")
+    assert prefetch.prefetchImages(["nginx:1.25"]) == []
+    assert pulls(docker) == []
+
+def test_retries(docker):
+    (docker / "failures.json").write_text(json.dumps({"flaky:1": 2, "broken:1": 10}))
+    failed = prefetch.prefetchImages(["flaky:1", "broken:1", "fine:1"], jobs=3, attempts=3)
+    assert failed == ["broken:1"]
+    assert pulls(docker) == ["broken:1"] * 3 + ["fine:1"] + ["flaky:1"] * 3
+
+def test_collected_images_are_pulled_once(tmp_path, docker):
+    apps_dir = tmp_path / "apps"
+    write_compose(apps_dir, "lnd", ["lightninglabs/lnd:v0.17.0-beta", "nginx:1.25"])
+    write_compose(apps_dir, "btcpay", ["nginx:1.25", "postgres:15"])
+    images = prefetch.collectImages(str(apps_dir), ["lnd", "btcpay"], {"tor": "postgres:15"})
+    assert prefetch.prefetchImages(images, jobs=4) == []
+    assert pulls(docker) == ["lightninglabs/lnd:v0.17.0-beta", "nginx:1.25", "postgres:15"]
+
+def test_without_docker(tmp_path, monkeypatch):
+    monkeypatch.setenv("PATH", str(tmp_path))
+    monkeypatch.setattr(prefetch.time, "sleep", lambda seconds: None)
+    assert prefetch.presentImages(["nginx:1.25"]) == set()
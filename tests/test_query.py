@@ -0,0 +1,69 @@
+# SPDX-FileCopyrightText: 2023 Citadel and contributors
+#
+# SPDX-License-Identifier: GPL-3.0-or-later
+
+# The query actions, answered in-process and by the app-manager daemon
+
+import json
+import os
+import threading
+import time
+
+import pytest
+
+from trees import load
+
+tree = "app"
+query = load("app", "query")
+daemon = load("app", "daemon")
+
+@pytest.fixture
+def node_root(tmp_path):
+    for directory in ["apps", "db", "events"]:
+        os.makedirs(tmp_path / directory)
+    (tmp_path / "apps" / "registry.json").write_text(json.dumps([{"id": "lnd"}, {"id": "btcpay"}]))
+    (tmp_path / "apps" / "virtual-apps.json").write_text(json.dumps({"lightning": ["lnd"]}))
+    (tmp_path / ".env").write_text("APP_LND_SERVICE_IP=10.21.22.3\n")
+    return tmp_path
+
+def write_user(node_root, data: dict):
+    (node_root / "db" / "user.json").write_text(json.dumps(data))
+    # A new mtime, so the cached state is read again
+    os.utime(node_root / "db" / "user.json", ns=(time.time_ns(), time.time_ns()))
+
+# A daemon for the node, and a function that asks it once it is listening
+@pytest.fixture
+def ask_daemon(node_root):
+    path = daemon.socketPath(str(node_root))
+    threading.Thread(target=daemon.serve, args=(str(node_root), path), daemon=True).start()
+
+    def ask(action: str, app=None):
+        for _ in range(100):
+            result = daemon.request(path, action, app)
+            if result is not None:
+                return result
+            time.sleep(0.05)
+        raise TimeoutError("The daemon didn't answer")
+
+    return ask
+
+def test_ls_installed(node_root, ask_daemon):
+    write_user(node_root, {"installedApps": ["lnd", "lightning", "btcpay"]})
+    # Virtual apps aren't listed
+    assert query.runQuery(str(node_root), "ls-installed", None) == (0, "lnd\nbtcpay\n")
+    assert ask_daemon("ls-installed") == (0, "lnd\nbtcpay\n")
+
+# scripts/app checks for an empty list of installed apps
+@pytest.mark.parametrize("user", [None, {}, {"installedApps": []}])
+def test_ls_installed_without_apps(node_root, ask_daemon, user):
+    if user is not None:
+        write_user(node_root, user)
+    assert query.runQuery(str(node_root), "ls-installed", None) == (0, "")
+    assert ask_daemon("ls-installed") == (0, "")
+
+def test_implementation(node_root, ask_daemon):
+    write_user(node_root, {"installedApps": ["lnd"]})
+    assert query.runQuery(str(node_root), "get-implementation", "lightning") == (0, "lnd\n")
+    assert ask_daemon("get-implementation", "lightning") == (0, "lnd\n")
+    assert ask_daemon("get-ip", "lightning") == query.runQuery(str(node_root), "get-ip", "lightning") == (0, "10.21.22.3\n")
+    assert query.runQuery(str(node_root), "get-implementation", "btcpay") == (1, "Not an virtual app\n")
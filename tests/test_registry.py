@@ -0,0 +1,59 @@
+# SPDX-FileCopyrightText: 2023 Citadel and contributors
+#
+# SPDX-License-Identifier: GPL-3.0-or-later
+
+import json
+import os
+import threading
+
+from trees import load
+
+tree = "app"
+registry = load("app", "registry")
+
+def write_json(path: str, data):
+    with open(path + ".tmp", "w") as f:
+        json.dump(data, f)
+    os.replace(path + ".tmp", path)
+
+def write_registry(apps_dir, version: int):
+    write_json(os.path.join(apps_dir, "registry.json"), [{"id": "app-{}".format(i), "version": version} for i in range(50)])
+    write_json(os.path.join(apps_dir, "virtual-apps.json"), {"lightning": ["app-1", "app-2"]})
+
+def test_lookups(tmp_path):
+    write_registry(tmp_path, 1)
+    catalog = registry.AppCatalog(str(tmp_path))
+    assert catalog.getEntry("app-3") == {"id": "app-3", "version": 1}
+    assert catalog.getEntry("missing") is None
+    assert catalog.getImplementedVirtualApps("app-2") == ["lightning"]
+    assert catalog.getInstalledImplementation("lightning", ["app-2"]) == "app-2"
+    write_registry(tmp_path, 2)
+    os.utime(os.path.join(tmp_path, "registry.json"), ns=(1, 1))
+    assert catalog.getEntry("app-3") == {"id": "app-3", "version": 2}
+
+# Lookups from many threads while the registry keeps changing never fail or return something that isn't an entry
+def test_concurrent_refresh(tmp_path):
+    write_registry(tmp_path, 0)
+    catalog = registry.AppCatalog(str(tmp_path))
+    errors = []
+    done = threading.Event()
+
+    def lookup():
+        try:
+            while not done.is_set():
+                for i in range(50):
+                    entry = catalog.getEntry("app-{}".format(i))
+                    assert entry is not None and entry["id"] == "app-{}".format(i)
+        except Exception as e:
+            errors.append(e)
+
+    threads = [threading.Thread(target=lookup) for _ in range(4)]
+    for thread in threads:
+        thread.start()
+    for version in range(1, 30):
+        write_registry(tmp_path, version)
+        os.utime(os.path.join(tmp_path, "registry.json"), ns=(version, version))
+    done.set()
+    for thread in threads:
+        thread.join()
+    assert errors == []
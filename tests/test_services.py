@@ -0,0 +1,63 @@
+# SPDX-FileCopyrightText: 2023 Citadel and contributors
+#
+# SPDX-License-Identifier: GPL-3.0-or-later
+
+import json
+import os
+import shutil
+
+import pytest
+import yaml
+
+from trees import load, repo_root
+
+tree = "scripts"
+services = load("scripts", "services")
+torplacement = load("app", "torplacement")
+
+def main_compose_services() -> dict:
+    with open(os.path.join(repo_root, "docker-compose.yml"), "r") as f:
+        return yaml.safe_load(f)["services"]
+
+addresses = {"app-4-tor": ["10.21.21.250", "fd00::250"], "app-5-tor": ["10.21.21.251", "fd00::251"]}
+
+# configure adds the instances itself, the result has to be the same as when the app-manager scales them
+@pytest.mark.parametrize("count", [1, 3, 5])
+def test_same_instances_as_the_app_manager(count):
+    assert services.compose_app_tor_instances(main_compose_services(), count, addresses) == \
+        torplacement.composeInstances(main_compose_services(), count, addresses)
+
+def test_instance_names():
+    for index in range(torplacement.maxInstanceCount):
+        assert services.app_tor_instance_name(index) == torplacement.instanceName(index)
+        assert services.app_tor_torrc_name(index) == torplacement.torrcName(index)
+        assert services.app_tor_ip_var(index) == torplacement.ipVar(index)
+        assert services.is_app_tor_instance(services.app_tor_instance_name(index))
+    assert services.tor_placement_version == torplacement.stateVersion
+    assert services.builtin_app_tor_instances == torplacement.builtinInstanceCount
+    assert not services.is_app_tor_instance("tor")
+
+@pytest.fixture
+def node_root(tmp_path):
+    shutil.copy(os.path.join(repo_root, "docker-compose.yml"), tmp_path / "docker-compose.yml")
+    shutil.copytree(os.path.join(repo_root, "services", "bitcoin"), tmp_path / "services" / "bitcoin")
+    os.makedirs(tmp_path / "db")
+    return tmp_path
+
+def test_apply_scaled_instances(node_root):
+    (node_root / "db" / "tor-placement.json").write_text(json.dumps(
+        {"version": torplacement.stateVersion, "instances": 5, "addresses": addresses, "assignments": {}, "load": {}}))
+    config = services.ServiceConfig(str(node_root))
+    config.apply()
+    assert config.app_tor_instances() == ["app-tor", "app-2-tor", "app-3-tor", "app-4-tor", "app-5-tor"]
+    assert config.compose["services"]["app-5-tor"]["networks"]["default"]["ipv4_address"] == "10.21.21.251"
+    images = services.core_images({"manager": "manager", "dashboard": "dashboard", "tor": "tor"}, config.app_tor_instances())
+    assert [service for service, image in images.items() if image == "tor"] == ["tor"] + config.app_tor_instances()
+
+def test_apply_without_placement(node_root):
+    config = services.ServiceConfig(str(node_root))
+    config.apply()
+    assert config.app_tor_instances() == ["app-tor", "app-2-tor", "app-3-tor"]
+    config.save()
+    # Saving again changes nothing
+    assert services.ServiceConfig(str(node_root)).save() == []
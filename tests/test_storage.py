@@ -0,0 +1,55 @@
+# SPDX-FileCopyrightText: 2023 Citadel and contributors
+#
+# SPDX-License-Identifier: GPL-3.0-or-later
+
+import os
+import subprocess
+
+import pytest
+
+from trees import load
+
+tree = "scripts"
+storage = load("scripts", "storage")
+
+def write_files(root, count: int, size: int = 5000):
+    for i in range(count):
+        directory = root / "dir-{}".format(i % 3) / "sub"
+        os.makedirs(directory, exist_ok=True)
+        (directory / "file-{}".format(i)).write_bytes(b"x" * size)
+
+def du(path) -> int:
+    return int(subprocess.check_output(["du", "--block-size=1", "--summarize", str(path)]).split()[0])
+
+@pytest.fixture
+def apps(tmp_path):
+    for app in ["lnd", "btcpay"]:
+        write_files(tmp_path / app, 10)
+    return tmp_path
+
+def test_matches_du(apps):
+    accountant = storage.StorageAccountant()
+    sizes = accountant.scan([str(apps / "lnd"), str(apps / "btcpay"), str(apps / "missing")], full=True)
+    assert sizes == {str(apps / "lnd"): du(apps / "lnd"), str(apps / "btcpay"): du(apps / "btcpay"), str(apps / "missing"): 0}
+
+def test_unchanged_dirs_are_reused(apps, tmp_path):
+    cache_file = str(tmp_path / "cache")
+    accountant = storage.StorageAccountant(cache_file)
+    accountant.scan([str(apps / "lnd")], full=True)
+    accountant.save()
+    accountant = storage.StorageAccountant(cache_file)
+    (apps / "lnd" / "dir-1" / "new").write_bytes(b"x" * 10000)
+    assert accountant.scan([str(apps / "lnd")], full=False) == {str(apps / "lnd"): du(apps / "lnd")}
+    assert accountant.dirs_listed == 1
+    assert accountant.dirs_reused == 6
+
+def test_full_scan_drops_directories_that_are_not_scanned(apps):
+    accountant = storage.StorageAccountant()
+    accountant.scan([str(apps / "lnd"), str(apps / "btcpay")], full=True)
+    # Scanning a subset keeps the cache of the others
+    accountant.scan([str(apps / "lnd")], full=False)
+    assert any(path.startswith(str(apps / "btcpay")) for path in accountant.dirs)
+    # btcpay was uninstalled
+    accountant.scan([str(apps / "lnd")], full=True)
+    assert accountant.dirs
+    assert all(path.startswith(str(apps / "lnd")) for path in accountant.dirs)
@@ -0,0 +1,164 @@
+# SPDX-FileCopyrightText: 2023 Citadel and contributors
+#
+# SPDX-License-Identifier: GPL-3.0-or-later
+
+# Placement of the apps' hidden services on the app Tor instances, with torrc files like the app-cli writes them
+
+import json
+import os
+import shutil
+import time
+
+import pytest
+import yaml
+
+from trees import load, repo_root
+
+tree = "app"
+torplacement = load("app", "torplacement")
+
+# The hidden services of every app
+apps = {
+    "lnd": ["app-lnd-rest", "app-lnd-grpc"],
+    "btcpay": ["app-btcpay"],
+    "mempool": ["app-mempool"],
+    "electrs": ["app-electrs"],
+    "ride": ["app-ride"],
+}
+
+def torrc(services: list, preamble: str = "SocksPort 0") -> str:
+    blocks = [preamble] + ["# {} Hidden Service\nHiddenServiceDir /var/lib/tor/{}\nHiddenServicePort 80 10.21.21.9:3000".format(service, service)
+                           for service in services]
+    return "\n\n".join(blocks) + "\n"
+
+def hosted(node_root, index: int) -> list:
+    content = (node_root / "tor" / torplacement.torrcName(index)).read_text()
+    return sorted(service.name for service in torplacement.parseTorrc(content)[1])
+
+@pytest.fixture
+def node_root(tmp_path, monkeypatch):
+    for directory in ["apps", "db", "tor", "statuses"]:
+        os.makedirs(tmp_path / directory)
+    (tmp_path / "apps" / "registry.json").write_text(json.dumps([{"id": app, "hiddenServices": services} for app, services in apps.items()]))
+    (tmp_path / "apps" / "virtual-apps.json").write_text("{}")
+    install(tmp_path, list(apps))
+    # No docker here, the tests set the CPU time every instance used
+    monkeypatch.setattr(torplacement, "_cpuUsage", lambda containers: {name: cpu_seconds.get(name, 0.0) for name in containers})
+    cpu_seconds.clear()
+    return tmp_path
+
+cpu_seconds = {}
+
+def install(node_root, installed: list):
+    (node_root / "db" / "user.json").write_text(json.dumps({"installedApps": installed}))
+    # A new mtime, so the cached state is read again
+    stat = os.stat(node_root / "db" / "user.json")
+    os.utime(node_root / "db" / "user.json", ns=(stat.st_atime_ns, stat.st_mtime_ns + 10 ** 9))
+
+# Like the app-cli: every service in one of the three files
+def generate(node_root, files: list):
+    for index, services in enumerate(files):
+        (node_root / "tor" / torplacement.torrcName(index)).write_text(torrc(sorted(services)))
+
+def write_state(node_root, assignments: dict, instances: int = 3, load: dict = None):
+    (node_root / "db" / "tor-placement.json").write_text(json.dumps({
+        "version": torplacement.stateVersion, "instances": instances, "assignments": assignments, "addresses": {}, "load": load or {}}))
+
+def test_first_run_adopts_the_app_cli_placement(node_root):
+    generate(node_root, [["app-lnd-rest", "app-lnd-grpc"], ["app-btcpay", "app-mempool"], ["app-electrs"]])
+    assert torplacement.TorPlacement(str(node_root)).apply(generated=True) == []
+    state = json.loads((node_root / "db" / "tor-placement.json").read_text())
+    assert state["assignments"] == {"app-lnd-rest": 0, "app-lnd-grpc": 0, "app-btcpay": 1, "app-mempool": 1, "app-electrs": 2}
+    assert "new" not in state
+    status = json.loads((node_root / "statuses" / "tor-status.json").read_text())
+    assert [instance["services"] for instance in status["instances"]] == [2, 2, 1]
+
+def test_assignments_are_sticky(node_root):
+    write_state(node_root, {"app-lnd-rest": 2, "app-lnd-grpc": 2, "app-btcpay": 0, "app-mempool": 1, "app-electrs": 1})
+    # The app-cli puts the services somewhere else, and a new app on the first instance
+    generate(node_root, [["app-lnd-rest", "app-lnd-grpc", "app-btcpay", "app-ride"], ["app-mempool"], ["app-electrs"]])
+    changed = torplacement.TorPlacement(str(node_root)).apply(generated=True)
+    assert [hosted(node_root, index) for index in range(3)] == [["app-btcpay", "app-ride"], ["app-electrs", "app-mempool"], ["app-lnd-grpc", "app-lnd-rest"]]
+    # The first instance had the fewest services
+    assert changed == [0, 1, 2]
+    # Running it again changes nothing
+    assert torplacement.TorPlacement(str(node_root)).apply() == []
+
+def test_new_services_of_an_app_stay_with_it(node_root):
+    write_state(node_root, {"app-lnd-rest": 1, "app-btcpay": 0, "app-mempool": 2})
+    generate(node_root, [["app-lnd-rest", "app-lnd-grpc", "app-btcpay", "app-mempool"], [], []])
+    assert torplacement.TorPlacement(str(node_root)).apply(generated=True) == [0, 1, 2]
+    assert hosted(node_root, 1) == ["app-lnd-grpc", "app-lnd-rest"]
+
+def test_torrc_keeps_its_inode(node_root):
+    write_state(node_root, {"app-lnd-rest": 0, "app-lnd-grpc": 0, "app-btcpay": 1})
+    generate(node_root, [["app-lnd-rest", "app-lnd-grpc"], ["app-btcpay"], ["app-mempool"]])
+    inodes = [os.stat(node_root / "tor" / torplacement.torrcName(index)).st_ino for index in range(3)]
+    generate(node_root, [["app-lnd-rest", "app-lnd-grpc", "app-btcpay", "app-mempool"], [], []])
+    assert torplacement.TorPlacement(str(node_root)).apply(generated=True) == [0, 1, 2]
+    # The containers bind-mount these files, a new inode wouldn't be seen by a running Tor
+    assert [os.stat(node_root / "tor" / torplacement.torrcName(index)).st_ino for index in range(3)] == inodes
+    assert hosted(node_root, 2) == ["app-mempool"]
+
+def test_services_of_apps_that_arent_installed_count_less(node_root):
+    install(node_root, ["lnd", "btcpay"])
+    # Two idle services on the first instance weigh less than an installed app
+    write_state(node_root, {"app-mempool": 0, "app-electrs": 0, "app-btcpay": 1}, instances=2)
+    generate(node_root, [["app-mempool", "app-electrs", "app-btcpay", "app-ride"], [], []])
+    torplacement.TorPlacement(str(node_root)).apply(generated=True)
+    assert hosted(node_root, 0) == ["app-electrs", "app-mempool", "app-ride"]
+
+def test_busy_instances_get_no_new_apps(node_root):
+    # 100 seconds ago, both instances had used no CPU time yet
+    measured = {"cpuSeconds": 0.0, "time": time.time() - 100, "cores": 0.0}
+    write_state(node_root, {"app-mempool": 0, "app-btcpay": 1}, instances=2, load={"app-tor": measured, "app-2-tor": measured})
+    cpu_seconds.update({"app-tor": 50.0, "app-2-tor": 10.0})
+    generate(node_root, [["app-mempool", "app-btcpay", "app-ride"], [], []])
+    torplacement.TorPlacement(str(node_root)).apply(generated=True)
+    assert hosted(node_root, 1) == ["app-btcpay", "app-ride"]
+
+def test_rebalance(node_root):
+    everything = {service: 0 for services in apps.values() for service in services}
+    generate(node_root, [sorted(everything), [], []])
+    write_state(node_root, everything)
+    # Without rebalancing, nothing moves
+    assert torplacement.TorPlacement(str(node_root)).apply(generated=True) == []
+    assert hosted(node_root, 0) == sorted(everything)
+    placement = torplacement.TorPlacement(str(node_root))
+    assert placement.apply(rebalance=True) == [0, 1, 2]
+    counts = [len(hosted(node_root, index)) for index in range(3)]
+    assert sum(counts) == len(everything) and max(counts) - min(counts) <= 1
+    # Apps are moved as a whole
+    assert len(set(placement.state["assignments"][service] for service in apps["lnd"])) == 1
+
+@pytest.fixture
+def compose_node(node_root):
+    shutil.copy(os.path.join(repo_root, "docker-compose.yml"), node_root / "docker-compose.yml")
+    (node_root / ".env").write_text("NETWORK_IP=10.21.21.0\nNETWORK_IP6=fd00::21:0:0:0\n")
+    return node_root
+
+def test_scale_down_removes_torrc_files(compose_node):
+    write_state(compose_node, {"app-lnd-rest": 0, "app-lnd-grpc": 0, "app-btcpay": 1, "app-mempool": 2, "app-electrs": 2})
+    generate(compose_node, [["app-lnd-rest", "app-lnd-grpc"], ["app-btcpay"], ["app-mempool", "app-electrs"]])
+    placement = torplacement.TorPlacement(str(compose_node))
+    added, removed, lost, others = placement.scale(2)
+    assert (added, removed, lost) == ([], ["app-3-tor"], [])
+    assert not os.path.exists(compose_node / "tor" / "torrc-apps-3")
+    # Only the services of the removed instance moved, one app to each of the others
+    assert hosted(compose_node, 0) == ["app-lnd-grpc", "app-lnd-rest", "app-mempool"]
+    assert hosted(compose_node, 1) == ["app-btcpay", "app-electrs"]
+    assert others == ["app-tor", "app-2-tor"]
+    assert placement.instanceCount() == 2
+
+def test_scale_up(compose_node):
+    write_state(compose_node, {"app-lnd-rest": 0, "app-lnd-grpc": 0, "app-btcpay": 1, "app-mempool": 2})
+    generate(compose_node, [["app-lnd-rest", "app-lnd-grpc"], ["app-btcpay"], ["app-mempool"]])
+    added, removed, lost, others = torplacement.TorPlacement(str(compose_node)).scale(4)
+    assert (added, removed, lost, others) == (["app-4-tor"], [], [], [])
+    with open(compose_node / "docker-compose.yml", "r") as f:
+        assert yaml.safe_load(f)["services"]["app-4-tor"]["container_name"] == "app-4-tor"
+    # The added instance gets its own data dir, and existing services stay where they are
+    assert (compose_node / "tor" / "torrc-apps-4").read_text() == torplacement.addedInstancePreamble.format("app-4-tor")
+    assert hosted(compose_node, 0) == ["app-lnd-grpc", "app-lnd-rest"]
+    with pytest.raises(ValueError):
+        torplacement.TorPlacement(str(compose_node)).scale(torplacement.maxInstanceCount + 1)
@@ -0,0 +1,155 @@
+# SPDX-FileCopyrightText: 2023 Citadel and contributors
+#
+# SPDX-License-Identifier: GPL-3.0-or-later
+
+# configure and karen trace with scripts/lib/tracing.py, the app-manager with app/lib/tracing.py,
+# an app-manager call made by a script has to become part of the script's trace
+
+import json
+import os
+import subprocess
+import sys
+
+from trees import load, tree_dirs
+
+tree = "scripts"
+tracing = load("scripts", "tracing")
+app_tracing = load("app", "tracing")
+
+# Like the app-manager: a trace with a phase
+app_manager = """
+import sys
+sys.path.insert(0, {app!r})
+from lib.tracing import span, startTrace
+startTrace({root!r}, "app-manager", "app-manager start lnd")
+with span("registry lookup", apps=1):
+    pass
+"""
+
+# Like configure: phases, one of which runs the app-manager
+configure = """
+import subprocess
+import sys
+sys.path.insert(0, {scripts!r})
+from lib.tracing import Phases, start_trace
+start_trace({root!r}, "configure", "configure")
+phases = Phases()
+phases.start("generate")
+subprocess.run([sys.executable, "-c", {app_manager!r}], check=True)
+phases.start("write files", files=2)
+phases.end()
+"""
+
+def run_configure(node_root, env: dict):
+    app_manager_code = app_manager.format(app=tree_dirs["app"], root=str(node_root))
+    code = configure.format(scripts=tree_dirs["scripts"], root=str(node_root), app_manager=app_manager_code)
+    subprocess.run([sys.executable, "-c", code], check=True, env=env)
+
+def clean_env() -> dict:
+    return {name: value for name, value in os.environ.items() if not name.startswith("CITADEL_TRACE")}
+
+def test_shared_trace(tmp_path):
+    os.makedirs(tmp_path / "logs")
+    os.makedirs(tmp_path / "db")
+    (tmp_path / "db" / "tracing").touch()
+    run_configure(tmp_path, clean_env())
+    spans = tracing.read_spans(str(tmp_path))
+    by_name = {entry["name"]: entry for entry in spans}
+    assert set(by_name) == {"configure", "generate", "subprocess", "write files", "app-manager start lnd", "registry lookup"}
+    assert len({entry["trace"] for entry in spans}) == 1
+    assert by_name["configure"]["parent"] is None
+    assert by_name["generate"]["parent"] == by_name["configure"]["span"]
+    assert by_name["subprocess"]["parent"] == by_name["generate"]["span"]
+    assert by_name["app-manager start lnd"]["parent"] == by_name["subprocess"]["span"]
+    assert by_name["registry lookup"]["parent"] == by_name["app-manager start lnd"]["span"]
+    assert by_name["configure"]["attributes"]["subprocesses"] == 1
+    assert {entry["component"] for entry in spans} == {"configure", "app-manager"}
+    # Both write the same fields
+    assert set(by_name["write files"]) == set(by_name["registry lookup"])
+    summary = tracing.summarize(spans)
+    assert [operation["name"] for operation in summary["operations"]] == ["configure"]
+    assert summary["operations"][0]["subprocesses"] == 1
+
+def test_disabled(tmp_path):
+    os.makedirs(tmp_path / "logs")
+    os.makedirs(tmp_path / "db")
+    run_configure(tmp_path, clean_env())
+    assert not os.path.exists(tmp_path / "logs" / tracing.trace_file_name)
+
+def test_operations(tmp_path, monkeypatch):
+    for name in ["CITADEL_TRACE", "CITADEL_TRACE_ID", "CITADEL_TRACE_PARENT"]:
+        monkeypatch.delenv(name, raising=False)
+    os.makedirs(tmp_path / "logs")
+    assert tracing.start_operation(str(tmp_path), "karen", "app install lnd") == (tracing.noop_span, {})
+    monkeypatch.setenv("CITADEL_TRACE", "1")
+    operation, env = tracing.start_operation(str(tmp_path), "karen", "app install lnd", queuedMs=1.5)
+    operation.end(exitCode=0)
+    entry, = tracing.read_spans(str(tmp_path))
+    assert entry["trace"] == env["CITADEL_TRACE_ID"] and entry["span"] == env["CITADEL_TRACE_PARENT"]
+    assert entry["attributes"] == {"queuedMs": 1.5, "exitCode": 0}
+
+def test_rotation_matches(tmp_path):
+    sizes = {}
+    for name, append in [("scripts", tracing.append_rotated), ("app", app_tracing.appendRotated)]:
+        os.makedirs(tmp_path / name)
+        path = str(tmp_path / name / "trace.ndjson")
+        for _ in range(5):
+            append(path, b"x" * 40 + b"\n", 100, 2)
+        sizes[name] = {file: os.path.getsize(tmp_path / name / file) for file in os.listdir(tmp_path / name)}
+    assert sizes["scripts"] == sizes["app"] == {"trace.ndjson": 41, "trace.ndjson.1": 82, "trace.ndjson.2": 82}
+    assert tracing.kept_trace_files == app_tracing.keptTraceFiles
+    assert tracing.trace_file_name == app_tracing.traceFileName
+
+# The same operation traced by either implementation, in a process started by a traced parent:
+# a phase runs a child with subprocess.run() and another one with os.system(), which record the trace they got
+traced_operation = """
+import json
+import os
+import subprocess
+import sys
+sys.path.insert(0, {lib_dir!r})
+from lib.tracing import span, {start}
+{start}({root!r}, "test", "operation", apps=2)
+child = "import json, os, sys; json.dump({{name: value for name, value in os.environ.items() if name.startswith('CITADEL_TRACE')}}, open(sys.argv[1], 'w'))"
+with span("phase", files=3) as phase:
+    subprocess.run([sys.executable, "-c", child, {run_env!r}], check=True)
+    os.system("{{}} -c \\"{{}}\\" {{}}".format(sys.executable, child, {system_env!r}))
+    phase.set(done=True)
+"""
+
+def traced_by(implementation: str, node_root, parent_env: dict):
+    os.makedirs(node_root / "logs")
+    code = traced_operation.format(lib_dir=tree_dirs[implementation], root=str(node_root),
+                                   start="start_trace" if implementation == "scripts" else "startTrace",
+                                   run_env=str(node_root / "run.json"), system_env=str(node_root / "system.json"))
+    subprocess.run([sys.executable, "-c", code], check=True, env=dict(clean_env(), **parent_env))
+    spans = tracing.read_spans(str(node_root))
+    child_envs = [json.loads((node_root / name).read_text()) for name in ["run.json", "system.json"]]
+    return spans, child_envs
+
+def test_implementations_match(tmp_path):
+    parent_env = {"CITADEL_TRACE": "1", "CITADEL_TRACE_ID": "0123456789abcdef", "CITADEL_TRACE_PARENT": "76543210"}
+    results = {implementation: traced_by(implementation, tmp_path / implementation, parent_env) for implementation in ["scripts", "app"]}
+    records = {}
+    for implementation, (spans, child_envs) in results.items():
+        ids = {entry["span"]: entry["name"] for entry in spans}
+        subprocess_spans = [entry for entry in spans if entry["name"] == "subprocess"]
+        assert len(subprocess_spans) == 2
+        # Each child continues the trace under the span of the call that started it
+        assert [env["CITADEL_TRACE_PARENT"] for env in child_envs] == [entry["span"] for entry in subprocess_spans]
+        assert all(env["CITADEL_TRACE_ID"] == parent_env["CITADEL_TRACE_ID"] and env["CITADEL_TRACE"] == "1" for env in child_envs)
+        # The same records, apart from the ids, times and the process
+        records[implementation] = []
+        for entry in spans:
+            assert set(entry) == {"trace", "span", "parent", "component", "name", "start", "durationMs", "pid", "attributes"}
+            assert isinstance(entry["start"], float) and isinstance(entry["durationMs"], float) and entry["pid"] > 0
+            assert entry["trace"] == parent_env["CITADEL_TRACE_ID"]
+            attributes = dict(entry["attributes"], command=entry["attributes"]["command"].split(" -c ")[0]) if "command" in entry["attributes"] else entry["attributes"]
+            records[implementation].append((entry["name"], ids.get(entry["parent"], entry["parent"]), entry["component"], attributes))
+    assert records["scripts"] == records["app"]
+    assert records["app"] == [
+        ("subprocess", "phase", "test", {"command": sys.executable, "exitCode": 0}),
+        ("subprocess", "phase", "test", {"command": sys.executable, "exitCode": 0}),
+        ("phase", "operation", "test", {"files": 3, "done": True}),
+        ("operation", "76543210", "test", {"apps": 2, "subprocesses": 2}),
+    ]
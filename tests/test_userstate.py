@@ -0,0 +1,88 @@
+# SPDX-FileCopyrightText: 2023 Citadel and contributors
+#
+# SPDX-License-Identifier: GPL-3.0-or-later
+
+# Many processes and threads install and remove apps at the same time, afterwards every change has to be in user.json
+#
+# Every worker installs its own apps (some of them together with a virtual app, like app-manager.py install does),
+# removes every second one again and reads the state in between. Other keys of user.json must survive.
+
+import json
+import multiprocessing
+import os
+import threading
+
+from trees import load
+
+tree = "app"
+userstate = load("app", "userstate")
+
+workers = 8
+apps = 30
+
+def worker(user_file: str, worker: int):
+    state = userstate.getUserState(user_file)
+    for i in range(apps):
+        app = "app-{}-{}".format(worker, i)
+        if i % 5 == 0:
+            state.install(app, "virtual-{}-{}".format(worker, i))
+        else:
+            state.install(app)
+        state.read()
+        if i % 2 == 1:
+            state.remove(app)
+
+def expected(worker_ids) -> set:
+    installed = set()
+    for worker in worker_ids:
+        for i in range(apps):
+            if i % 2 == 0:
+                installed.add("app-{}-{}".format(worker, i))
+            if i % 5 == 0:
+                installed.add("virtual-{}-{}".format(worker, i))
+    return installed
+
+def write_user_file(tmp_path) -> str:
+    user_file = os.path.join(tmp_path, "user.json")
+    with open(user_file, "w") as f:
+        json.dump({"name": "satoshi", "installedApps": []}, f)
+    return user_file
+
+def check_no_lost_updates(user_file: str, worker_ids):
+    with open(user_file, "r") as f:
+        user_data = json.load(f)
+    assert user_data["name"] == "satoshi"
+    installed = user_data["installedApps"]
+    assert len(installed) == len(set(installed))
+    assert expected(worker_ids) - set(installed) == set(), "lost installs"
+    assert set(installed) - expected(worker_ids) == set(), "lost removals"
+    assert not [name for name in os.listdir(os.path.dirname(user_file)) if name.endswith(".tmp")]
+
+def test_concurrent_processes(tmp_path):
+    user_file = write_user_file(tmp_path)
+    context = multiprocessing.get_context("fork")
+    processes = [context.Process(target=worker, args=(user_file, i)) for i in range(workers)]
+    for process in processes:
+        process.start()
+    for process in processes:
+        process.join()
+    assert [process.exitcode for process in processes] == [0] * workers
+    check_no_lost_updates(user_file, range(workers))
+
+# The app-manager changes the state from several threads when it starts or stops apps at once
+def test_concurrent_threads_and_processes(tmp_path):
+    user_file = write_user_file(tmp_path)
+    context = multiprocessing.get_context("fork")
+    processes = [context.Process(target=worker, args=(user_file, i)) for i in range(workers // 2)]
+    threads = [threading.Thread(target=worker, args=(user_file, i)) for i in range(workers // 2, workers)]
+    for process in processes:
+        process.start()
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    for process in processes:
+        process.join()
+    assert [process.exitcode for process in processes] == [0] * (workers // 2)
+    check_no_lost_updates(user_file, range(workers))
+    assert set(userstate.getUserState(user_file).read()["installedApps"]) == expected(range(workers))
@@ -0,0 +1,36 @@
+# SPDX-FileCopyrightText: 2023 Citadel and contributors
+#
+# SPDX-License-Identifier: GPL-3.0-or-later
+
+# app/lib and scripts/lib are both imported as "lib", so tests can't just put both on sys.path.
+# Every tree gets its own set of "lib" modules, which are swapped into sys.modules while a test of that tree runs.
+# A test module sets "tree" to "app" or "scripts" and loads modules with load(), conftest.py does the rest.
+
+import contextlib
+import importlib
+import os
+import sys
+from typing import Dict
+
+repo_root = os.path.realpath(os.path.join(os.path.dirname(os.path.realpath(__file__)), ".."))
+tree_dirs = {"app": os.path.join(repo_root, "app"), "scripts": os.path.join(repo_root, "scripts")}
+_modules: Dict[str, dict] = {name: {} for name in tree_dirs}
+
+def _lib_modules() -> dict:
+    return {name: sys.modules.pop(name) for name in list(sys.modules) if name == "lib" or name.startswith("lib.")}
+
+@contextlib.contextmanager
+def use_tree(name: str):
+    saved = _lib_modules()
+    sys.modules.update(_modules[name])
+    sys.path.insert(0, tree_dirs[name])
+    try:
+        yield
+    finally:
+        sys.path.remove(tree_dirs[name])
+        _modules[name] = _lib_modules()
+        sys.modules.update(saved)
+
+def load(tree: str, module: str):
+    with use_tree(tree):
+        return importlib.import_module("lib." + module)